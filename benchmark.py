@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Micro-benchmarks for the Echo360 Tools.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Usage: python benchmark.py parse --count 10000
+#        python benchmark.py throughput --rooms 100 --threads 16 --count 5000
+#
+# parse:     the cost of each status response: XML parse (ET.fromstring), field extraction with one
+#            add_value()/add_timestamp() (ElementTree find) per field, and with the compiled Echo360FieldSchema.
+# timestamp: UTC to local timestamp conversion, the strptime/mktime/fromtimestamp/strftime path the
+#            tools used to use, and local_timestamp() without (miss) and with (hit) its memo.
+# throughput: status_monitoring() polling of simulated devices (simulator.py, run as a separate process so
+#            it doesn't share the client's CPU): one device polled by --threads threads, and --rooms devices
+#            polled by an Echo360Fleet with --threads workers. Reports requests/s, p50/p99 latency, the client
+#            CPU per request and the parse (make_response() and field extraction) time per response.
+
+from capture_device import Echo360CaptureDevice, Echo360CaptureDeviceResponse
+from fleet import Echo360Fleet, Echo360WorkerPool
+import capture_device
+import argparse
+import datetime
+import os
+import socket
+import subprocess
+import sys
+import time
+import timeit
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+SAMPLE_CAPTURE = '''
+    <schedule>
+      <type>scheduled</type>
+      <start-time>2014-07-09T05:08:22.000Z</start-time>
+      <duration>5400</duration>
+      <parameters>
+        <title>Introduction to Lecture Capture</title>
+        <section>ECHO101 Semester 2</section>
+        <capture-profile>
+          <name>Standard Lecture</name>
+        </capture-profile>
+      </parameters>
+    </schedule>
+    <state>active</state>
+    <start-time>2014-07-09T05:08:22.000Z</start-time>
+    <duration>5400</duration>
+'''
+
+SAMPLE_RESPONSES = [
+    ('status/system', Echo360CaptureDevice.STATUS_SYSTEM_FIELDS, '''<status>
+  <wall-clock-time>2014-06-11T02:50:56.749Z</wall-clock-time>
+  <content><state>idle</state></content>
+  <utc-offset>600</utc-offset>
+  <serial-number>ff-ff-08-00-ff-ff</serial-number>
+  <system-version>5.4.39512</system-version>
+  <up-since>2014-06-07T15:33:45.198Z</up-since>
+  <last-sync>2014-06-11T02:50:41.276Z</last-sync>
+</status>'''),
+    ('status/captures', Echo360CaptureDevice.STATUS_CAPTURES_FIELDS, '''<status>
+  <wall-clock-time>2014-07-09T05:10:00.000Z</wall-clock-time>
+  <current>{0}</current>
+  <next>{0}</next>
+</status>'''.format(SAMPLE_CAPTURE)),
+    ('status/monitoring', Echo360CaptureDevice.STATUS_MONITORING_FIELDS, '''<status>
+  <wall-clock-time>2014-07-09T05:10:00.000Z</wall-clock-time>
+  <state>active</state>
+  <start-time>2014-07-09T05:08:22.000Z</start-time>
+  <duration>5400</duration>
+  <confidence-monitoring>false</confidence-monitoring>
+</status>'''),
+    ]
+
+def best_time(fn, count, repeat=3):
+    # Microseconds per call of fn(), the best of 'repeat' runs of 'count' calls.
+    return min(timeit.repeat(fn, number=count, repeat=repeat)) / count * 1e6
+
+def new_response(command, data, xml_data):
+    return Echo360CaptureDeviceResponse(command, 'success', 'Ok', data=data, xml_data=xml_data,
+        utc_offset='600', title=command)
+
+def benchmark_parse(count):
+    print('{0:<20} {1:>12} {2:>12} {3:>12} {4:>8}'.format(
+        'response (us)', 'XML parse', 'find/field', 'schema', 'speedup'))
+    for (command, schema, data) in SAMPLE_RESPONSES:
+        xml_data = ET.fromstring(data)
+        def find_per_field():
+            response = new_response(command, data, xml_data)
+            for (xpath, is_timestamp) in schema.fields:
+                if is_timestamp:
+                    response.add_timestamp(xpath)
+                else:
+                    response.add_value(xpath)
+        def single_walk():
+            schema.extract(new_response(command, data, xml_data))
+        parse = best_time(lambda: ET.fromstring(data), count)
+        find = best_time(find_per_field, count)
+        walk = best_time(single_walk, count)
+        print('{0:<20} {1:12.1f} {2:12.1f} {3:12.1f} {4:7.1f}x'.format(command, parse, find, walk, find / walk))
+
+def legacy_local_timestamp(value, utc_offset):
+    # The conversion used by add_timestamp() before local_timestamp()
+    ts_struct_time = time.strptime(value.split('.',1)[0], "%Y-%m-%dT%H:%M:%S")
+    ts_datetime = datetime.datetime.fromtimestamp(time.mktime(ts_struct_time)) + \
+        datetime.timedelta(minutes = int(utc_offset))
+    return ts_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+
+def benchmark_timestamp(count):
+    value = '2014-06-11T02:50:41.276Z'
+    assert legacy_local_timestamp(value, '600') == capture_device.local_timestamp(value, '600')
+    def miss():
+        capture_device._local_timestamps.clear()
+        capture_device.local_timestamp(value, '600')
+    legacy = best_time(lambda: legacy_local_timestamp(value, '600'), count)
+    fast = best_time(miss, count)
+    hit = best_time(lambda: capture_device.local_timestamp(value, '600'), count)
+    print('{0:<20} {1:>12} {2:>12} {3:>12}'.format('timestamp (us)', 'strptime', 'parse', 'memo'))
+    print('{0:<20} {1:12.2f} {2:12.2f} {3:12.2f}'.format(value, legacy, fast, hit))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def start_simulator(rooms, latency=0, certificate=None):
+    # Run simulator.py with 'rooms' devices in a new process. Returns (process, config filename).
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    config = 'benchmark-{0}.config'.format(os.getpid())
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulator.py'),
+        '--port', str(port), '--rooms', str(rooms), '--config', config, '--latency', str(latency)]
+    if certificate is not None:
+        command += ['--certificate', certificate]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    process.stdout.readline()   # started
+    return (process, config)
+
+def throughput_report(name, requests, elapsed, latencies, cpu, parse):
+    print('{0:<24} {1:>9} {2:>9.0f} {3:>9.2f} {4:>9.2f} {5:>10.0f} {6:>9.1f}'.format(name, requests,
+        requests / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        cpu / requests * 1e6, parse))
+
+def benchmark_throughput(count, rooms, threads, latency=0, certificate=None):
+    from fleet import load_rooms
+    (process, config) = start_simulator(rooms, latency, certificate)
+    if certificate is not None:
+        # the simulator certificate is self-signed
+        import ssl
+        ssl._create_default_https_context = ssl._create_unverified_context
+    try:
+        all_rooms = load_rooms(config)
+        room = all_rooms[0]
+        print('{0:<24} {1:>9} {2:>9} {3:>9} {4:>9} {5:>10} {6:>9}'.format(
+            'status_monitoring', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'CPU us/req', 'parse us'))
+
+        # parse cost of one response, without the network
+        device = Echo360CaptureDevice(room['uri'], room['username'], room['password'])
+        (status, reason, headers, data) = device.request('GET', 'status/monitoring', device.request_headers())
+        parse = best_time(lambda: device._parse_status_monitoring(
+            device.make_response('status/monitoring', status, reason, headers, data, 'status_monitoring')), 2000)
+
+        # one device, 'threads' concurrent callers
+        device = Echo360CaptureDevice(room['uri'], room['username'], room['password'], max_connections=threads)
+        pool = Echo360WorkerPool(threads)
+        def poll(n):
+            latencies = []
+            for i in range(n):
+                start = time.time()
+                device.status_monitoring()
+                latencies.append(time.time() - start)
+            return latencies
+        cpu = sum(os.times()[:2])
+        start = time.time()
+        jobs = [pool.submit(poll, count // threads) for i in range(threads)]
+        latencies = sum([job.result for job in pool.as_completed(jobs)], [])
+        throughput_report('1 device, {0} threads'.format(threads), len(latencies), time.time() - start, latencies,
+            sum(os.times()[:2]) - cpu, parse)
+
+        # 'rooms' devices, polled by a fleet
+        fleet = Echo360Fleet(all_rooms, commands=['status_monitoring'], workers=threads, timeout=10,
+            device_timeout=30)
+        fleet.poll()    # connection tests
+        latencies = []
+        cpu = sum(os.times()[:2])
+        start = time.time()
+        for i in range(max(1, count // rooms)):
+            latencies += [result['latency'] for result in fleet.poll()['rooms'].values()]
+        throughput_report('{0} devices, {1} workers'.format(rooms, threads), len(latencies), time.time() - start,
+            latencies, sum(os.times()[:2]) - cpu, parse)
+    finally:
+        process.terminate()
+        os.remove(config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Tools micro-benchmarks',
+        )
+    parser.add_argument('benchmark', help='benchmark to run', choices=['parse', 'timestamp', 'throughput'])
+    parser.add_argument('--count', help='iterations per measurement', default=10000, type=int)
+    parser.add_argument('--rooms', help='throughput: simulated devices', default=100, type=int)
+    parser.add_argument('--threads', help='throughput: concurrent requests', default=16, type=int)
+    parser.add_argument('--latency', help='throughput: simulated device latency (seconds)', default=0, type=float)
+    parser.add_argument('--certificate', help='throughput: simulate HTTPS with this PEM certificate and key',
+        default=None)
+    args = parser.parse_args()
+
+    if args.benchmark == 'parse':
+        benchmark_parse(args.count)
+    elif args.benchmark == 'timestamp':
+        benchmark_timestamp(args.count)
+    elif args.benchmark == 'throughput':
+        benchmark_throughput(args.count, args.rooms, args.threads, args.latency, args.certificate)
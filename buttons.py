@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Button input for monitor.py: debounced, edge triggered presses of the Adafruit 2x16 LCD plate buttons.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Echo360Buttons calls handler(character) once per press of a button, however long it is held. A press
+# counts once the button has read the same for 'debounce' seconds, so contact bounce doesn't repeat it.
+# While busy() is true (e.g. a command is being sent to the device) presses are ignored.
+#
+# All buttons are read at once: lcd.buttons() is one read of the plate's input register, where calling
+# lcd.buttonPressed() for each button was five. They are read every 'interval' seconds (0.2) while none is
+# pressed, and every 'fast_interval' seconds (0.01) from the first read that finds one pressed (or a change
+# settling) until they are all released again. A tap is always seen if it is held for interval + debounce
+# (0.23 seconds), and usually when shorter; keep 'debounce' (0.03) below the shortest tap to support. An LCD
+# with add_button_listener(fn) (fn(buttons) is called, from any thread, when the buttons change) is not
+# polled at all.
+#
+# Echo360FakeLCD has the same methods as Adafruit_CharLCDPlate, without the hardware:
+#
+#     loop = Echo360EventLoop()
+#     lcd = Echo360FakeLCD()
+#     buttons = Echo360Buttons(loop, lcd, [(lcd.SELECT, 'a'), (lcd.RIGHT, 'c')], handler)
+#     buttons.start()
+#     lcd.press(lcd.SELECT)     # handler('a') is called after the debounce time
+#     lcd.release(lcd.SELECT)
+
+import threading
+import time
+
+class Echo360Buttons(object):
+    # 'buttons' is a list of (button, character). Buttons are bit numbers of lcd.buttons().
+    def __init__(self, loop, lcd, buttons, handler, busy=None, interval=0.2, fast_interval=0.01, debounce=0.03):
+        self.loop = loop
+        self.lcd = lcd
+        self.buttons = buttons
+        self.handler = handler
+        self.busy = busy
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.debounce = debounce
+        self.state = 0          # the debounced buttons
+        self.ignored = 0        # presses ignored while busy()
+        self._raw = 0           # the buttons as last read
+        self._changed = 0       # time _raw changed
+        self._timer = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self.state = self._raw = self.read()
+        if hasattr(self.lcd, 'add_button_listener'):
+            self.lcd.add_button_listener(lambda buttons: self.loop.call_soon_threadsafe(self._event, buttons))
+        else:
+            self._timer = self.loop.call_later(self.interval, self._poll)
+
+    def stop(self):
+        self._running = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def read(self):
+        # All buttons, as a bit mask
+        if hasattr(self.lcd, 'buttons'):
+            return self.lcd.buttons()
+        buttons = 0
+        for (button, char) in self.buttons:
+            if self.lcd.buttonPressed(button):
+                buttons |= 1 << button
+        return buttons
+
+    def _poll(self):
+        if not self._running:
+            return
+        self._sample(self.read())
+        # (fast while a button is pressed or a change is settling, otherwise at the idle interval)
+        fast = self._raw != 0 or self._raw != self.state
+        self._timer = self.loop.call_later(self.fast_interval if fast else self.interval, self._poll)
+
+    def _event(self, buttons):
+        if not self._running:
+            return
+        self._sample(buttons)
+        # check again once the buttons have settled
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(self.debounce, self._settle)
+
+    def _settle(self):
+        self._timer = None
+        if self._running:
+            self._sample(self._raw)
+
+    def _sample(self, buttons, now=None):
+        now = now or time.time()
+        if buttons != self._raw:
+            self._raw = buttons
+            self._changed = now
+        if self._raw == self.state or now - self._changed < self.debounce:
+            return
+        pressed = self._raw & ~self.state
+        self.state = self._raw
+        for (button, char) in self.buttons:
+            if pressed & (1 << button):
+                if self.busy is not None and self.busy():
+                    self.ignored += 1
+                else:
+                    self.handler(char)
+
+
+class Echo360FakeLCD(object):
+    # An Adafruit_CharLCDPlate without the hardware. message() text is kept in 'text' (and every message in
+    # 'messages'). press() and release() change the buttons. With events=True it has add_button_listener().
+    SELECT = 0
+    RIGHT = 1
+    DOWN = 2
+    UP = 3
+    LEFT = 4
+
+    def __init__(self, events=False):
+        self.text = ''
+        self.messages = []
+        self.reads = 0          # button register reads
+        self._buttons = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        if events:
+            self.add_button_listener = self._listeners.append
+
+    def begin(self, cols, lines):
+        pass
+
+    def clear(self):
+        self.text = ''
+
+    def message(self, text):
+        self.text += text
+        self.messages.append(text)
+
+    def buttons(self):
+        with self._lock:
+            self.reads += 1
+            return self._buttons
+
+    def buttonPressed(self, b):
+        return (self.buttons() >> b) & 1
+
+    def press(self, b):
+        self._set(self._buttons | (1 << b))
+
+    def release(self, b):
+        self._set(self._buttons & ~(1 << b))
+
+    def _set(self, buttons):
+        with self._lock:
+            self._buttons = buttons
+        for fn in self._listeners:
+            fn(buttons)
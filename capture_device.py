@@ -28,28 +28,445 @@
 
 import argparse
 import base64
+import calendar
+import collections
 import datetime
+import hashlib
 import httplib
 import json
+import os
+import Queue
+import re
 import socket
+import StringIO
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 import urllib2
 import urlparse
-import xml.etree.ElementTree as ET
+import weakref
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from retry import Echo360RetryPolicy
+
+# Used by request_retry() without a retry policy: no retries, but errors are still classified for the breaker
+NO_RETRY = Echo360RetryPolicy(retries=0)
+
+def _timestamp_fields(value):
+    # (year, month, day, hour, minute, second) of a capture device timestamp (e.g. '2014-06-05T00:27:37.000Z')
+    if len(value) < 19 or value[4] != '-' or value[7] != '-' or value[10] != 'T' or value[13] != ':':
+        # not the usual format: let strptime raise the usual ValueError
+        time.strptime(value.split('.',1)[0], "%Y-%m-%dT%H:%M:%S")
+    return (int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+def timestamp_seconds(value):
+    # Convert a capture device UTC timestamp to seconds since the epoch. None if value is None.
+    if value is None:
+        return None
+    return calendar.timegm(_timestamp_fields(value) + (0, 0, 0))
+
+def xml_fields(element, path='', fields=None):
+    # A dict of the element path (e.g. 'device/serial-number') and text of each element with text, the first of
+    # each path (a structured index of an XML file without a parser, e.g. the device configuration).
+    fields = {} if fields is None else fields
+    path = path + element.tag
+    if element.text is not None and element.text.strip() != '' and path not in fields:
+        fields[path] = element.text.strip()
+    for child in element:
+        xml_fields(child, path + '/', fields)
+    return fields
+
+def html_text(data):
+    # The text of a diagnostics/system-info page (e.g. top): the <pre> sections, without the other markup
+    return re.sub(r'<head>.*?</head>|</?pre>', '\n', data or '', flags=re.S)
+
+_local_timestamps = {}  # (value, utc_offset) -> local time, see local_timestamp()
+
+def local_timestamp(value, utc_offset):
+    # Convert a capture device UTC timestamp (e.g. '2014-06-05T00:27:37.000Z') to local time
+    # ('2014-06-05T10:27:37') using utc_offset (minutes). None if either is None.
+    # The fixed format is sliced directly and the fixed offset added, without going through the host
+    # time zone (which is slow, and wrong around DST changes on hosts not set to UTC). Results are
+    # memoised as values such as 'up-since' and 'last-sync' repeat on every poll.
+    if value is None or utc_offset is None:
+        return None
+    key = (value, utc_offset)
+    local = _local_timestamps.get(key)
+    if local is not None:
+        return local
+    ts = datetime.datetime(*_timestamp_fields(value)) + datetime.timedelta(minutes=int(utc_offset))
+    local = '%04d-%02d-%02dT%02d:%02d:%02d' % (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
+    if len(_local_timestamps) >= 4096:
+        _local_timestamps.clear()
+    _local_timestamps[key] = local
+    return local
+
+class Echo360HTTPConnection(httplib.HTTPConnection):
+    # An HTTPConnection that times connect() (connect_time, seconds), for Echo360Metrics.
+    connect_time = None
+    tls_time = None
+
+    def connect(self):
+        start = time.time()
+        httplib.HTTPConnection.connect(self)
+        self.connect_time = time.time() - start
+
+class Echo360HTTPSConnection(httplib.HTTPSConnection):
+    # An HTTPSConnection that times the TCP connect (connect_time) and the TLS handshake (tls_time) separately.
+    connect_time = None
+    tls_time = None
+
+    def connect(self):
+        if not hasattr(self, '_context'):
+            # Python < 2.7.9: the handshake can't be timed separately
+            start = time.time()
+            httplib.HTTPSConnection.connect(self)
+            self.connect_time = time.time() - start
+            return
+        start = time.time()
+        httplib.HTTPConnection.connect(self)
+        self.connect_time = time.time() - start
+        start = time.time()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+        self.tls_time = time.time() - start
+
+class Echo360ConnectionPool(object):
+    # A pool of persistent HTTP/1.1 (keep-alive) connections to a single capture device.
+    # Each poll otherwise pays for a TCP connect and a full TLS handshake, which on an embedded capture
+    # device costs more than the API call itself.
+    # At most max_connections are open at once. Idle connections are closed after idle_timeout seconds.
+    # Thread safe, so one device object may be shared by several threads.
+    def __init__(self, scheme, host, port, timeout=10, max_connections=4, idle_timeout=30, debuglevel=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.debug = debuglevel
+        self._idle = []     # list of (connection, time last used), most recently used last
+        self._count = 0     # open connections, idle or in use
+        self._lock = threading.Condition()
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            conn = Echo360HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = Echo360HTTPConnection(self.host, self.port, timeout=self.timeout)
+        if self.debug is not None:
+            conn.set_debuglevel(self.debug)
+        return conn
+
+    def acquire(self):
+        # Return (connection, reused). 'reused' is True if the connection has been used before and may
+        # have been closed by the device since. Returns (None, False) if no connection became free
+        # within self.timeout seconds.
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                while len(self._idle) > 0:
+                    (conn, last_used) = self._idle.pop()
+                    if now - last_used < self.idle_timeout:
+                        return (conn, True)
+                    conn.close()
+                    self._count -= 1
+                if self._count < self.max_connections:
+                    self._count += 1
+                    break
+                if now >= deadline:
+                    return (None, False)
+                self._lock.wait(deadline - now)
+        return (self.new_connection(), False)
+
+    def release(self, conn, reusable=True):
+        # Return a connection to the pool. Connections that are not reusable (e.g. after an error or a
+        # 'Connection: close' response) are closed.
+        with self._lock:
+            if reusable:
+                self._idle.append((conn, time.time()))
+            else:
+                conn.close()
+                self._count -= 1
+            self._lock.notify()
+
+    def close(self):
+        # Close all idle connections. Connections in use are closed when they are released.
+        with self._lock:
+            for (conn, last_used) in self._idle:
+                conn.close()
+                self._count -= 1
+            self._idle = []
+
+class Echo360DeviceInfoCache(object):
+    # On disk (JSON) cache of the utc_offset, serial number and system version of each device, so that
+    # short lived CLI runs and restarts of a fleet process can skip the connection test.
+    # Entries older than 'ttl' seconds are ignored.
+    def __init__(self, filename='~/.echo360-cache.json', ttl=24*3600):
+        self.filename = os.path.expanduser(filename)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, server):
+        # Return the cached dict (time, utc_offset, serial_number, system_version) or None.
+        with self._lock:
+            info = self._load().get(server)
+        if info is None or time.time() - info['time'] > self.ttl:
+            return None
+        return info
+
+    def put(self, server, response):
+        # Save the device information from a successful status_system() response.
+        with self._lock:
+            cache = self._load()
+            cache[server] = {
+                'time': time.time(),
+                'utc_offset': response.utc_offset,
+                'serial_number': response.serial_number,
+                'system_version': response.system_version,
+                }
+            # write then rename, so a concurrent reader never sees a partial file
+            temp = '{0}.{1}'.format(self.filename, os.getpid())
+            with open(temp, 'w') as f:
+                json.dump(cache, f, indent=4, sort_keys=True)
+            os.rename(temp, self.filename)
+
+
+class Echo360ResponseCache(object):
+    # In memory cache of status responses (the (status, reason, headers, data) of request()), shared by
+    # every Echo360CaptureDevice given it, so that several consumers of one device in a process share one
+    # HTTP call. Only GET requests of commands with a 'ttls' entry are cached, and only successful ones.
+    # Concurrent requests for the same uncached command wait for the first (single-flight) rather than
+    # each making their own call. Any POST (capture_*, diagnostics_*) invalidates the device's entries.
+    TTLS = {
+        'status/system':            60,
+        'status/captures':          5,
+        'status/next_capture':      5,
+        'status/current_capture':   5,
+        'status/monitoring':        0.5,
+        'status/get_user_sections': 300,
+        'status/get_user_ref':      300,
+        }
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(self.TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # requests that waited for an identical request in flight
+        self._lock = threading.RLock()
+        self._entries = {}      # (server, username, command) -> (expires, result)
+        self._in_flight = {}    # (server, username, command) -> [threading.Event, result]
+        self._generations = {}  # server -> number of invalidations
+
+    def ttl(self, command):
+        return self.ttls.get(command, 0)
+
+    def get(self, key):
+        # The unexpired result for 'key' (server, username, command), or None.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            return None
+
+    def generation(self, server):
+        # Pass to put() to discard a result if the cache is invalidated while its request is in flight.
+        with self._lock:
+            return self._generations.get(server, 0)
+
+    def put(self, key, ttl, result, generation):
+        with self._lock:
+            if result[0] == 200 and self._generations.get(key[0], 0) == generation:
+                self._entries[key] = (time.time() + ttl, result)
+
+    def fetch(self, key, ttl, fn):
+        # Return the cached result for 'key', or the result of fn() (a request()), making at most one call
+        # of fn() at a time for each key.
+        with self._lock:
+            result = self.get(key)
+            if result is not None:
+                return result
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = [threading.Event(), None]
+                self._in_flight[key] = flight
+                generation = self._generations.get(key[0], 0)
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight[0].wait()
+            if flight[1] is not None:
+                return flight[1]
+            return fn()     # the request in flight raised an exception
+        try:
+            flight[1] = fn()
+            self.put(key, ttl, flight[1], generation)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight[0].set()
+        return flight[1]
+
+    def invalidate(self, server):
+        # Forget the cached responses of 'server'. Requests in flight are not cached when they complete.
+        with self._lock:
+            self._generations[server] = self._generations.get(server, 0) + 1
+            for key in self._entries.keys():
+                if key[0] == server:
+                    del self._entries[key]
+
+
+class Echo360FieldSchema(object):
+    # The fields extracted from one kind of response, as a list of (xpath, is_timestamp) where xpath
+    # is a simple 'tag/tag' path from the root element (as used by add_value() and add_timestamp()).
+    # The paths are compiled once into a tree of tags so that extract() finds every field in a single
+    # walk of the parsed XML, rather than one ElementTree find() per field.
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self._names = []    # (attribute name, is_timestamp)
+        self._tree = {}     # tag -> ([field index, ...], {child tag -> ...})
+        for (xpath, is_timestamp) in self.fields:
+            index = len(self._names)
+            self._names.append((xpath.replace('/', '_').replace('-', '_'), is_timestamp))
+            node = self._tree
+            tags = xpath.split('/')
+            for tag in tags[:-1]:
+                node = node.setdefault(tag, ([], {}))[1]
+            node.setdefault(tags[-1], ([], {}))[0].append(index)
+
+    def extract(self, response):
+        # Set the response attribute for each field to the text of the first matching element, or None.
+        # Timestamp fields also get 'name'_local (see Echo360CaptureDeviceResponse.add_timestamp()).
+        values = [None] * len(self._names)
+        found = [False] * len(self._names)
+        self._walk(response.xml(), self._tree, values, found)
+        for (i, (name, is_timestamp)) in enumerate(self._names):
+            response.__dict__[name] = values[i]
+            if is_timestamp:
+                response.add_local_timestamp(name)
+        return response
+
+    def _walk(self, element, tree, values, found):
+        for child in element:
+            node = tree.get(child.tag)
+            if node is None:
+                continue
+            for i in node[0]:
+                if not found[i]:
+                    found[i] = True
+                    values[i] = child.text
+            if len(node[1]) > 0:
+                self._walk(child, node[1], values, found)
+
+
+def _capture_fields(prefix):
+    # The fields of the 'current' or 'next' capture in a capture status response.
+    return [
+        (prefix + '/schedule/type', False),
+        (prefix + '/schedule/start-time', True),
+        (prefix + '/schedule/duration', False),
+        (prefix + '/schedule/parameters/title', False),
+        (prefix + '/schedule/parameters/section', False),
+        (prefix + '/schedule/parameters/capture-profile/name', False),
+        (prefix + '/state', False),
+        (prefix + '/start-time', True),
+        (prefix + '/duration', False),
+        ]
+
 
 class Echo360CaptureDevice(object):
     # This class is a wrapper for the Echo360 Capture device API.
-    def __init__(self, server, username, password, debuglevel=None, timeout=10):
+    # The constructor runs a connection test (a status/system call) to find the device utc_offset.
+    # With 'lazy' the test is deferred until the device is first used; with an Echo360DeviceInfoCache
+    # the test is skipped if the device information is in the cache. Status calls go through the
+    # Echo360ResponseCache 'cache', if given (which may be shared by several devices). Request timings and
+    # response counts are recorded in the Echo360Metrics 'metrics', if given (see metrics.py). Failed requests
+    # are retried as the Echo360RetryPolicy 'retry' says, and the Echo360CircuitBreaker 'breaker' stops calls
+    # to a device that keeps failing (see retry.py).
+
+    # Fields of each status response, see Echo360FieldSchema
+    STATUS_SYSTEM_FIELDS = Echo360FieldSchema([
+        ('wall-clock-time', True),
+        ('content/state', False),
+        ('utc-offset', False),
+        ('serial-number', False),
+        ('system-version', False),
+        ('up-since', True),
+        ('last-sync', True),
+        ])
+    STATUS_CAPTURES_FIELDS = Echo360FieldSchema(
+        [('wall-clock-time', True)] + _capture_fields('current') + _capture_fields('next'))
+    STATUS_NEXT_CAPTURE_FIELDS = Echo360FieldSchema([('wall-clock-time', True)] + _capture_fields('next'))
+    STATUS_CURRENT_CAPTURE_FIELDS = Echo360FieldSchema([('wall-clock-time', True)] + _capture_fields('current'))
+    STATUS_MONITORING_FIELDS = Echo360FieldSchema([
+        ('state', False),
+        ('start-time', True),
+        ('duration', False),
+        ('confidence-monitoring', False),
+        ])
+
+    def __init__(self, server, username, password, debuglevel=None, timeout=10, 
+            max_connections=4, idle_timeout=30, lazy=False, info_cache=None, cache=None,
+            metrics=None, retry=None, breaker=None):
         self.server = server
         self.username = username
         self.password = password
         self.debug = debuglevel
         self.timeout = int(timeout)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.pool = None
+        self.info_cache = info_cache
+        self.cache = cache
+        self.metrics = metrics
+        self.retry = retry
+        self.breaker = breaker
         self.utc_offset = None
-        self.connection_test = self.status_system()
-        if self.connection_test.success():
-            self.utc_offset = self.connection_test.utc_offset
+        self._connection_test = None
+        info = None if info_cache is None else info_cache.get(server)
+        if info is not None:
+            self.utc_offset = info['utc_offset']
+            response = Echo360CaptureDeviceResponse('status/system', 'success', 'Ok (cached)', device=self,
+                utc_offset=self.utc_offset, title='Get System Status')
+            response.utc_offset = info['utc_offset']
+            response.serial_number = info['serial_number']
+            response.system_version = info['system_version']
+            self._connection_test = response
+        elif not lazy:
+            self.test_connection()
+
+    @property
+    def connection_test(self):
+        # The status_system() response of the connection test, run now if it was deferred.
+        if self._connection_test is None:
+            self.test_connection()
+        return self._connection_test
+
+    def test_connection(self):
+        # Run the connection test and set utc_offset. Returns the status_system() response.
+        response = self.status_system()
+        self._connection_test = response
+        if response.success():
+            self.utc_offset = response.utc_offset
+            if self.info_cache is not None:
+                self.info_cache.put(self.server, response)
+        return response
 
     def request(self, method, path, headers=None, body=None, timeout=None):
         # Perform the request and all exception handling.
@@ -59,55 +476,183 @@ class Echo360CaptureDevice(object):
         #     headers  - A dict that may contain HTTP response headers
         #     data     - None or response data.
         # allow override in a subclass to support other http libraries (such as Diesel.io)
+        (status, reason, headers, resp) = self.request_stream(method, path, headers, body, timeout)
+        if not isinstance(resp, httplib.HTTPResponse):
+            return (status, reason, headers, resp)
+        start = time.time()
+        try:
+            data = resp.read()
+        except Exception as e:
+            self.release_stream(resp, reusable=False)
+            return self.request_error(e, timeout)
+        self.release_stream(resp)
+        if self.metrics is not None:
+            self.metrics.observe(self.server, path, 'body', time.time() - start)
+        return (status, reason, headers, data)
+
+    def request_stream(self, method, path, headers=None, body=None, timeout=None):
+        # As request(), but 'data' is the httplib.HTTPResponse with the body still to be read (or None
+        # on error). Call release_stream() once the body has been read (or abandoned).
         url = urlparse.urlparse(urlparse.urljoin(self.server, path))
         if len(url.netloc) == 0:
             return('Invalid URL', 'Missing IP address or domain name.', {}, None)
+        if url.scheme not in ['http', 'https']:
+            return('Invalid URL', 'The URL scheme must be http or https.', {}, None)
+        if self.pool is None:
+            self.pool = Echo360ConnectionPool(url.scheme, url.hostname, url.port, timeout=self.timeout,
+                max_connections=self.max_connections, idle_timeout=self.idle_timeout, debuglevel=self.debug)
+        while True:
+            (conn, reused) = self.pool.acquire()
+            if conn is None:
+                return('timeout', 'No free connection to {0} (limit {1}).'.format(
+                    self.server, self.max_connections), {}, None)
+            try:
+                start = time.time()
+                conn.request(method, url.path, body, headers)
+                resp = conn.getresponse()
+                resp.connection = conn
+                if self.metrics is not None:
+                    self._observe_connection(conn, path, time.time() - start)
+                return (resp.status, resp.reason, dict(resp.getheaders()), resp)
+            except Exception as e:
+                self.pool.release(conn, reusable=False)
+                if reused and not isinstance(e, socket.timeout) and (isinstance(e, httplib.BadStatusLine) or
+                        (method in ['GET', 'HEAD'] and isinstance(e, (httplib.HTTPException, socket.error)))):
+                    # The device closed the idle keep-alive connection, so retry on a new connection. Only
+                    # a GET is always safe to send again: a reset after a POST was sent may mean the device
+                    # acted on it (e.g. a second new capture), so a POST is only retried if the connection
+                    # closed before any response (BadStatusLine).
+                    continue
+                return self.request_error(e, timeout)
+
+    def _observe_connection(self, conn, path, elapsed):
+        # Record the connect, TLS and time to first byte of a request (connect and TLS only once per connection)
+        for phase in ['connect', 'tls']:
+            seconds = getattr(conn, phase + '_time', None)
+            if seconds is not None:
+                self.metrics.observe(self.server, path, phase, seconds)
+                elapsed -= seconds
+                setattr(conn, phase + '_time', None)
+        self.metrics.observe(self.server, path, 'ttfb', elapsed)
+
+    def read_stream(self, resp, result=(None, None, {})):
+        # Read the rest of a request_stream() response and release it. Returns (status, reason, headers, data)
+        # from 'result' (status, reason, headers) and the body, or the error if the read failed.
         try:
-            if url.scheme == 'https':
-                conn = httplib.HTTPSConnection(url.hostname, url.port, timeout=self.timeout)
-            elif url.scheme == 'http':
-                conn = httplib.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
-            else:
-                return('Invalid URL', 'The URL scheme must be http or https.', {}, None)
+            data = resp.read()
         except Exception as e:
-            return('unknown', 'Unknown error: {0}'.format(repr(e)), {}, None)
-        if self.debug is not None:
-            conn.set_debuglevel(self.debug)
-        try:
-            conn.request(method, url.path, body, headers)
-            resp = conn.getresponse()
-            return (resp.status, resp.reason, dict(resp.getheaders()), resp.read())
-        except socket.timeout as e:
-        # This exception is raised when a timeout occurs on a socket which has had
-        # timeouts enabled via a prior call to settimeout().
+            self.release_stream(resp, reusable=False)
+            return self.request_error(e, self.timeout)
+        self.release_stream(resp)
+        return result + (data,)
+
+    def release_stream(self, resp, reusable=True):
+        # Return the connection of a request_stream() response to the pool. It is only reused if the whole
+        # body was read.
+        self.pool.release(resp.connection, reusable=reusable and resp.isclosed() and not resp.will_close)
+
+    def request_error(self, e, timeout=None):
+        # Map a request exception to the (status, reason, headers, data) returned by request().
+        if isinstance(e, socket.timeout):
+            # This exception is raised when a timeout occurs on a socket which has had
+            # timeouts enabled via a prior call to settimeout().
             if timeout is None:
                 return('timeout', 'Network connection timed out.', {}, None)
             else:
                 return('timeout', 'Network connection timed out (after {0} seconds).'.format(timeout), {}, None)
-        except socket.error as e:
+        elif isinstance(e, socket.error):
             # This exception is raised for socket-related errors.
             if e.errno == 8:
                 # socket.gaierror: [Errno 8] nodename nor servname provided, or not known
-                return('socket-8', 'Unknown host: {0}'.format(args.server), {}, None)
+                return('socket-8', 'Unknown host: {0}'.format(self.server), {}, None)
             elif e.errno == 61:
                 # socket.error: [Errno 61] Connection refused
-                return('socket-61', 'Server connection refused: {0}'.format(args.server), {}, None)
+                return('socket-61', 'Server connection refused: {0}'.format(self.server), {}, None)
             elif e.errno is not None:
                 return('socket', 'Network error ({0}): {1}'.format(e.errno, e.strerror), {}, None)
             else:
                 return('unknown', 'Network error: {0}'.format(repr(e)), {}, None)
+        else:
+            return('unknown', 'Unknown error: {0}'.format(repr(e)), {}, None)
+
+    def close(self):
+        # Close the idle keep-alive connections to the device.
+        if self.pool is not None:
+            self.pool.close()
 
     def call_api(self, command, method=None, post_data=None, title=None, dump_xml=None):
+        if self._connection_test is None and command != 'status/system':
+            # deferred (lazy) connection test, needed for utc_offset
+            self.test_connection()
         if method is None:
             if post_data is None:
                 method = 'GET'
             else:
                 method = 'POST'
+        start = time.time()
+        if self.cache is not None and method == 'GET' and self.cache.ttl(command) > 0:
+            (status, reason, headers, data) = self.cache.fetch((self.server, self.username, command),
+                self.cache.ttl(command), lambda: self.request_retry(method, command, post_data))
+        else:
+            (status, reason, headers, data) = self.request_retry(method, command, post_data)
+            if self.cache is not None and method == 'POST':
+                # a command may change any status
+                self.cache.invalidate(self.server)
+        response = self.make_response(command, status, reason, headers, data, title, dump_xml)
+        if self.metrics is not None:
+            self.metrics.count(self.server, command, status)
+            self.metrics.observe(self.server, command, 'total', time.time() - start)
+        return response
+
+    def request_retry(self, method, command, post_data=None, stream=False):
+        # request() through the circuit breaker, retrying as the retry policy says (if there are ones).
+        # With 'stream' it is request_stream(): the body of the result is still to be read.
+        request = self.request_stream if stream else self.request
+        if self.breaker is not None:
+            allowed = self.breaker.allow()
+            if allowed == 'probe':
+                # half-open: is the device back?
+                probe = self.request('GET', self.breaker.probe, self.request_headers(), None, self.timeout)
+                if (self.retry or NO_RETRY).classify(probe[0])[1]:
+                    self.breaker.failure()
+                    allowed = False
+                else:
+                    self.breaker.success()
+            if not allowed:
+                return ('circuit-open', 'Not sent: the device failed {0} times in a row (next try in {1:.0f} '
+                    'seconds).'.format(self.breaker.failures, self.breaker.retry_in()), {}, None)
+        policy = self.retry or NO_RETRY
+        attempt = 0
+        while True:
+            result = request(method, command, self.request_headers(), post_data, self.timeout)
+            if self.breaker is not None:
+                if policy.classify(result[0])[1]:
+                    self.breaker.failure()
+                    if self.breaker.state != 'closed':
+                        return result
+                else:
+                    self.breaker.success()
+            if not policy.should_retry(result[0], method, attempt):
+                return result
+            if isinstance(result[3], httplib.HTTPResponse):
+                # (the error body of a stream, so the connection can be reused for the retry)
+                self.read_stream(result[3])
+            self.wait(policy.delay(attempt))
+            attempt += 1
+
+    def wait(self, seconds):
+        # Sleep between retries. Allow override in a subclass (e.g. for Diesel).
+        time.sleep(seconds)
+
+    def request_headers(self):
         if self.username is not None and self.password is not None: 
-            req_headers = { 'Authorization' : 'Basic ' + base64.b64encode(self.username + ':' + self.password) }
+            return { 'Authorization' : 'Basic ' + base64.b64encode(self.username + ':' + self.password) }
         else:
-            req_headers = {}
-        (status, reason, headers, data) = self.request(method, command, req_headers, post_data, self.timeout)
+            return {}
+
+    def make_response(self, command, status, reason, headers, data, title=None, dump_xml=None):
+        # Build the Echo360CaptureDeviceResponse for the result of request()
+        start = time.time()
         if 'Content-Type' in headers and headers['Content-Type'] == 'text/xml':
             xml_data = ET.fromstring(data)
         # some libraries convert to lower-case
@@ -115,6 +660,8 @@ class Echo360CaptureDevice(object):
             xml_data = ET.fromstring(data)
         else:
             xml_data = None
+        if xml_data is not None and self.metrics is not None:
+            self.metrics.observe(self.server, command, 'parse', time.time() - start)
         if status == 200:
             return Echo360CaptureDeviceResponse(command, 'success', 'Ok', data=data, xml_data=xml_data, 
                 device=self, utc_offset=self.utc_offset, title=title, dump_xml=dump_xml)
@@ -128,14 +675,117 @@ class Echo360CaptureDevice(object):
             return Echo360CaptureDeviceResponse(command, status, reason, data=data, xml_data=xml_data,
                 device=self, utc_offset=self.utc_offset, title=title, dump_xml=dump_xml)
 
-    def fetch_file(self, command):
-        pass
+    def call_api_stream(self, command, parse, title=None):
+        # Like call_api() for responses that are a list of records (one per child of the root element).
+        # The body is parsed with iterparse as it arrives and the 'items' attribute of the response is a
+        # generator of parse(element) for each record. Each record is cleared once parsed, so neither the
+        # whole body nor the whole tree are held in memory. If the stream fails part way through, the
+        # response result code is set to the error after the last record.
+        # The generator holds a pooled connection until it is exhausted or closed: a caller that stops early
+        # should call response.items.close() (dropping the last reference to it also closes it).
+        if self._connection_test is None:
+            self.test_connection()
+        (status, reason, headers, resp) = self.request_retry('GET', command, stream=True)
+        if self.metrics is not None:
+            self.metrics.count(self.server, command, status)
+        content_type = headers.get('Content-Type', headers.get('content-type'))
+        if status != 200 or content_type != 'text/xml':
+            data = resp
+            if isinstance(resp, httplib.HTTPResponse):
+                (status, reason, headers, data) = self.read_stream(resp, (status, reason, headers))
+            return self.make_response(command, status, reason, headers, data, title)
+        response = Echo360CaptureDeviceResponse(command, 'success', 'Ok', device=self, utc_offset=self.utc_offset,
+            title=title)
+        # (a weak reference: in a cycle with the response the generator would never be collected and closed)
+        response.items = self._iter_records(resp, parse, weakref.ref(response), command)
+        next(response.items)    # into its try block, so close() releases the connection before the first record
+        return response
+
+    def _iter_records(self, resp, parse, response_ref, command):
+        # (the body is read and parsed together, so its time is recorded as the 'body' phase)
+        complete = False
+        start = time.time()
+        try:
+            yield None          # primed by call_api_stream()
+            depth = 0
+            root = None
+            for (event, element) in ET.iterparse(resp, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if root is None:
+                        root = element
+                    continue
+                depth -= 1
+                if depth == 1:
+                    yield parse(element)
+                    root.clear()
+            complete = True
+        except Exception as e:
+            response = response_ref()
+            if response is not None:
+                (response._result_code, response._result_message, headers, data) = self.request_error(e,
+                    self.timeout)
+        finally:
+            self.release_stream(resp, reusable=complete)
+            if complete and self.metrics is not None:
+                self.metrics.observe(self.server, command, 'body', time.time() - start)
+
+    def fetch_file(self, command, out=None, buffer=None, title=None, chunk_size=65536):
+        # Download a (binary) file. The body is read in chunks of up to chunk_size bytes, written straight
+        # to the file object 'out' or copied into the bytearray 'buffer' (allocated once at the Content-Length,
+        # so a buffer can be reused for every download of a file). Nothing is joined or kept in between.
+        # The response 'size' is the number of bytes read and 'content_type' the Content-Type. Without 'out',
+        # _buffer is the bytearray holding the file in _buffer[:size].
+        if self._connection_test is None:
+            self.test_connection()
+        (status, reason, headers, resp) = self.request_retry('GET', command, stream=True)
+        if self.metrics is not None:
+            self.metrics.count(self.server, command, status)
+        if status != 200:
+            data = resp
+            if isinstance(resp, httplib.HTTPResponse):
+                (status, reason, headers, data) = self.read_stream(resp, (status, reason, headers))
+            return self.make_response(command, status, reason, headers, data, title)
+        response = Echo360CaptureDeviceResponse(command, 'success', 'Ok', device=self, utc_offset=self.utc_offset,
+            title=title)
+        response.content_type = headers.get('Content-Type', headers.get('content-type'))
+        length = resp.length    # None if not known (chunked or close delimited)
+        if out is None:
+            if buffer is None:
+                buffer = bytearray(length or chunk_size)
+            elif length is not None and len(buffer) < length:
+                buffer.extend('\0' * (length - len(buffer)))
+        start = time.time()
+        size = 0
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+                if out is not None:
+                    out.write(chunk)
+                else:
+                    # (grows the buffer if the length was not known)
+                    buffer[size:size + len(chunk)] = chunk
+                size += len(chunk)
+        except Exception as e:
+            self.release_stream(resp, reusable=False)
+            (response._result_code, response._result_message, headers, data) = self.request_error(e, self.timeout)
+            return response
+        self.release_stream(resp)
+        if self.metrics is not None:
+            self.metrics.observe(self.server, command, 'body', time.time() - start)
+        response.size = size
+        response._buffer = buffer
+        return response
 
     def capture_status_str(self, sleep=None):
         # Fetch the capture status
         if sleep is not None:
             time.sleep(sleep)
-        response = self.status_monitoring()
+        return self._capture_status_str(self.status_monitoring())
+
+    def _capture_status_str(self, response):
         if response.success():
             text = 'State={0}'.format(response.state)
             if response.check_attribute('duration'):
@@ -153,6 +803,53 @@ class Echo360CaptureDevice(object):
             return 'Unknown device error ({0}): {1}'.format(
                 response._result_code, response._result_message)
 
+    def snapshot(self, dump_xml=None):
+        """
+        Device status snapshot: status/system, status/monitoring and status/captures requested at the same time
+        (each on its own pooled connection) and merged into one response with the attributes 'system',
+        'monitoring', 'captures', 'current_capture' and 'next_capture' (the responses of those calls).
+        The current and next capture are taken from status/captures rather than requested again.
+        The result code is 'success' if every call succeeded, otherwise that of the first that failed.
+        """
+        start = time.time()
+        calls = {'system': self.status_system, 'monitoring': self.status_monitoring, 'captures': self.status_captures}
+        responses = {}
+        if self._connection_test is None:
+            # the deferred connection test is a status/system call, and the other calls need its utc_offset
+            responses['system'] = self.test_connection()
+        def call(name):
+            responses[name] = calls[name](dump_xml=dump_xml)
+        names = [name for name in sorted(calls) if name not in responses]
+        threads = [threading.Thread(target=call, args=(name,)) for name in names[1:]]
+        for t in threads:
+            t.start()
+        call(names[0])
+        for t in threads:
+            t.join()
+        return self._snapshot(responses['system'], responses['monitoring'], responses['captures'], start, dump_xml)
+
+    def _snapshot(self, system, monitoring, captures, start, dump_xml=None):
+        # Merge the responses of a snapshot()
+        response = Echo360CaptureDeviceResponse('snapshot', 'success', 'Ok', device=self, utc_offset=self.utc_offset,
+            title='Device Status Snapshot')
+        for part in [system, monitoring, captures]:
+            if not part.success():
+                (response._result_code, response._result_message) = (part._result_code, part._result_message)
+                break
+        response.system = system
+        response.monitoring = monitoring
+        response.captures = captures
+        response.current_capture = self._parse_status_current_capture(Echo360CaptureDeviceResponse(
+            'status/current_capture', captures._result_code, captures._result_message, data=captures._data,
+            xml_data=captures.xml(), device=self, utc_offset=self.utc_offset, title='Get Current Capture Status',
+            dump_xml=dump_xml))
+        response.next_capture = self._parse_status_next_capture(Echo360CaptureDeviceResponse(
+            'status/next_capture', captures._result_code, captures._result_message, data=captures._data,
+            xml_data=captures.xml(), device=self, utc_offset=self.utc_offset, title='Get Next Capture Status',
+            dump_xml=dump_xml))
+        response.elapsed = round(time.time() - start, 3)
+        return response
+
     # (3) Device API Calls
     # The method names match the API names.
 
@@ -167,14 +864,11 @@ class Echo360CaptureDevice(object):
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/status/system"
         """
         response = self.call_api('status/system', title='Get System Status', dump_xml=dump_xml)
+        return self._parse_status_system(response)
+
+    def _parse_status_system(self, response):
         if response.success():
-            response.add_timestamp('wall-clock-time')
-            response.add_value('content/state')
-            response.add_value('utc-offset')
-            response.add_value('serial-number')
-            response.add_value('system-version')
-            response.add_timestamp('up-since')
-            response.add_timestamp('last-sync')
+            self.STATUS_SYSTEM_FIELDS.extract(response)
         return response
 
     def status_captures(self, dump_xml=None):
@@ -184,24 +878,14 @@ class Echo360CaptureDevice(object):
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/status/captures"
         """
         response = self.call_api('status/captures', title='Get Capture Status', dump_xml=dump_xml)
+        return self._parse_status_captures(response)
+
+    def _parse_status_captures(self, response):
         if response.success():
-            response.add_timestamp('wall-clock-time')
-            self._current_capture(response)
+            self.STATUS_CAPTURES_FIELDS.extract(response)
             response.state = response.current_state
-            self._next_capture(response)
         return response
 
-    def _next_capture(self, response):
-        response.add_value('next/schedule/type')
-        response.add_timestamp('next/schedule/start-time')
-        response.add_value('next/schedule/duration')
-        response.add_value('next/schedule/parameters/title')
-        response.add_value('next/schedule/parameters/section')
-        response.add_value('next/schedule/parameters/capture-profile/name')
-        response.add_value('next/state')
-        response.add_timestamp('next/start-time')
-        response.add_value('next/duration')
-
     def status_next_capture(self, dump_xml=None):
         """
         (3.1.3) Get Next Capture Status returns information on the status of only the next capture.
@@ -209,22 +893,13 @@ class Echo360CaptureDevice(object):
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/status/next_capture"
         """
         response = self.call_api('status/next_capture', title='Get Next Capture Status', dump_xml=dump_xml)
+        return self._parse_status_next_capture(response)
+
+    def _parse_status_next_capture(self, response):
         if response.success(): 
-            response.add_timestamp('wall-clock-time')
-            self._next_capture(response)
+            self.STATUS_NEXT_CAPTURE_FIELDS.extract(response)
         return response
 
-    def _current_capture(self, response):
-        response.add_value('current/schedule/type')
-        response.add_timestamp('current/schedule/start-time')
-        response.add_value('current/schedule/duration')
-        response.add_value('current/schedule/parameters/title')
-        response.add_value('current/schedule/parameters/section')
-        response.add_value('current/schedule/parameters/capture-profile/name')
-        response.add_value('current/state')
-        response.add_timestamp('current/start-time')
-        response.add_value('current/duration')
-
     def status_current_capture(self, dump_xml=None):
         """
         (3.1.4) Get Current Capture Status returns information on the status of only the current capture.
@@ -232,9 +907,11 @@ class Echo360CaptureDevice(object):
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/status/current_capture"
         """
         response = self.call_api('status/current_capture', title='Get Current Capture Status', dump_xml=dump_xml)
+        return self._parse_status_current_capture(response)
+
+    def _parse_status_current_capture(self, response):
         if response.success(): 
-            response.add_timestamp('wall-clock-time')
-            self._current_capture(response)
+            self.STATUS_CURRENT_CAPTURE_FIELDS.extract(response)
             response.state = response.current_state
         return response
 
@@ -248,14 +925,17 @@ class Echo360CaptureDevice(object):
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/status/monitoring"
         """
         response = self.call_api('status/monitoring', title='Get Capture Status with Monitoring Information', dump_xml=dump_xml)
+        return self._parse_status_monitoring(response)
+
+    def _parse_status_monitoring(self, response):
         if response.success(): 
-            response.add_value('state')
-            response.add_timestamp('start-time')
-            response.add_value('duration')
-            response.add_value('confidence-monitoring')
+            self.STATUS_MONITORING_FIELDS.extract(response)
+            # the monitoring image filenames, for monitoring_snapshot()
+            response.thumbnails = [element.text for element in response.xml().iter()
+                if element.text is not None and element.text.endswith('.jpg')]
         return response
 
-    def monitoring_snapshot(self, url, dump_xml=None):
+    def monitoring_snapshot(self, url, dump_xml=None, out=None, buffer=None):
         """
         (3.1.6) Show Current Video or Display View returns a snapshot image of the video or display input  
         for the current capture. This is an image of what the Video input or Display input for the current 
@@ -272,8 +952,14 @@ class Echo360CaptureDevice(object):
             Display/Video (Podcast/Vodcast/EchoPlayer). Optimized for quality/full motion video&
             description=test-description' 
             --url https://192.168.61.10:8443/monitoring/vga_display_graphics-channel1-stream0.jpg
+
+        'url' is a filename from status_monitoring().thumbnails (or 'monitoring/' + filename). The image is
+        streamed to the file object 'out', or into the bytearray 'buffer' (reused if large enough); see
+        fetch_file().
         """
-        raise "unimplemented"
+        if not url.startswith('monitoring/'):
+            url = 'monitoring/' + url
+        return self.fetch_file(url, out, buffer, title='Show Current Video or Display View')
 
     def status_get_user_sections(self, dump_xml=None):
         """
@@ -293,6 +979,9 @@ class Echo360CaptureDevice(object):
         curl --user admin:password --insecure --url https://192.168.61.10:8443/status/get_user_ref
         """
         response = self.call_api('status/get_user_ref', title='Get Authenticated User Reference ID', dump_xml=dump_xml)
+        return self._parse_status_get_user_ref(response)
+
+    def _parse_status_get_user_ref(self, response):
         if response.success():
             response.add_value('', name='authenticated-user-ref')
         return response        
@@ -374,7 +1063,22 @@ class Echo360CaptureDevice(object):
 
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/diagnostics/system-info/tasks"
         """
-        return self.call_api('diagnostics/system-info/tasks', title='Get Device Tasks')
+        # 'tasks' is a list of dicts, one per scheduled capture (see _task()).
+        response = self.call_api('diagnostics/system-info/tasks', title='Get Device Tasks')
+        return self._parse_system_info_tasks(response)
+
+    def _parse_system_info_tasks(self, response):
+        if response.success():
+            response.tasks = [self._task(element) for element in response.xml() if element.tag == 'task']
+        return response
+
+    def _task(self, element):
+        # A dict of a 'task' element, as _saved_capture() (e.g. id, type, start_time, duration, title, section,
+        # capture_profile), with the 'start' and 'end' of the capture in seconds since the epoch.
+        task = self._saved_capture(element)
+        task['start'] = timestamp_seconds(task.get('start_time'))
+        task['end'] = task['start'] + int(task.get('duration') or 0) if task['start'] is not None else None
+        return task
 
     def diagnostics_system_info_device(self):
         """
@@ -411,13 +1115,51 @@ class Echo360CaptureDevice(object):
 
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/diagnostics/recovery/saved-content"
         """
-        # TODO: Can be many captures. Will cuurently fail if more than one.
-        response = self.call_api('diagnostics/recovery/saved-content', title='Get Saved Content on the Device')
+        # 'captures' is a list of dicts, one per saved capture (see _saved_capture()). The capture_title,
+        # capture_start_time, capture_duration and capture_section attributes are from the first capture.
+        response = self.diagnostics_recovery_saved_content_iter()
+        if response.check_attribute('items'):
+            response.captures = list(response.items)
+            del response.items
+            self._first_saved_capture(response)
+        return response
+
+    def diagnostics_recovery_saved_content_iter(self):
+        """
+        (3.2.11) Get Saved Content on the Device, streamed.
+        As diagnostics_recovery_saved_content(), but the response 'items' is a generator of capture dicts
+        parsed as the response arrives, for devices with a large amount of saved content.
+        Call response.items.close() when stopping before the last capture, to release the connection.
+        """
+        return self.call_api_stream('diagnostics/recovery/saved-content', self._saved_capture,
+            title='Get Saved Content on the Device')
+
+    def _saved_capture(self, element):
+        # A dict of the attributes and child elements of a saved content 'capture' element, with '-'
+        # replaced by '_' in the names (e.g. id, title, start_time, duration, section). Timestamps also
+        # have the local time in 'name'_local.
+        capture = {}
+        for name in element.attrib:
+            capture[name.replace('-', '_')] = element.attrib[name]
+        for child in element:
+            name = child.tag.replace('-', '_')
+            capture[name] = child.text
+            if name.endswith('time'):
+                capture[name + '_local'] = local_timestamp(child.text, self.utc_offset)
+        return capture
+
+    def _first_saved_capture(self, response):
+        first = response.captures[0] if len(response.captures) > 0 else {}
+        for name in ['title', 'start_time', 'duration', 'section']:
+            response.__dict__['capture_' + name] = first.get(name)
+        if first.get('start_time') is not None:
+            response.capture_start_time_local = first.get('start_time_local')
+
+    def _parse_saved_content(self, response):
+        # Parse a saved content response that has already been read (e.g. by AsyncEcho360CaptureDevice)
         if response.success():
-            response.add_value('capture/title')
-            response.add_timestamp('capture/start-time')
-            response.add_value('capture/duration')
-            response.add_value('capture/section')
+            response.captures = [self._saved_capture(element) for element in response.xml()]
+            self._first_saved_capture(response)
         return response        
 
     def diagnostics_capture_id_upload(self, id):
@@ -428,8 +1170,12 @@ class Echo360CaptureDevice(object):
         capture ID.
 
         curl --silent --user $adminlogincreds --insecure -d --url $apiurl"/diagnostics/recovery/4d951a96-9702-4321-abe6-a0f232ae1e36/upload"
+        # <ok text="Upload of capture 4d951a96-9702-4321-abe6-a0f232ae1e36 queued" />
         """
-        raise "unimplemented"
+        response = self.call_api('diagnostics/recovery/{0}/upload'.format(id), method='POST',
+            title='Re-Upload Content from the Device to the ESS')
+        response.check_for_error()
+        return response
 
     def log_list_last_count(self, count, dump_xml=None):
         """
@@ -438,22 +1184,164 @@ class Echo360CaptureDevice(object):
 
         curl --silent --user $adminlogincreds --insecure --url $apiurl"/log-list-last-count/3"
         """
-        response = self.call_api('log-list-last-count/' + str(count), title='Retrieve the Last X Number of Log Messages', dump_xml=dump_xml)
+        if dump_xml:
+            return self.call_api('log-list-last-count/' + str(count), title='Retrieve the Last X Number of Log Messages', dump_xml=dump_xml)
+        response = self.log_iter_last_count(count)
+        if response.check_attribute('items'):
+            response.entries = list(response.items) # List of Dict's
+            del response.items
+        return response
+
+    def log_iter_last_count(self, count):
+        """
+        (3.2.13) Retrieve the Last X Number of Log Messages, streamed.
+        As log_list_last_count(), but the response 'items' is a generator of log entry dicts parsed as the
+        response arrives, so thousands of entries don't need the whole payload and tree in memory.
+        Call response.items.close() when stopping before the last entry, to release the connection.
+        """
+        return self.call_api_stream('log-list-last-count/' + str(count), self._log_entry,
+            title='Retrieve the Last X Number of Log Messages')
+
+    def _log_entry(self, element):
+        # A log entry is a set of 'name: "value"' lines
+        entry = {}
+        for line in (element.text or '').split('\n'):
+            if len(line) > 0:
+                part = line.split(':', 1)
+                if len(part) == 2:
+                    entry[part[0]] = part[1].replace('"', '').strip()
+        return entry
+
+    def _parse_log_list(self, response, dump_xml=None):
+        # Parse a log response that has already been read (e.g. by AsyncEcho360CaptureDevice)
         if dump_xml:
             return response
         if response.xml() is not None:
-            xml = response.xml()
-            entries = []
-            for child in xml:
-                entry = {}
-                for line in child.text.split('\n'):
-                    if len(line) > 0:
-                        #print line
-                        part = line.split(':', 1)
-                        entry[part[0]] = part[1].replace('"', '').strip()
-                entries.append(entry)
-            response.entries = entries # List of Dict's
-            return response 
+            response.entries = [self._log_entry(element) for element in response.xml()] # List of Dict's
+        return response 
+
+    # The files of a diagnostics_bundle(): (name, command, parse method for the index or None)
+    BUNDLE_FILES = [
+        ('status-system', 'status/system', '_parse_status_system'),
+        ('status-captures', 'status/captures', '_parse_status_captures'),
+        ('status-monitoring', 'status/monitoring', '_parse_status_monitoring'),
+        ('ifconfig', 'diagnostics/system-info/ifconfig', None),
+        ('device', 'diagnostics/system-info/device', None),
+        ('tasks', 'diagnostics/system-info/tasks', '_parse_system_info_tasks'),
+        ('top', 'diagnostics/system-info/top', None),
+        ('dmesg', 'diagnostics/system-info/dmesg', None),
+        ('saved-content', 'diagnostics/recovery/saved-content', '_parse_saved_content'),
+        ('log', 'log-list-last-count/{0}', '_parse_log_list'),
+        ]
+
+    def diagnostics_bundle(self, filename, log_count=500, spool_size=1024*1024):
+        """
+        Diagnostics bundle: the status calls, every diagnostics/system-info file, the saved content and the last
+        'log_count' log entries, requested at the same time (up to max_connections at once) and written to the
+        tar.gz archive 'filename' as they arrive (larger bodies are spooled to disk, not kept in memory).
+        The archive also has a manifest.json (command, result, size, SHA-256 and time of each file) and an
+        index.json of the fields parsed from the XML (as_dict() of the parsed status, tasks, saved content and
+        log responses; for other XML files, each element path and its text). The response has 'filename',
+        'manifest' and 'index'. The result code is 'success' if every file was fetched, otherwise that of the
+        first that failed; files that failed are in the manifest but not the archive.
+        """
+        start = time.time()
+        if self._connection_test is None:
+            self.test_connection()
+        if not self._connection_test.success():
+            return self._connection_test
+        response = Echo360CaptureDeviceResponse('diagnostics-bundle', 'success', 'Ok', device=self,
+            utc_offset=self.utc_offset, title='Diagnostics Bundle')
+        prefix = re.sub(r'(\.tar\.gz|\.tgz)$', '', os.path.basename(filename))
+        pending = Queue.Queue()
+        for item in self.BUNDLE_FILES:
+            pending.put(item)
+        done = Queue.Queue()
+        def fetch():
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    done.put(self._bundle_file(item, log_count, spool_size))
+                except Exception as e:
+                    done.put(({'name': item[0], 'command': item[1].format(log_count), 'result': 'unknown',
+                        'message': 'Unknown error: {0}'.format(repr(e))}, None, None))
+        threads = [threading.Thread(target=fetch) for i in range(min(self.max_connections, len(self.BUNDLE_FILES)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        files = []
+        index = {}
+        with tarfile.open(filename, 'w:gz') as archive:
+            for i in range(len(self.BUNDLE_FILES)):
+                (entry, spool, fields) = done.get(True, 365 * 24 * 3600)
+                files.append(entry)
+                if fields is not None:
+                    index[entry['name'].rsplit('.', 1)[0]] = fields
+                if spool is None:
+                    if response.success():
+                        (response._result_code, response._result_message) = (entry['result'], entry['message'])
+                    continue
+                spool.seek(0)
+                self._bundle_add(archive, prefix + '/' + entry['name'], spool, entry['size'])
+                spool.close()
+            files.sort(key=lambda entry: entry['name'])
+            response.filename = filename
+            response.manifest = {'server': self.server, 'created': datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%SZ'), 'elapsed': round(time.time() - start, 3), 'files': files}
+            response.index = index
+            for (name, value) in [('manifest.json', response.manifest), ('index.json', index)]:
+                data = json.dumps(value, indent=2, sort_keys=True, default=str)
+                self._bundle_add(archive, prefix + '/' + name, StringIO.StringIO(data), len(data))
+        response.elapsed = round(time.time() - start, 3)
+        return response
+
+    def _bundle_add(self, archive, name, fileobj, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        archive.addfile(info, fileobj)
+
+    def _bundle_file(self, item, log_count, spool_size):
+        # Fetch one BUNDLE_FILES item. Returns (manifest entry, spooled body or None, index fields or None).
+        start = time.time()
+        (name, command, parse) = item
+        command = command.format(log_count)
+        spool = tempfile.SpooledTemporaryFile(spool_size)
+        fetched = self.fetch_file(command, out=spool)
+        entry = {'command': command, 'result': fetched._result_code, 'message': fetched._result_message,
+            'elapsed': round(time.time() - start, 3)}
+        if not fetched.success():
+            entry['name'] = name
+            spool.close()
+            return (entry, None, None)
+        xml = (fetched.content_type or '').split(';')[0] == 'text/xml'
+        entry.update({'name': name + ('.xml' if xml else '.html'), 'content_type': fetched.content_type,
+            'size': fetched.size})
+        spool.seek(0)
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: spool.read(65536), ''):
+            digest.update(chunk)
+        entry['sha256'] = digest.hexdigest()
+        fields = None
+        if xml:
+            spool.seek(0)
+            try:
+                root = ET.parse(spool).getroot()
+            except Exception as e:
+                entry['parse_error'] = repr(e)
+                return (entry, spool, None)
+            if parse is not None:
+                parsed = getattr(self, parse)(Echo360CaptureDeviceResponse(command, 'success', 'Ok', xml_data=root,
+                    device=self, utc_offset=self.utc_offset))
+                fields = parsed.as_dict()
+                for key in ['command', 'result_code', 'result_message']:
+                    del fields[key]
+            else:
+                fields = xml_fields(root)
+        return (entry, spool, fields)
 
     # (3.3) CaptureControlAPICalls
     # The API calls described below are used to create and manipulate captures performed by the capture device 
@@ -575,6 +1463,7 @@ class Echo360CaptureDeviceResponse(object):
         self._result_message = result_message
         self._data = data
         self._xml = xml_data    # might be None
+        self._title = None
         self.title(title)
         self._device = device
         self._utc_offset = utc_offset
@@ -610,18 +1499,15 @@ class Echo360CaptureDeviceResponse(object):
         # Method will fail if no XML data.
         # Capture device timestamps are always UTC (e.g. '2014-06-05T00:27:37.000Z').
         # The attribute is set to the local time, or None if the timestamp is None or if self._utc_offset is None.
-        name = self.add_value(xpath, name)
+        return self.add_local_timestamp(self.add_value(xpath, name))
+
+    def add_local_timestamp(self, name):
+        # Sets 'name'_local from the UTC timestamp attribute 'name', as for add_timestamp().
         node_value = self.__dict__[name]
         if node_value is None:
             return name
         local_name = name + '_local'
-        if self._utc_offset is None:
-            self.__dict__[local_name] = None
-        else:
-            ts_struct_time = time.strptime(node_value.split('.',1)[0], "%Y-%m-%dT%H:%M:%S")
-            ts_datetime = datetime.datetime.fromtimestamp(time.mktime(ts_struct_time)) + \
-                datetime.timedelta(minutes = int(self._utc_offset))
-            self.__dict__[local_name] = ts_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+        self.__dict__[local_name] = local_timestamp(node_value, self._utc_offset)
         return local_name
 
     def check_attribute(self, attr):
@@ -645,6 +1531,21 @@ class Echo360CaptureDeviceResponse(object):
     def xml(self):
         return self._xml
 
+    def as_dict(self):
+        # The command, result code and message, and all data attributes, e.g. for JSON output.
+        result = {
+            'command': self._command,
+            'result_code': self._result_code,
+            'result_message': self._result_message,
+            }
+        for key in self.__dict__:
+            if not key.startswith('_'):
+                result[key] = self.__dict__[key]
+                if isinstance(result[key], Echo360CaptureDeviceResponse):
+                    # (e.g. the parts of a snapshot())
+                    result[key] = result[key].as_dict()
+        return result
+
     def __str__(self):
         # Useful for testing and in CLI situations.
         if self.success():
@@ -652,7 +1553,7 @@ class Echo360CaptureDeviceResponse(object):
             data = []
             for key in sorted(self.__dict__):
                 if not key.startswith('_'):
-                    data.append('{0}: {1}'.format(key, self.__dict__[key]))
+                    data.append('{0}: {1}'.format(key, str(self.__dict__[key]).replace('\n', '\n    ')))
             if len(data) > 0:
                 string += '\nData: ' + '\n  '.join(data)
             if self._dump_xml:
@@ -667,11 +1568,400 @@ class Echo360CaptureDeviceResponse(object):
         return self._result_code == 'success'
 
 
+class Echo360LogFollower(object):
+    # Incremental 'tail -f' of a device log. poll() returns only the entries logged since the last poll.
+    # The API can only return the last N entries, so the follower keeps the fingerprints of the newest
+    # 'index_size' entries it has seen and asks for a few more entries than last time: if the answer does not
+    # overlap what it has already seen, it asks again for twice as many (up to max_count). The number asked
+    # for then follows the rate the device logs at, so an idle device costs a small request each poll.
+    def __init__(self, device, count=10, min_count=8, max_count=5000, index_size=64):
+        self.device = device
+        self.count = count          # entries to ask for on the next poll (the first poll returns this many)
+        self.min_count = min_count
+        self.max_count = max_count
+        self._seen = collections.deque(maxlen=index_size)   # fingerprints of the newest entries, oldest first
+        self._first = True
+
+    def _fingerprint(self, entry):
+        return hash(tuple(sorted(entry.items())))
+
+    def _new_entries(self, fingerprints):
+        # The index in 'fingerprints' (oldest first) of the first entry after the newest one already seen,
+        # or None if they do not overlap. The entries before it must match the seen entries too, so identical
+        # entries logged at the same time are not mistaken for each other.
+        seen = list(self._seen)
+        for i in range(len(fingerprints) - 1, -1, -1):
+            if fingerprints[i] != seen[-1]:
+                continue
+            n = min(i + 1, len(seen))
+            if fingerprints[i + 1 - n:i + 1] == seen[-n:]:
+                return i + 1
+        return None
+
+    def poll(self):
+        # Returns the log_list_last_count() response with 'entries' (oldest first) replaced by the new entries.
+        # 'fetched' is the number of entries transferred, and 'gap' is True if entries may have been missed
+        # (more than max_count since the last poll, or the device log was cleared or rolled over).
+        count = self.count
+        fetched = 0
+        while True:
+            response = self.device.log_list_last_count(count)
+            if not response.success():
+                return response
+            entries = response.entries
+            if len(entries) > 1 and entries[0].get('time', '') > entries[-1].get('time', ''):
+                entries.reverse()
+            fetched += len(entries)
+            fingerprints = [self._fingerprint(entry) for entry in entries]
+            start = 0 if self._first or len(self._seen) == 0 else self._new_entries(fingerprints)
+            if start is None and len(entries) >= count and count < self.max_count:
+                # a gap: look further back
+                count = min(count * 2, self.max_count)
+                continue
+            break
+        response.gap = start is None
+        response.entries = entries[start or 0:]
+        response.fetched = fetched
+        self._seen.extend(fingerprints[start or 0:])
+        # ask for enough to cover as many new entries again, plus the overlap
+        new = 0 if self._first else len(response.entries)
+        self.count = max(self.min_count, min(self.max_count, 2 * new + 2))
+        self._first = False
+        return response
+
+
+class Echo360StatusStream(object):
+    # Change-only JSON Lines output of status_monitoring() responses. write() only writes a record when the
+    # state, duration, confidence monitoring or capture of a room changes (or its error), or as a 'heartbeat' when
+    # nothing has been written for the room for 'heartbeat' seconds. Records are written to 'out' as they come
+    # but it is only flushed by flush(), if a record was written since the last flush(), so a poll of many rooms
+    # is one write to the pipe and an unchanged poll is none.
+    def __init__(self, out, heartbeat=60, rooms=True):
+        self.out = out
+        self.heartbeat = heartbeat
+        self.rooms = rooms          # add the room name to the records
+        self._last = {}             # room -> (key, time of the last record)
+        self._pending = False
+
+    def _key(self, response):
+        if not response.success():
+            return ('error', response._result_code)
+        # (a new capture may have the same state and duration as the last one, so its start time is compared too)
+        return (response.state, getattr(response, 'duration', None), getattr(response, 'confidence_monitoring', None),
+            getattr(response, 'start_time', None))
+
+    def write(self, room, response, now=None):
+        # Write the record for a response, if needed. Returns 'change', 'heartbeat' or None.
+        now = time.time() if now is None else now
+        key = self._key(response)
+        (last_key, last_time) = self._last.get(room, (None, None))
+        if key != last_key:
+            event = 'change'
+        elif now - last_time >= self.heartbeat:
+            event = 'heartbeat'
+        else:
+            return None
+        record = {'time': datetime.datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%SZ'), 'event': event}
+        if self.rooms:
+            record['room'] = room
+        if response.success():
+            record['state'] = response.state
+            for name in ['duration', 'start_time_local', 'confidence_monitoring']:
+                if response.check_attribute(name):
+                    record[name] = getattr(response, name)
+        else:
+            record['error'] = response._result_code
+            record['message'] = response._result_message
+        self.out.write(json.dumps(record, sort_keys=True) + '\n')
+        self._last[room] = (key, now)
+        self._pending = True
+        return event
+
+    def flush(self, force=False):
+        # Flush the records (changes and heartbeats) written since the last flush() (or anything, with 'force')
+        if self._pending or force:
+            self.out.flush()
+            self._pending = False
+
+
+def cli_connection_error(device, server):
+    # The CLI message and exit code for a failed connection test, or None if it succeeded.
+    if device.connection_test.success():
+        return None
+    if device.connection_test._result_code == 401:
+        return ('Connection Test Error (401): Incorrect capture device username or password.', 1)
+    elif device.connection_test._result_code == 404:
+        return ('Connection Test Error (404): Capture Device API error: command not found.', 2)
+    else:
+        return ('Connection Test Error ({0}): {1} to {2}'.format(
+            device.connection_test._result_code, device.connection_test._result_message, server), 3)
+
+def cli_command(device, args, output):
+    # Run the CLI command against one device, passing each line of output to output().
+    # Returns the response of the command (None for multi-step commands).
+    response = None
+    if args.command == 'system-status':
+        response = device.status_system(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'status':
+        response = device.status_monitoring()
+        output(device._capture_status_str(response))
+        if args.count > 1:
+            for i in range(1, args.count):
+                output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'monitoring-snapshot':
+        # --url is an image name, or every image in status_monitoring().thumbnails
+        names = [args.url]
+        if args.url is None:
+            response = device.status_monitoring()
+            if not response.success():
+                output(str(response))
+            names = response.thumbnails if response.success() else []
+        room = re.sub(r'[^A-Za-z0-9_.-]+', '_', getattr(args, 'room', None) or urlparse.urlparse(device.server).netloc)
+        for url in names:
+            filename = os.path.join(args.snapshot_dir, '{0}-{1}'.format(room, url.split('/')[-1]))
+            with open(filename, 'wb') as f:
+                response = device.monitoring_snapshot(url, out=f)
+            if response.success():
+                output('{0}: {1} bytes ({2})'.format(filename, response.size, response.content_type))
+            else:
+                os.remove(filename)
+                output(str(response))
+    elif args.command == 'new-capture':
+        response = device.capture_new_capture(args.duration, args.profile , args.description)
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'confidence-monitor':
+        response = device.capture_confidence_monitor(args.duration, args.profile , args.description)
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'pause':
+        response = device.capture_pause()
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'resume':
+        response = device.capture_record()
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'extend':
+        response = device.capture_extend(args.duration)
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'stop':
+        response = device.capture_stop()
+        output(str(response))
+        output(device.capture_status_str(sleep=args.sleep))
+    elif args.command == 'status-get-user-sections':
+        # TODO: output(str(device.status_get_user_sections()))
+        output('Not implemented yet.')
+    elif args.command == 'status-get-user-ref':
+        response = device.status_get_user_ref(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'diagnostics-clear-cache':
+        response = device.diagnostics_clear_cache()
+        output(str(response))
+    elif args.command == 'ping':
+        if args.url is None:
+            output("No ping URL specified. Use '--url'")
+        else:
+            response = device.diagnostics_ping(args.url)
+            if response.success():
+                output('{0}\n{1}'.format(str(response), response._data))
+            else:
+                output(str(response))
+    elif args.command == 'traceroute':
+        if args.url is None:
+            output("No traceroute URL specified. Use '--url'")
+        else:
+            response = device.diagnostics_traceroute(args.url)
+            if response.success():
+                t = response._data.replace('<br/>', '\n')
+                output('{0}\n{1}'.format(str(response), t))
+            else:
+                output(str(response))
+    elif args.command == 'restart-all':
+        response = device.diagnostics_restart_all()
+        output(str(response))
+    elif args.command == 'reboot':
+        response = device.diagnostics_reboot()
+        output(str(response))
+    elif args.command == 'saved-content':
+        response = device.diagnostics_recovery_saved_content()
+        if response.success():
+            output(json.dumps(response.captures, indent=4, sort_keys=True))
+        else:
+            output(str(response))
+    elif args.command == 'upload':
+        if args.id is None:
+            output("No capture ID specified. Use '--id' (see '-c saved-content')")
+        else:
+            response = device.diagnostics_capture_id_upload(args.id)
+            output(str(response))
+    elif args.command == 'log':
+        response = device.log_list_last_count(args.count, dump_xml=args.xml)
+        output(json.dumps(response.entries, indent=4, sort_keys=True))
+    elif args.command == 'system-info':
+        for call in [device.diagnostics_system_info_ifconfig, device.diagnostics_system_info_device,
+                device.diagnostics_system_info_top, device.diagnostics_system_info_dmesg]:
+            response = call()
+            if response.success():
+                output('{0}\n{1}'.format(str(response), html_text(response._data)))
+            else:
+                output(str(response))
+    elif args.command == 'diagnostics-bundle':
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', getattr(args, 'room', None) or urlparse.urlparse(device.server).netloc)
+        filename = os.path.join(args.bundle_dir, '{0}-{1}.tar.gz'.format(name,
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')))
+        response = device.diagnostics_bundle(filename, log_count=args.count if args.count > 1 else 500)
+        if response.check_attribute('manifest'):
+            files = response.manifest['files']
+            output('Diagnostics bundle {0}: {1} files, {2} bytes in {3:.1f} seconds'.format(filename,
+                len([entry for entry in files if 'size' in entry]), sum(entry.get('size', 0) for entry in files),
+                response.elapsed))
+            for entry in files:
+                if entry['result'] != 'success':
+                    output('  {0}: {1} {2}'.format(entry['command'], entry['result'], entry['message']))
+        else:
+            output(str(response))
+    elif args.command == 'status-captures':
+        response = device.status_captures(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'status-current-capture':
+        response = device.status_current_capture(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'status-next-capture':
+        response = device.status_next_capture(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'test-system':
+        output('\nDevice status_system')
+        response = device.status_system(dump_xml=args.xml)
+        output(str(response))
+    elif args.command == 'test-status':
+        response = device.snapshot(dump_xml=args.xml)
+        for name in ['system', 'monitoring', 'captures', 'current_capture', 'next_capture']:
+            output('\nDevice status_' + name)
+            output(str(getattr(response, name)))
+    elif args.command == 'test-capture':
+        sleep = args.sleep
+        output('\nstop; new_capture; pause; record; extend; pause; stop')
+        output(str(device.capture_stop()))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_new_capture(3500, 'Trinity Standard Lecture', 'test from python')))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_pause()))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_record()))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_extend(400)))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_pause()))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_stop()))
+        output(device.capture_status_str(sleep=sleep))
+    elif args.command == 'test-confidence':
+        sleep = args.sleep
+        output('\nconfidence_monitor; stop')
+        output(str(device.capture_confidence_monitor(360, 'Trinity Standard Lecture', 'test from python')))
+        output(device.capture_status_str(sleep=sleep))
+        output(str(device.capture_stop()))
+        output(device.capture_status_str(sleep=sleep))
+    return response
+
+def cli_device_command(server, args, info_cache):
+    # Run the CLI command against one device of a multi-device run. Returns a dict with the device name,
+    # the lines of output, the result ('success', the error code or the connection test error) and the
+    # elapsed time.
+    start = time.time()
+    lines = []
+    device = Echo360CaptureDevice(server['uri'], server['username'], server['password'],
+        debuglevel=args.debug, timeout=args.timeout, info_cache=info_cache)
+    error = cli_connection_error(device, server['uri'])
+    if error is not None:
+        lines.append(error[0])
+        result = str(device.connection_test._result_code)
+    else:
+        args = argparse.Namespace(**vars(args))
+        args.room = server['room']
+        if args.profile is None and server.get('profile') is not None:
+            # use the room's capture profile from the config file
+            args.profile = server['profile']
+        response = cli_command(device, args, lines.append)
+        result = 'success' if response is None or response.success() else str(response._result_code)
+    device.close()
+    return {'room': server['room'], 'lines': lines, 'result': result, 'elapsed': time.time() - start}
+
+def cli_status_stream(servers, args, info_cache):
+    # 'status --jsonl': poll the status of each device every --sleep seconds, --count times, printing JSON
+    # lines when a device's status changes and a heartbeat every --heartbeat seconds (see Echo360StatusStream).
+    from fleet import Echo360WorkerPool
+    pool = Echo360WorkerPool(args.workers)
+    devices = dict((server['room'], Echo360CaptureDevice(server['uri'], server['username'], server['password'],
+        debuglevel=args.debug, timeout=args.timeout, lazy=True, info_cache=info_cache)) for server in servers)
+    stream = Echo360StatusStream(sys.stdout, heartbeat=args.heartbeat, rooms=len(servers) > 1)
+    try:
+        for i in range(args.count):
+            start = time.time()
+            jobs = dict((pool.submit(device.status_monitoring), room) for (room, device) in devices.items())
+            for job in pool.as_completed(list(jobs)):
+                response = job.result
+                if job.error is not None:
+                    response = Echo360CaptureDeviceResponse('status/monitoring', 'unknown',
+                        'Unknown error: {0}'.format(repr(job.error)),
+                        title='Get Capture Status with Monitoring Information')
+                stream.write(jobs[job], response)
+            stream.flush()
+            if i < args.count - 1:
+                time.sleep(max(0, args.sleep - (time.time() - start)))
+    finally:
+        stream.flush(force=True)
+
+def cli_follow_log(servers, args, info_cache):
+    # 'log --follow': print the new log entries of each device every --sleep seconds as JSON lines (with the
+    # room name if there are several devices), polling up to --workers devices at once. Errors are printed
+    # to stderr when they change. Runs until interrupted.
+    from fleet import Echo360WorkerPool
+    pool = Echo360WorkerPool(args.workers)
+    followers = {}
+    for server in servers:
+        device = Echo360CaptureDevice(server['uri'], server['username'], server['password'],
+            debuglevel=args.debug, timeout=args.timeout, lazy=True, info_cache=info_cache)
+        followers[server['room']] = Echo360LogFollower(device, count=args.count)
+    errors = {}
+    while True:
+        start = time.time()
+        jobs = dict((pool.submit(follower.poll), room) for (room, follower) in followers.items())
+        for job in pool.as_completed(list(jobs)):
+            room = jobs[job]
+            error = None
+            if job.error is not None:
+                error = 'Unknown error: {0}'.format(repr(job.error))
+            elif not job.result.success():
+                error = str(job.result)
+            else:
+                if job.result.gap:
+                    sys.stderr.write('[{0}] the new log entries do not follow on from the last ones: some may have '
+                        'been missed\n'.format(room))
+                for entry in job.result.entries:
+                    if len(servers) > 1:
+                        entry = dict(entry, room=room)
+                    sys.stdout.write(json.dumps(entry, sort_keys=True) + '\n')
+            if error != errors.get(room):
+                if error is not None:
+                    sys.stderr.write('[{0}] {1}\n'.format(room, error))
+                errors[room] = error
+        sys.stdout.flush()
+        time.sleep(max(0, args.sleep - (time.time() - start)))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Echo360 Capture Device CLI',
         )
-    parser.add_argument('-s', '--server', help='capture device ', required=True)
+    parser.add_argument('-s', '--server', help='capture device (repeatable)', action='append', default=[])
+    parser.add_argument('--config', help='config file, for --rooms', default='echo360.config')
+    parser.add_argument('--rooms', help='config file room names or glob (e.g. "lt*", repeatable)', action='append',
+        default=[])
+    parser.add_argument('--workers', help='devices to run the command against at once', default=32, type=int)
     parser.add_argument('-u', '--user', help='username', default='admin')
     parser.add_argument('-p', '--password', help='password', default=None)
     parser.add_argument('-d', '--debug', help='debug level', default=0, type=int)
@@ -681,160 +1971,82 @@ if __name__ == '__main__':
         choices=['system-status', 'status', 
             'new-capture', 'confidence-monitor', 'pause', 'resume', 'extend', 'stop',
             'status-get-user-sections', 'status-get-user-ref', 'diagnostics-clear-cache',
-            'ping', 'traceroute', 'restart-all', 'reboot', 'log', 'system-info',
+            'ping', 'traceroute', 'restart-all', 'reboot', 'saved-content', 'upload', 'log', 'system-info',
+            'diagnostics-bundle', 'monitoring-snapshot',
             'status-captures', 'status-current-capture', 'status-next-capture',
             'test-system', 'test-status', 'test-capture', 'test-confidence'])
     parser.add_argument('--duration', help='duration (seconds)', default=3600+1800, type=int)
     parser.add_argument('--profile', help='profile name', default=None)
     parser.add_argument('--description', help='description', default='capture-device.py')
     parser.add_argument('--count', help='execute command multiple times', default=1, type=int)
-    parser.add_argument('--url', help='URL for ping and traceroute', default=None)
+    parser.add_argument('--follow', help='log: print new log entries every --sleep seconds', action='store_true')
+    parser.add_argument('--jsonl', help='status: print JSON lines, only when the status changes', action='store_true')
+    parser.add_argument('--heartbeat', help='status --jsonl: print the status at least every N seconds', default=60,
+        type=float)
+    parser.add_argument('--url', help='URL for ping and traceroute, image name for monitoring-snapshot', default=None)
+    parser.add_argument('--id', help='capture ID for upload', default=None)
     parser.add_argument('--xml', help='Print the raw XML', action='store_true')
+    parser.add_argument('--bundle-dir', help='diagnostics-bundle: directory for the archives', default='.')
+    parser.add_argument('--snapshot-dir', help='monitoring-snapshot: directory for the images', default='.')
+    parser.add_argument('--cache', help='device information cache file (skips the connection test)', default=None)
+    parser.add_argument('--cache-ttl', help='device information cache lifetime (seconds)', default=24*3600, type=int)
     args = parser.parse_args()
 
+    servers = [{'room': server, 'uri': server, 'username': args.user, 'password': args.password}
+        for server in args.server]
+    if len(args.rooms) > 0:
+        from fleet import load_rooms
+        for pattern in args.rooms:
+            servers += [room for room in load_rooms(args.config, pattern) if room not in servers]
+    if len(servers) == 0:
+        parser.error('a capture device is required: use -s/--server or --rooms')
+
     try:    # catch ctrl-c
-        device = Echo360CaptureDevice(args.server, args.user, args.password, 
-            debuglevel=args.debug, timeout=args.timeout)
-
-        # test access
-        if not device.connection_test.success():
-            if device.connection_test._result_code == 401:
-                print('Connection Test Error (401): Incorrect capture device username or password.')
-                sys.exit(1)
-            elif device.connection_test._result_code == 404:
-                print('Connection Test Error (404): Capture Device API error: command not found.')
-                sys.exit(2)
-            else:
-                print('Connection Test Error ({0}): {1} to {2}'.format(
-                    device.connection_test._result_code, device.connection_test._result_message, args.server))
-                sys.exit(3)
-
-        if args.command == 'system-status':
-            print(str(device.status_system(dump_xml=args.xml)))
-        elif args.command == 'status':
-            print(device.capture_status_str())
-            if args.count > 1:
-                for i in range(1, args.count):
-                    print(device.capture_status_str(sleep=args.sleep))
-        # TODO: monitoring_snapshot(self, url)
-        elif args.command == 'new-capture':
-            print(str(device.capture_new_capture(args.duration, args.profile , args.description)))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'confidence-monitor':
-            print(str(device.capture_confidence_monitor(args.duration, args.profile , args.description)))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'pause':
-            print(str(device.capture_pause()))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'resume':
-            print(str(device.capture_record()))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'extend':
-            print(str(device.capture_extend(args.duration)))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'stop':
-            print(str(device.capture_stop()))
-            print(device.capture_status_str(sleep=args.sleep))
-        elif args.command == 'status-get-user-sections':
-            # TODO: print(str(device.status_get_user_sections()))
-            print('Not implemented yet.')
-        elif args.command == 'status-get-user-ref':
-            print(str(device.status_get_user_ref(dump_xml=args.xml)))
-        elif args.command == 'diagnostics-clear-cache':
-            print(str(device.diagnostics_clear_cache()))
-        elif args.command == 'ping':
-            if args.url is None:
-                print("No ping URL specified. Use '--url'")
-            else:
-                response = device.diagnostics_ping(args.url)
-                if response.success():
-                    print('{0}\n{1}'.format(str(response), response._data))
-                else:
-                    print(str(response))
-        elif args.command == 'traceroute':
-            if args.url is None:
-                print("No traceroute URL specified. Use '--url'")
-            else:
-                response = device.diagnostics_traceroute(args.url)
-                if response.success():
-                    t = response._data.replace('<br/>', '\n')
-                    print('{0}\n{1}'.format(str(response), t))
+        info_cache = None
+        if args.cache is not None:
+            info_cache = Echo360DeviceInfoCache(args.cache, args.cache_ttl)
+
+        if args.command == 'log' and args.follow:
+            cli_follow_log(servers, args, info_cache)
+        elif args.command == 'status' and args.jsonl:
+            cli_status_stream(servers, args, info_cache)
+        elif len(servers) == 1 and len(args.server) == 1:
+            device = Echo360CaptureDevice(args.server[0], args.user, args.password, 
+                debuglevel=args.debug, timeout=args.timeout, info_cache=info_cache)
+
+            # test access
+            error = cli_connection_error(device, args.server[0])
+            if error is not None:
+                print(error[0])
+                sys.exit(error[1])
+
+            cli_command(device, args, lambda line: sys.stdout.write(line + '\n'))
+        else:
+            # Several devices: run the command against up to --workers devices at once, printing the output
+            # of each device as it finishes, then a summary.
+            from fleet import Echo360WorkerPool
+            pool = Echo360WorkerPool(args.workers)
+            start = time.time()
+            jobs = [pool.submit(cli_device_command, server, args, info_cache) for server in servers]
+            results = []
+            for job in pool.as_completed(jobs):
+                if job.error is not None:
+                    result = {'room': job.args[0]['room'], 'lines': ['Unknown error: {0}'.format(repr(job.error))],
+                        'result': 'unknown', 'elapsed': 0}
                 else:
-                    print(str(response))
-        elif args.command == 'restart-all':
-            print(str(device.diagnostics_restart_all()))
-        elif args.command == 'reboot':
-            print(str(device.diagnostics_reboot()))
-        elif args.command == 'log':
-            print(json.dumps(device.log_list_last_count(args.count, dump_xml=args.xml).entries, indent=4, sort_keys=True))
-        elif args.command == 'system-info':
-            response = device.diagnostics_system_info_ifconfig()
-            if response.success():
-                t = response._data.replace('<pre>', '\n').replace('</pre>', '\n')
-                print('{0}\n{1}'.format(str(response), t))
-            else:
-                print(str(response))
-            # TODO: XML result
-            # response = device.diagnostics_system_info_device()
-            # print('{0}\n{1}'.format(str(response), response._data))
-            response = device.diagnostics_system_info_top()
-            if response.success():
-                t = response._data.replace('<head><meta http-equiv="refresh" content="5"></head>', '').replace('<pre>', '\n').replace('</pre>', '\n')
-                print('{0}\n{1}'.format(str(response), t))
-            else:
-                print(str(response))
-            response = device.diagnostics_system_info_dmesg()
-            if response.success():
-                t = response._data.replace('<pre>', '\n').replace('</pre>', '\n')
-                print('{0}\n{1}'.format(str(response), t))
-            else:
-                print(str(response))
-        elif args.command == 'status-captures':
-            print(str(device.status_captures(dump_xml=args.xml)))
-        elif args.command == 'status-current-capture':
-            print(str(device.status_current_capture(dump_xml=args.xml)))
-        elif args.command == 'status-next-capture':
-            print(str(device.status_next_capture(dump_xml=args.xml)))
-        elif args.command == 'test-system':
-            print('\nDevice status_system')
-            print(str(device.status_system(dump_xml=args.xml)))
-        elif args.command == 'test-status':
-            print('\nDevice status_system')
-            print(str(device.status_system(dump_xml=args.xml)))
-            print('\nDevice status_monitoring')
-            print(str(device.status_monitoring(dump_xml=args.xml)))
-            print('\nDevice status_captures')
-            print(str(device.status_captures(dump_xml=args.xml)))
-            print('\nDevice status_current_capture')
-            print(str(device.status_current_capture(dump_xml=args.xml)))
-            print('\nDevice status_next_capture')
-            print(str(device.status_next_capture(dump_xml=args.xml)))
-        elif args.command == 'test-capture':
-            sleep = args.sleep
-            print('\nstop; new_capture; pause; record; extend; pause; stop')
-            print(str(device.capture_stop()))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_new_capture(3500, 'Trinity Standard Lecture', 'test from python')))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_pause()))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_record()))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_extend(400)))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_pause()))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_stop()))
-            print(device.capture_status_str(sleep=sleep))
-        elif args.command == 'test-confidence':
-            sleep = args.sleep
-            print('\nconfidence_monitor; stop')
-            print(str(device.capture_confidence_monitor(360, 'Trinity Standard Lecture', 'test from python')))
-            print(device.capture_status_str(sleep=sleep))
-            print(str(device.capture_stop()))
-            print(device.capture_status_str(sleep=sleep))
+                    result = job.result
+                results.append(result)
+                print('\n[{0}]'.format(result['room']))
+                for line in result['lines']:
+                    print(line)
+                sys.stdout.flush()
+            print('\nSummary: {0} devices in {1:.1f} seconds'.format(len(results), time.time() - start))
+            for result in sorted(results, key=lambda result: result['room']):
+                print('{0:<32} {1:<12} {2:6.1f}s'.format(result['room'], result['result'], result['elapsed']))
+            failed = len([result for result in results if result['result'] != 'success'])
+            if failed > 0:
+                print('{0} of {1} devices failed'.format(failed, len(results)))
+                sys.exit(4)
 
     except KeyboardInterrupt:
         print('\nCtrl-C User requested exit.')
-
-
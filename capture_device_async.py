@@ -0,0 +1,983 @@
+#!/usr/bin/env python
+#
+# Non-blocking (event loop) version of the Echo360 Capture Device API wrapper.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# AsyncEcho360CaptureDevice has the same API methods as Echo360CaptureDevice but each returns an
+# Echo360Future of the same Echo360CaptureDeviceResponse instead of blocking. One Echo360EventLoop
+# (the standard library asyncore loop, using poll() so there is no select() limit on open sockets)
+# can hold thousands of requests in flight without a thread per device.
+#
+# Generator based coroutines 'yield' a future to wait for its result:
+#
+#     def show_state(device):
+#         yield device.test_connection()
+#         response = yield device.status_monitoring()
+#         print(str(response))
+#
+#     loop = Echo360EventLoop()
+#     device = AsyncEcho360CaptureDevice('https://10.10.10.10', 'admin', 'letmein', loop=loop)
+#     loop.run_until_complete(loop.spawn(show_state(device)))
+
+from capture_device import Echo360CaptureDevice, Echo360CaptureDeviceResponse, NO_RETRY
+import asyncore
+import collections
+import heapq
+import httplib
+import os
+import re
+import socket
+import ssl
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+class Echo360Cancelled(Exception):
+    # The error of a future cancelled with Echo360Future.cancel()
+    pass
+
+
+class Echo360NotSupported(Exception):
+    # Raised by the Echo360CaptureDevice methods that AsyncEcho360CaptureDevice has no non-blocking version of
+    pass
+
+
+class Echo360Future(object):
+    # The result of an operation that has not finished yet. result() runs the event loop until it has.
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        if self._done:
+            # (e.g. a timer of a cancelled future)
+            return
+        self._result = result
+        self._set_done()
+
+    def set_error(self, error):
+        if self._done:
+            return
+        self._error = error
+        self._set_done()
+
+    def cancel(self):
+        # Fail the future with Echo360Cancelled, unless it is done.
+        self.set_error(Echo360Cancelled())
+
+    def _set_done(self):
+        self._done = True
+        for fn in self._callbacks:
+            self.loop.call_soon(fn, self)
+        self._callbacks = []
+
+    def add_done_callback(self, fn):
+        # Call fn(future) from the event loop once the future is done.
+        if self._done:
+            self.loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+    def result(self):
+        # Return the result, running the event loop until it is available. Raises the error of a failed future.
+        if not self._done:
+            self.loop.run_until_complete(self)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def then(self, fn):
+        # Return a future for fn(result). If fn returns a future, its result is used.
+        future = Echo360Future(self.loop)
+        def chain(f):
+            if f._error is not None:
+                future.set_error(f._error)
+            else:
+                try:
+                    value = fn(f._result)
+                except Exception as e:
+                    future.set_error(e)
+                    return
+                if isinstance(value, Echo360Future):
+                    value.add_done_callback(lambda v: future.set_error(v._error) if v._error is not None
+                        else future.set_result(v._result))
+                else:
+                    future.set_result(value)
+        self.add_done_callback(chain)
+        return future
+
+
+class Echo360Task(Echo360Future):
+    # Runs a generator based coroutine. Each future the generator yields is waited for and its result
+    # (or error) is sent back into the generator. Use 'raise StopIteration(value)' to return a value.
+    def __init__(self, loop, coroutine):
+        Echo360Future.__init__(self, loop)
+        self._coroutine = coroutine
+        self._waiting = None    # the future the coroutine is waiting for
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, error):
+        if self._done:
+            return
+        try:
+            if error is None:
+                future = self._coroutine.send(value)
+            else:
+                future = self._coroutine.throw(error)
+        except StopIteration as e:
+            self.set_result(e.args[0] if len(e.args) > 0 else None)
+            return
+        except Exception as e:
+            self.set_error(e)
+            return
+        self._waiting = future
+        future.add_done_callback(lambda f: self._step(f._result, f._error))
+
+    def cancel(self):
+        # Stop the coroutine (GeneratorExit is raised at its current yield) and cancel the future it is
+        # waiting for (e.g. an Echo360Queue get(), so the queue doesn't hand it an item).
+        if not self._done:
+            self._coroutine.close()
+            self.set_result(None)
+            if self._waiting is not None:
+                self._waiting.cancel()
+
+
+class Echo360Queue(object):
+    # A FIFO queue between coroutines on one Echo360EventLoop. get() returns a future of the next item.
+    def __init__(self, loop):
+        self.loop = loop
+        self._items = collections.deque()
+        self._getters = collections.deque()
+
+    def put(self, item):
+        while len(self._getters) > 0:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(item)
+                return
+        self._items.append(item)
+
+    def get(self):
+        future = Echo360Future(self.loop)
+        if len(self._items) > 0:
+            future.set_result(self._items.popleft())
+        else:
+            self._getters.append(future)
+        return future
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Echo360Timer(object):
+    # Handle returned by Echo360EventLoop.call_later()
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class _Echo360Waker(asyncore.file_dispatcher):
+    # The read end of a pipe in the socket map, so call_soon_threadsafe() can wake up the loop.
+    def __init__(self, loop):
+        (self._read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read_fd, map=loop.map)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def wake(self):
+        os.write(self.write_fd, 'x')
+
+
+class Echo360EventLoop(object):
+    # A single threaded event loop for AsyncEcho360CaptureDevice requests, timers and coroutines.
+    def __init__(self):
+        self.map = {}   # asyncore socket map
+        self._ready = []
+        self._timers = []
+        self._lock = threading.RLock()  # (re-entrant: a signal handler may call call_soon_threadsafe())
+        self._stopped = False
+        self._waker = _Echo360Waker(self)
+        # The same certificate checks as httplib.HTTPSConnection. Capture devices often use a self-signed
+        # certificate, set this to ssl._create_unverified_context() to match 'curl --insecure'.
+        self.ssl_context = ssl._create_default_https_context()
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        # call_soon() for use from other threads (e.g. one reading stdin).
+        with self._lock:
+            self._ready.append((fn, args))
+        self._waker.wake()
+
+    def call_later(self, delay, fn, *args):
+        timer = Echo360Timer(time.time() + delay, fn, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def sleep(self, seconds):
+        # Return a future that is done after 'seconds'.
+        future = Echo360Future(self)
+        self.call_later(seconds, future.set_result, None)
+        return future
+
+    def spawn(self, coroutine):
+        # Run a generator based coroutine. Returns its Echo360Task.
+        return Echo360Task(self, coroutine)
+
+    def gather(self, futures):
+        # Return a future for the list of results of 'futures'. Fails with the first error, if any.
+        futures = list(futures)
+        gathered = Echo360Future(self)
+        pending = [len(futures)]
+        def done(f):
+            pending[0] -= 1
+            if gathered.done():
+                return
+            if f._error is not None:
+                gathered.set_error(f._error)
+            elif pending[0] == 0:
+                gathered.set_result([future._result for future in futures])
+        for f in futures:
+            f.add_done_callback(done)
+        if len(futures) == 0:
+            gathered.set_result([])
+        return gathered
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self._run_once()
+        return future.result()
+
+    def run_forever(self):
+        # Run until stop() is called.
+        self._stopped = False
+        while not self._stopped:
+            self._run_once()
+
+    def stop(self):
+        self._stopped = True
+
+    def _run_once(self):
+        # Wait for socket events (or the next timer), then run the callbacks that are ready.
+        while len(self._timers) > 0 and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if len(self._ready) > 0:
+            timeout = 0
+        elif len(self._timers) > 0:
+            timeout = max(0, self._timers[0].when - time.time())
+        else:
+            timeout = 30
+        asyncore.loop(timeout, use_poll=True, map=self.map, count=1)
+        now = time.time()
+        while len(self._timers) > 0 and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.fn, timer.args))
+        with self._lock:
+            ready = self._ready
+            self._ready = []
+        for (fn, args) in ready:
+            fn(*args)
+
+
+class _ResponseSocket(object):
+    # Just enough of a socket for httplib.HTTPResponse to parse a response that has already been read.
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, mode, bufsize=None):
+        return StringIO.StringIO(self._data)
+
+
+class Echo360HTTPDispatcher(asyncore.dispatcher):
+    # An HTTP(S) connection on a non-blocking socket, one request at a time. The response ends at its
+    # Content-Length, at the last chunk or when the device closes the connection. finish() is called exactly
+    # once per request with the response (or the exception). With 'release', a connection whose response
+    # allows keep-alive is not closed but passed to release(dispatcher), and send_request() sends the next one.
+    # 'address' is a (family, socket address) of the device, from socket.getaddrinfo(). The seconds each phase
+    # of the last request took are in connect_time and tls_time (None after the first request on the
+    # connection has been recorded, as for Echo360HTTPConnection), ttfb_time and body_time.
+    # With 'out', the body of a 200 response with a Content-Length (or that ends when the device closes the
+    # connection) is written to out as it arrives (streamed, bytes) and the response's data is None.
+    def __init__(self, loop, url, address, request, timeout, finish, release=None, out=None):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.url = url
+        self.release = release
+        self.reused = False     # True from the second request (the device may have closed it since)
+        self.unanswered = False # the device closed the connection without any response
+        self.established = False    # connected (TCP)
+        self.connect_time = None
+        self.tls_time = None
+        self._handshaking = False
+        self._want_write = False
+        self._start(request, timeout, finish, out)
+        self.create_socket(address[0], socket.SOCK_STREAM)
+        try:
+            self.connect(address[1])
+        except Exception as e:
+            # (from the event loop, so finish is never called before the constructor returns)
+            self.loop.call_soon(self.finish, None, e)
+
+    def _start(self, request, timeout, finish, out):
+        self._out = request
+        self._in = bytearray()
+        self.unanswered = False
+        self._header_end = None
+        self._length = None
+        self._chunked = False
+        self._body_out = out
+        self._streaming = False
+        self.streamed = 0
+        self._finish = finish
+        self._timer = self.loop.call_later(timeout, self._timeout)
+        self.ttfb_time = None
+        self.body_time = None
+        self._mark = time.time()    # the start of the current phase
+
+    def send_request(self, request, timeout, finish, out=None):
+        # Send the next request on an idle connection
+        self.reused = True
+        self._start(request, timeout, finish, out)
+
+    def finish(self, response=None, error=None, reusable=False):
+        if self._finish is None:
+            return
+        finish = self._finish
+        self._finish = None
+        self._timer.cancel()
+        if reusable and self.release is not None:
+            self.release(self)
+        else:
+            self.close()
+        finish(response, error)
+
+    def _timeout(self):
+        self.finish(error=socket.timeout('timed out'))
+
+    def _phase(self):
+        # The seconds since the start of the current phase, which ends now
+        now = time.time()
+        (seconds, self._mark) = (now - self._mark, now)
+        return seconds
+
+    def handle_connect(self):
+        self.established = True
+        self.connect_time = self._phase()
+        if self.url.scheme == 'https':
+            self.socket = self.loop.ssl_context.wrap_socket(self.socket, do_handshake_on_connect=False,
+                server_hostname=self.url.hostname)
+            self._handshaking = True
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self._want_write = True
+            return
+        self._handshaking = False
+        self.tls_time = self._phase()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self._handshaking:
+            return self._want_write
+        return len(self._out) > 0
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        if len(self._out) == 0:
+            return
+        try:
+            sent = self.socket.send(self._out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            self.finish(error=e)
+            return
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        if self._finish is None:
+            # idle: the device closed the connection (or sent something unexpected)
+            self.close()
+            return
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except socket.error as e:
+                # (asyncore would call handle_close() for a reset connection, as if it was closed cleanly)
+                self.finish(error=e)
+                return
+            if len(data) == 0:
+                self.handle_close()
+                return
+            if len(self._in) == 0:
+                self.ttfb_time = self._phase()
+            self._in += data
+            if self._complete():
+                self._parse()
+                return
+            if not isinstance(self.socket, ssl.SSLSocket) or self.socket.pending() == 0:
+                return
+
+    def _complete(self):
+        # True once self._in holds the whole response
+        if self._header_end is None:
+            i = self._in.find('\r\n\r\n')
+            if i < 0:
+                return False
+            self._header_end = i + 4
+            head = str(self._in[:i]).lower()
+            length = re.search(r'\r\ncontent-length:\s*(\d+)', head)
+            if length is not None:
+                self._length = int(length.group(1))
+            self._chunked = re.search(r'\r\ntransfer-encoding:\s*chunked', head) is not None
+            self._streaming = self._body_out is not None and not self._chunked and \
+                re.match(r'http/\d\.\d 200 ', head) is not None
+        if self._streaming:
+            body = self._in[self._header_end:]
+            if len(body) > 0:
+                self._body_out.write(str(body))
+                self.streamed += len(body)
+                del self._in[self._header_end:]
+            return self._length is not None and self.streamed >= self._length
+        if self._length is not None:
+            return len(self._in) - self._header_end >= self._length
+        if self._chunked:
+            return self._in.endswith('0\r\n\r\n')
+        return False
+
+    def _parse(self, closed=False):
+        self.body_time = self._phase()
+        try:
+            resp = httplib.HTTPResponse(_ResponseSocket(str(self._in)))
+            resp.begin()
+            # (will_close: 'Connection: close', HTTP/1.0 or a response that ends when the connection closes)
+            reusable = not closed and not resp.will_close
+            data = None if self._streaming else resp.read()
+        except Exception as e:
+            self.finish(error=e)
+            return
+        self.finish(response=(resp.status, resp.reason, dict(resp.getheaders()), data), reusable=reusable)
+
+    def handle_close(self):
+        # The device closed the connection: the end of the response unless it has a length
+        if self._finish is None:
+            self.close()
+        elif self._streaming and self._length is not None:
+            # (the response was not complete, or handle_read() would have finished it)
+            self.finish(error=httplib.IncompleteRead('', self._length - self.streamed))
+        elif len(self._in) == 0:
+            # (asyncore also calls this for a reset connection, which may have acted on the request)
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                self.finish(error=socket.error(error, os.strerror(error)))
+                return
+            self.unanswered = True
+            self.finish(error=socket.error(None, 'Connection closed by the device.'))
+        else:
+            self._parse(closed=True)
+
+    def handle_expt(self):
+        self.handle_close()
+
+    def handle_error(self):
+        if self._finish is None:
+            self.close()
+        else:
+            self.finish(error=sys.exc_info()[1])
+
+
+class _Echo360FileSink(object):
+    # Where fetch_file() writes the body: to 'out' or into 'buffer' (grown as needed), as
+    # Echo360CaptureDevice.fetch_file()
+    def __init__(self, out, buffer):
+        self.out = out
+        self.buffer = bytearray() if out is None and buffer is None else buffer
+        self.size = 0
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        else:
+            self.buffer[self.size:self.size + len(data)] = data
+        self.size += len(data)
+
+
+def _check_for_error(response):
+    response.check_for_error()
+    return response
+
+def _not_supported(name):
+    # An AsyncEcho360CaptureDevice method for a blocking only Echo360CaptureDevice method
+    def method(self, *args, **kwargs):
+        raise Echo360NotSupported('{0}() is not supported by AsyncEcho360CaptureDevice (it reads from blocking '
+            'connections); use Echo360CaptureDevice.'.format(name))
+    method.__name__ = name
+    return method
+
+
+class AsyncEcho360CaptureDevice(Echo360CaptureDevice):
+    # Non-blocking version of Echo360CaptureDevice. The API methods have the same names and arguments but
+    # return an Echo360Future of the same Echo360CaptureDeviceResponse.
+    # The constructor does not run the connection test; yield test_connection() to run it and set utc_offset.
+    # An Echo360ResponseCache 'cache' is used as by Echo360CaptureDevice; requests in flight are shared by
+    # this device only (other devices and threads sharing the cache wait for the cache entry). An Echo360Metrics
+    # 'metrics' records the phases of each call and the response counts, as by Echo360CaptureDevice. 'retry'
+    # and 'breaker' are used as by Echo360CaptureDevice. Up to 'idle_connections' keep-alive connections are
+    # kept open for the next requests, for at most idle_timeout seconds (as the connection pool of
+    # Echo360CaptureDevice).
+    connection_test = None
+
+    def __init__(self, server, username, password, debuglevel=None, timeout=10, loop=None, cache=None,
+            metrics=None, retry=None, breaker=None, idle_connections=4, idle_timeout=30):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.debug = debuglevel
+        self.timeout = int(timeout)
+        self.loop = loop or Echo360EventLoop()
+        self.cache = cache
+        self.metrics = metrics
+        self.retry = retry
+        self.breaker = breaker
+        self.idle_connections = idle_connections
+        self.idle_timeout = idle_timeout
+        self.utc_offset = None
+        self.connection_test = None
+        self._in_flight = {}    # command -> future of request(), see call_api()
+        self._idle = []         # (Echo360HTTPDispatcher, time last used), most recently used last
+        self._active = set()    # the Echo360HTTPDispatchers sending a request
+        self._pending = set()   # the futures of request() and of the retry delays, cancelled by close()
+        self._epoch = 0         # incremented by close(): requests started before then don't connect
+        self._address = None    # future of the (family, socket address) of the device, see resolve()
+
+    # Streamed responses read the body from a blocking connection as it is parsed, and diagnostics_bundle()
+    # fetches from threads. Use log_list_last_count() and diagnostics_recovery_saved_content() instead of the
+    # _iter versions.
+    request_stream = _not_supported('request_stream')
+    read_stream = _not_supported('read_stream')
+    release_stream = _not_supported('release_stream')
+    call_api_stream = _not_supported('call_api_stream')
+    log_iter_last_count = _not_supported('log_iter_last_count')
+    diagnostics_recovery_saved_content_iter = _not_supported('diagnostics_recovery_saved_content_iter')
+    diagnostics_bundle = _not_supported('diagnostics_bundle')
+
+    def request(self, method, path, headers=None, body=None, timeout=None, out=None):
+        # Returns a future of (status, reason, headers, data), as returned by Echo360CaptureDevice.request().
+        # With 'out', a 200 response's body may be written to out as it arrives instead, with data None
+        # (see Echo360HTTPDispatcher).
+        future = Echo360Future(self.loop)
+        url = urlparse.urlparse(urlparse.urljoin(self.server, path))
+        if len(url.netloc) == 0:
+            future.set_result(('Invalid URL', 'Missing IP address or domain name.', {}, None))
+            return future
+        if url.scheme not in ['http', 'https']:
+            future.set_result(('Invalid URL', 'The URL scheme must be http or https.', {}, None))
+            return future
+        lines = ['{0} {1} HTTP/1.1'.format(method, url.path or '/'),
+            'Host: {0}'.format(url.netloc),
+            'Accept-Encoding: identity']
+        for name in headers or {}:
+            lines.append('{0}: {1}'.format(name, headers[name]))
+        if body is not None or method == 'POST':
+            lines.append('Content-Length: {0}'.format(len(body or '')))
+        request = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+        def finish(dispatcher, response, error):
+            if future.done():
+                # (cancelled by close())
+                return
+            if dispatcher is None or (error is not None and not dispatcher.established):
+                # (not resolved, or not connected: the address may have changed)
+                self._address = None
+            if error is not None and dispatcher is not None and dispatcher.reused and \
+                    not isinstance(error, socket.timeout) and dispatcher.streamed == 0 and \
+                    (method in ['GET', 'HEAD'] or dispatcher.unanswered):
+                # The device closed the idle keep-alive connection, so retry on a new connection. As in
+                # Echo360CaptureDevice.request_stream(), a POST is only sent again if there was no response
+                # (and nothing is sent again once part of the body has been written to 'out').
+                self.connection(url, request, timeout or self.timeout, finish, reuse=False, out=out)
+                return
+            if error is not None:
+                response = self.request_error(error, timeout)
+            elif self.metrics is not None:
+                self._observe_dispatcher(dispatcher, path)
+            future.set_result(response)
+        self.connection(url, request, timeout or self.timeout, finish, out=out)
+        return self._track(future)
+
+    def connection(self, url, request, timeout, finish, reuse=True, out=None):
+        # Send 'request' on an idle keep-alive connection (unless not 'reuse') or a new one. Calls
+        # finish(dispatcher, response, error); 'dispatcher' is None if the device's address wasn't resolved.
+        start = time.time()
+        epoch = self._epoch
+        def sent(dispatcher, response, error):
+            self._active.discard(dispatcher)
+            finish(dispatcher, response, error)
+        while reuse and len(self._idle) > 0:
+            (dispatcher, last_used) = self._idle.pop()
+            if dispatcher.connected and start - last_used < self.idle_timeout:
+                self._active.add(dispatcher)
+                dispatcher.send_request(request, timeout, lambda response, error: sent(dispatcher, response, error),
+                    out)
+                return
+            dispatcher.close()
+        pending = [True]
+        def resolved(address):
+            if not pending[0]:
+                return
+            pending[0] = False
+            timer.cancel()
+            if epoch != self._epoch:
+                finish(None, None, Echo360Cancelled())
+            elif address is None or address._error is not None:
+                finish(None, None, socket.timeout('timed out') if address is None else address._error)
+                return
+            connect(address._result, 0)
+        def connect(addresses, i):
+            def connected(dispatcher, response, error):
+                self._active.discard(dispatcher)
+                if error is not None and not dispatcher.established and i + 1 < len(addresses) and \
+                        time.time() - start < timeout and epoch == self._epoch:
+                    # (e.g. 'localhost' is ::1 and 127.0.0.1, and the device only listens on one)
+                    connect(addresses, i + 1)
+                    return
+                if error is None and i > 0:
+                    addresses.insert(0, addresses.pop(i))
+                finish(dispatcher, response, error)
+            remaining = max(0.001, timeout - (time.time() - start))
+            dispatcher = Echo360HTTPDispatcher(self.loop, url, addresses[i], request, remaining,
+                lambda response, error: connected(dispatcher, response, error), release=self._release, out=out)
+            self._active.add(dispatcher)
+        timer = self.loop.call_later(timeout, resolved, None)
+        self.resolve(url).add_done_callback(resolved)
+
+    def _observe_dispatcher(self, dispatcher, path):
+        # Record the phases of the request just completed on 'dispatcher' (connect and TLS only once per
+        # connection), as Echo360CaptureDevice._observe_connection()
+        for phase in ['connect', 'tls', 'ttfb', 'body']:
+            seconds = getattr(dispatcher, phase + '_time', None)
+            if seconds is not None:
+                self.metrics.observe(self.server, path, phase, seconds)
+        dispatcher.connect_time = None
+        dispatcher.tls_time = None
+
+    def resolve(self, url):
+        # A future of the list of (family, socket address) of the device, tried in order (the last that
+        # worked first). getaddrinfo() blocks (a DNS lookup), so it runs in a thread, once: the addresses are
+        # kept until none of them can be connected to.
+        if self._address is None:
+            future = Echo360Future(self.loop)
+            def lookup():
+                try:
+                    info = socket.getaddrinfo(url.hostname, url.port or (443 if url.scheme == 'https' else 80), 0,
+                        socket.SOCK_STREAM)
+                    self.loop.call_soon_threadsafe(future.set_result, [(item[0], item[4]) for item in info])
+                except Exception as e:
+                    self.loop.call_soon_threadsafe(future.set_error, e)
+            t = threading.Thread(target=lookup)
+            t.daemon = True
+            t.start()
+            self._address = future
+        return self._address
+
+    def _track(self, future):
+        # Keep 'future' in _pending until it is done (see close())
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def _release(self, dispatcher):
+        # A connection is idle: keep it for the next request (closing the least recently used if too many)
+        self._idle.append((dispatcher, time.time()))
+        if len(self._idle) > self.idle_connections:
+            self._idle.pop(0)[0].close()
+
+    def call_api(self, command, method=None, post_data=None, title=None, dump_xml=None):
+        if method is None:
+            if post_data is None:
+                method = 'GET'
+            else:
+                method = 'POST'
+        start = time.time()
+        if self.cache is not None and method == 'GET' and self.cache.ttl(command) > 0:
+            future = self.cached_request(command)
+        else:
+            future = self.request_retry(method, command, post_data)
+            if self.cache is not None and method == 'POST':
+                future = future.then(self._invalidate)
+        def response((status, reason, headers, data)):
+            response = self.make_response(command, status, reason, headers, data, title, dump_xml)
+            if self.metrics is not None:
+                self.metrics.count(self.server, command, status)
+                self.metrics.observe(self.server, command, 'total', time.time() - start)
+            return response
+        return future.then(response)
+
+    def cached_request(self, command):
+        # A future of the cached GET request() of 'command', shared with any identical request in flight.
+        key = (self.server, self.username, command)
+        result = self.cache.get(key)
+        if result is not None:
+            future = Echo360Future(self.loop)
+            future.set_result(result)
+            return future
+        if command not in self._in_flight:
+            generation = self.cache.generation(self.server)
+            def done(future):
+                # (whether it failed or not: a failed future must not be handed to every later caller)
+                del self._in_flight[command]
+                if future._error is None:
+                    self.cache.put(key, self.cache.ttl(command), future._result, generation)
+            self.cache.misses += 1
+            self._in_flight[command] = self.request_retry('GET', command)
+            self._in_flight[command].add_done_callback(done)
+        else:
+            self.cache.coalesced += 1
+        return self._in_flight[command]
+
+    def request_retry(self, method, command, post_data=None):
+        # As Echo360CaptureDevice.request_retry(): a future of request() through the circuit breaker and
+        # the retry policy.
+        return self.loop.spawn(self._request_retry(method, command, post_data))
+
+    def _request_retry(self, method, command, post_data):
+        if self.breaker is not None:
+            allowed = self.breaker.allow()
+            if allowed == 'probe':
+                probe = yield self.request('GET', self.breaker.probe, self.request_headers(), None, self.timeout)
+                if (self.retry or NO_RETRY).classify(probe[0])[1]:
+                    self.breaker.failure()
+                    allowed = False
+                else:
+                    self.breaker.success()
+            if not allowed:
+                raise StopIteration(('circuit-open', 'Not sent: the device failed {0} times in a row (next try in '
+                    '{1:.0f} seconds).'.format(self.breaker.failures, self.breaker.retry_in()), {}, None))
+        policy = self.retry or NO_RETRY
+        attempt = 0
+        while True:
+            result = yield self.request(method, command, self.request_headers(), post_data, self.timeout)
+            if self.breaker is not None:
+                if policy.classify(result[0])[1]:
+                    self.breaker.failure()
+                    if self.breaker.state != 'closed':
+                        raise StopIteration(result)
+                else:
+                    self.breaker.success()
+            if not policy.should_retry(result[0], method, attempt):
+                raise StopIteration(result)
+            yield self._track(self.loop.sleep(policy.delay(attempt)))
+            attempt += 1
+
+    def _invalidate(self, result):
+        self.cache.invalidate(self.server)
+        return result
+
+    def test_connection(self):
+        # The connection test run by the Echo360CaptureDevice constructor. Sets connection_test and utc_offset.
+        def tested(response):
+            self.connection_test = response
+            if response.success():
+                self.utc_offset = response.utc_offset
+            return response
+        return self.status_system().then(tested)
+
+    def close(self):
+        # Close the connections to the device: the idle keep-alive ones, and those of the requests in flight,
+        # which fail with Echo360Cancelled (as do the calls waiting for them, or to retry). The device can
+        # still be used afterwards.
+        for (dispatcher, last_used) in self._idle:
+            dispatcher.close()
+        self._idle = []
+        self._epoch += 1
+        for future in list(self._pending):
+            future.cancel()
+        for dispatcher in list(self._active):
+            dispatcher.finish(error=Echo360Cancelled())
+
+    def capture_status_str(self, sleep=None):
+        if sleep is not None:
+            return self.loop.sleep(sleep).then(lambda r: self.capture_status_str())
+        return self.status_monitoring().then(self._capture_status_str)
+
+    def snapshot(self, dump_xml=None):
+        # As Echo360CaptureDevice.snapshot(): a future of the merged response of the three calls, made at once.
+        start = time.time()
+        return self.loop.gather([self.status_system(dump_xml), self.status_monitoring(dump_xml),
+            self.status_captures(dump_xml)]).then(
+            lambda (system, monitoring, captures): self._snapshot(system, monitoring, captures, start, dump_xml))
+
+    # (3.1) Device and Capture Status API Calls
+
+    def status_system(self, dump_xml=None):
+        return self.call_api('status/system', title='Get System Status',
+            dump_xml=dump_xml).then(self._parse_status_system)
+
+    def status_captures(self, dump_xml=None):
+        return self.call_api('status/captures', title='Get Capture Status',
+            dump_xml=dump_xml).then(self._parse_status_captures)
+
+    def status_next_capture(self, dump_xml=None):
+        return self.call_api('status/next_capture', title='Get Next Capture Status',
+            dump_xml=dump_xml).then(self._parse_status_next_capture)
+
+    def status_current_capture(self, dump_xml=None):
+        return self.call_api('status/current_capture', title='Get Current Capture Status',
+            dump_xml=dump_xml).then(self._parse_status_current_capture)
+
+    def status_monitoring(self, dump_xml=None):
+        return self.call_api('status/monitoring', title='Get Capture Status with Monitoring Information',
+            dump_xml=dump_xml).then(self._parse_status_monitoring)
+
+    def fetch_file(self, command, out=None, buffer=None, title=None):
+        # As Echo360CaptureDevice.fetch_file(): the body is written to 'out' or 'buffer' as it arrives (except
+        # a chunked response, which is received whole first).
+        sink = _Echo360FileSink(out, buffer)
+        def fetched((status, reason, headers, data)):
+            if status != 200:
+                return self.make_response(command, status, reason, headers, data, title)
+            response = Echo360CaptureDeviceResponse(command, 'success', 'Ok', device=self,
+                utc_offset=self.utc_offset, title=title)
+            response.content_type = headers.get('Content-Type', headers.get('content-type'))
+            if data is not None:
+                sink.write(data)
+            response.size = sink.size
+            response._buffer = sink.buffer
+            return response
+        return self.request('GET', command, self.request_headers(), None, self.timeout, out=sink).then(fetched)
+
+    def monitoring_snapshot(self, url, dump_xml=None, out=None, buffer=None):
+        if not url.startswith('monitoring/'):
+            url = 'monitoring/' + url
+        return self.fetch_file(url, out, buffer, title='Show Current Video or Display View')
+
+    def status_get_user_sections(self, dump_xml=None):
+        return self.call_api('status/get_user_sections', title='Get User Sections', dump_xml=dump_xml)
+
+    def status_get_user_ref(self, dump_xml=None):
+        return self.call_api('status/get_user_ref', title='Get Authenticated User Reference ID',
+            dump_xml=dump_xml).then(self._parse_status_get_user_ref)
+
+    # (3.2) Diagnostics API Calls
+
+    def diagnostics_clear_cache(self):
+        return self.call_api('diagnostics/clear_cache', method='POST', title='Clear User Cache')
+
+    def diagnostics_ping(self, url):
+        return self.call_api('diagnostics/ping/' + url, method='POST', title='Ping Host Connectivity')
+
+    def diagnostics_traceroute(self, url):
+        return self.call_api('diagnostics/traceroute/' + url, method='POST', title='Trace Route Path and Time')
+
+    def diagnostics_restart_all(self):
+        return self.call_api('diagnostics/restart_all', method='POST', title='Restart Device Executables')
+
+    def diagnostics_reboot(self):
+        return self.call_api('diagnostics/reboot', method='POST', title='Reboot Device')
+
+    def diagnostics_system_info_ifconfig(self):
+        return self.call_api('diagnostics/system-info/ifconfig', title='Get Device Network Configuration')
+
+    def diagnostics_system_info_tasks(self):
+        return self.call_api('diagnostics/system-info/tasks', title='Get Device Tasks').then(
+            self._parse_system_info_tasks)
+
+    def diagnostics_system_info_device(self):
+        return self.call_api('diagnostics/system-info/device', title='Get Device Configuration File')
+
+    def diagnostics_system_info_top(self):
+        return self.call_api('diagnostics/system-info/top', title='Get Device Processes')
+
+    def diagnostics_system_info_dmesg(self):
+        return self.call_api('diagnostics/system-info/dmesg', title='Get Device Message Buffer')
+
+    def diagnostics_recovery_saved_content(self):
+        return self.call_api('diagnostics/recovery/saved-content',
+            title='Get Saved Content on the Device').then(self._parse_saved_content)
+
+    def diagnostics_capture_id_upload(self, id):
+        return self.call_api('diagnostics/recovery/{0}/upload'.format(id), method='POST',
+            title='Re-Upload Content from the Device to the ESS').then(_check_for_error)
+
+    def log_list_last_count(self, count, dump_xml=None):
+        return self.call_api('log-list-last-count/' + str(count), title='Retrieve the Last X Number of Log Messages',
+            dump_xml=dump_xml).then(lambda response: self._parse_log_list(response, dump_xml))
+
+    # (3.3) CaptureControlAPICalls
+
+    def capture_new_capture(self, duration, profile, description):
+        return self.call_api('capture/new_capture',
+            post_data='duration={0}&capture_profile_name={1}&description={2}'.format(duration, profile, description),
+            title='Create New Capture').then(_check_for_error)
+
+    def capture_confidence_monitor(self, duration, profile, description):
+        return self.call_api('capture/confidence_monitor',
+            post_data='duration={0}&capture_profile_name={1}&description={2}'.format(duration, profile, description),
+            title='Create Confidence Monitor Capture').then(_check_for_error)
+
+    def capture_extend(self, duration):
+        return self.call_api('capture/extend',
+            post_data='duration={0}&extend=Submit+Query'.format(duration),
+            title='Extend a Capture').then(_check_for_error)
+
+    def capture_pause(self):
+        return self.call_api('capture/pause', method='POST', title='Pause a Capture').then(_check_for_error)
+
+    def capture_record(self):
+        return self.call_api('capture/record', method='POST', title='Start or Resume a Capture').then(_check_for_error)
+
+    def capture_stop(self):
+        return self.call_api('capture/stop', method='POST', title='Stop a Capture').then(_check_for_error)
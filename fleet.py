@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+#
+# Poll every capture device in echo360.config concurrently.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Each '[capture room_name]' section of the config file is one device. Every cycle the status calls
+# are run against all rooms by a bounded pool of worker threads and the results are merged into one
+# snapshot. A room that does not answer within --device-timeout seconds is reported as 'timeout' so
+# one dead room can't stall the rest.
+#
+# Usage: python fleet.py --config echo360.config --interval 5 --count 9999
+
+from capture_device import Echo360CaptureDevice, Echo360DeviceInfoCache, Echo360ResponseCache
+from metrics import Echo360Metrics
+from polling import Echo360PollScheduler
+from recorder import Echo360Recorder
+from retry import Echo360CircuitBreaker, Echo360RetryPolicy
+import argparse
+import ConfigParser
+import datetime
+import fnmatch
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+# The device methods polled by default (by Echo360Fleet, fleet.py and gateway.py)
+DEFAULT_COMMANDS = ('status_monitoring', 'status_system')
+
+def load_rooms(config_filename, pattern='*'):
+    # Return a list of rooms (dicts with room, uri, username, password and profile), one per
+    # '[capture room_name]' section whose room_name matches the glob 'pattern'.
+    config = ConfigParser.ConfigParser()
+    config.readfp(open(config_filename))
+    rooms = []
+    for section in config.sections():
+        if not section.startswith('capture '):
+            continue
+        room = section.split(' ', 1)[1]
+        if not fnmatch.fnmatch(room, pattern):
+            continue
+        rooms.append({
+            'room':     room,
+            'uri':      config.get(section, 'uri'),
+            'username': config.get(section, 'username'),
+            'password': config.get(section, 'password'),
+            'profile':  config.get(section, 'profile') if config.has_option(section, 'profile') else None,
+            })
+    return rooms
+
+
+class Echo360Job(object):
+    # A function call run by an Echo360WorkerPool. 'result' is the return value, or 'error' the
+    # exception, once done() is True.
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        with self._lock:
+            self._done.set()
+            listeners = self._listeners
+        for q in listeners:
+            q.put(self)
+
+    def add_listener(self, q):
+        # Put this job on the Queue 'q' when it is done (immediately if it is already done).
+        with self._lock:
+            if not self._done.is_set():
+                self._listeners.append(q)
+                return
+        q.put(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done()
+
+
+class Echo360WorkerPool(object):
+    # A bounded pool of worker threads. At most 'workers' jobs run at once, the rest wait in order.
+    # Workers are daemon threads so a device that never answers can't prevent the process exiting.
+    def __init__(self, workers=16):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def submit(self, fn, *args, **kwargs):
+        job = Echo360Job(fn, args, kwargs)
+        if len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        self._queue.put(job)
+        return job
+
+    def _worker(self):
+        while True:
+            self._queue.get().run()
+
+    def as_completed(self, jobs, timeout=None):
+        # Yield the jobs as they finish. Stops early (leaving jobs unfinished) after 'timeout' seconds.
+        q = Queue.Queue()
+        for job in jobs:
+            job.add_listener(q)
+        deadline = None if timeout is None else time.time() + timeout
+        for i in range(len(jobs)):
+            try:
+                if deadline is None:
+                    # a finite timeout keeps ctrl-c working in Python 2
+                    yield q.get(True, 365 * 24 * 3600)
+                else:
+                    yield q.get(True, max(0, deadline - time.time()))
+            except Queue.Empty:
+                return
+
+
+class Echo360Fleet(object):
+    # Concurrent poller for many capture devices.
+    # 'commands' are the Echo360CaptureDevice method names run against each room every cycle.
+    # Devices are created lazily (the connection test runs in a worker), using 'info_cache' if given.
+    # With an Echo360ResponseCache 'cache', status calls are shared with other users of the cache.
+    # With an Echo360Metrics 'metrics', request timings are recorded for each room.
+    # Failed requests are retried as the Echo360RetryPolicy 'retry' says. With a 'breaker_threshold' each room
+    # has an Echo360CircuitBreaker that opens after that many failures in a row; its state is in the results.
+    # With a 'thumbnails' directory, the monitoring images of each room with a capture in progress are
+    # downloaded (at most every thumbnail_interval seconds) to 'room_name-image_name.jpg' in the directory.
+    # With 'adaptive' each room is only polled when its Echo360PollScheduler says so (fast around
+    # scheduled starts and during captures, slowly when idle); rooms that are not due keep their last result.
+    def __init__(self, rooms, commands=DEFAULT_COMMANDS, workers=16, timeout=4,
+            device_timeout=5, info_cache=None, adaptive=False, cache=None, metrics=None, thumbnails=None,
+            thumbnail_interval=10, retry=None, breaker_threshold=None):
+        self.rooms = rooms
+        self.commands = commands
+        self.workers = Echo360WorkerPool(workers)
+        self.timeout = timeout
+        self.device_timeout = device_timeout
+        self.info_cache = info_cache
+        self.adaptive = adaptive
+        self.cache = cache
+        self.metrics = metrics
+        self.thumbnails = thumbnails
+        self.thumbnail_interval = thumbnail_interval
+        self._thumbnail_time = {}
+        self.retry = retry
+        self.breaker_threshold = breaker_threshold
+        self._breakers = {}
+        if metrics is not None:
+            for room in rooms:
+                metrics.names[room['uri']] = room['room']
+        self._devices = {}
+        self._jobs = {}
+        self._results = {}
+        self._result_jobs = {}      # room name -> the job whose result is in _results (under _lock)
+        self._schedulers = {}
+        self._next_poll = {}
+        self._soon = set()          # rooms poll_soon() asked for, without 'adaptive'
+        self._lock = threading.Lock()   # _devices, _breakers, _next_poll, _schedulers and _results (poll_room()
+                                        # runs in the workers, device() and poll_soon() in any thread)
+        self._wake = threading.Event()
+
+    def device(self, room):
+        # Return the Echo360CaptureDevice for 'room' (a dict from load_rooms()). A device is only kept once
+        # its connection test succeeds, so a failed test is repeated on the next call.
+        name = room['room']
+        with self._lock:
+            if name in self._devices:
+                return self._devices[name]
+            if self.breaker_threshold is not None and name not in self._breakers:
+                self._breakers[name] = Echo360CircuitBreaker(threshold=self.breaker_threshold)
+            device = Echo360CaptureDevice(room['uri'], room['username'], room['password'], timeout=self.timeout,
+                lazy=True, info_cache=self.info_cache, cache=self.cache, metrics=self.metrics, retry=self.retry,
+                breaker=self._breakers.get(name))
+        # (the connection test is a request to the device, so it runs without the lock)
+        if not device.connection_test.success():
+            return device
+        with self._lock:
+            # (another thread may have created one at the same time)
+            return self._devices.setdefault(name, device)
+
+    def poll_room(self, room, commands=None):
+        # Run each command against one room. Returns a dict with the room name, the elapsed time ('latency')
+        # and the response of each command (see Echo360CaptureDeviceResponse.as_dict()), with the time the
+        # command took as its 'latency'.
+        start = time.time()
+        result = {'room': room['room']}
+        device = self.device(room)
+        if not device.connection_test.success():
+            result['error'] = str(device.connection_test._result_code)
+            result['message'] = device.connection_test._result_message
+        else:
+            with self._lock:
+                scheduler = self._schedulers.get(room['room'])
+            if scheduler is not None and scheduler.schedule_stale():
+                scheduler.update_schedule(device.status_next_capture())
+            for command in commands or self.commands:
+                begin = time.time()
+                result[command] = getattr(device, command)().as_dict()
+                result[command]['latency'] = round(time.time() - begin, 3)
+            if self.thumbnails is not None and 'status_monitoring' in result:
+                self.fetch_thumbnails(room, device, result)
+        if device.breaker is not None:
+            result['breaker'] = device.breaker.as_dict()
+        result['latency'] = round(time.time() - start, 3)
+        if self.adaptive:
+            state = result.get('status_monitoring', {}).get('state')
+            with self._lock:
+                self._next_poll[room['room']] = time.time() + self._schedulers[room['room']].next_delay(state)
+        return result
+
+    def fetch_thumbnails(self, room, device, result):
+        # Download the monitoring images named in the status_monitoring result of a room, if it is time to.
+        # Each image is streamed to a temporary file that then replaces the last one, so a reader never sees
+        # a partial image. result['thumbnail_files'] is the list of files written.
+        name = room['room']
+        mon = result['status_monitoring']
+        if mon.get('state') not in ['active', 'paused'] or len(mon.get('thumbnails') or []) == 0:
+            return
+        if time.time() - self._thumbnail_time.get(name, 0) < self.thumbnail_interval:
+            return
+        self._thumbnail_time[name] = time.time()
+        result['thumbnail_files'] = []
+        for thumbnail in mon['thumbnails']:
+            filename = os.path.join(self.thumbnails, '{0}-{1}'.format(name, os.path.basename(thumbnail)))
+            temp = filename + '.part'
+            with open(temp, 'wb') as f:
+                response = device.monitoring_snapshot(thumbnail, out=f)
+            if response.success():
+                os.rename(temp, filename)
+                result['thumbnail_files'].append(filename)
+            else:
+                os.remove(temp)
+                result['thumbnail_error'] = '{0} {1}'.format(response._result_code, response._result_message)
+
+    def poll(self, commands=None, rooms=None):
+        # Poll all rooms concurrently and return one snapshot: {'time': ..., 'rooms': {room_name: {...}}}.
+        # Rooms still busy with a previous poll are not polled again until they answer. With a set of room
+        # names 'rooms' only those are polled; like rooms that are not due with 'adaptive', the others keep
+        # their last result.
+        start = time.time()
+        jobs = []
+        for room in self.rooms:
+            if rooms is not None and room['room'] not in rooms:
+                continue
+            if self.adaptive:
+                with self._lock:
+                    if self._next_poll.get(room['room'], 0) > start:
+                        continue
+                    self._schedulers.setdefault(room['room'], Echo360PollScheduler())
+            job = self._jobs.get(room['room'])
+            if job is None or job.done():
+                job = self.workers.submit(self.poll_room, room, commands)
+                self._jobs[room['room']] = job
+                jobs.append(job)
+        for job in self.workers.as_completed(jobs, self.device_timeout):
+            pass
+        snapshot = {
+            'time': datetime.datetime.utcfromtimestamp(start).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'rooms': {},
+            }
+        for room in self.rooms:
+            name = room['room']
+            job = self._jobs.get(name)
+            with self._lock:
+                last = self._results.get(name)
+                reported = job is not None and self._result_jobs.get(name) is job
+            if job is None or (job not in jobs and job.done() and reported):
+                # not due: the result of the last poll
+                snapshot['rooms'][name] = last
+            elif not job.done():
+                snapshot['rooms'][name] = {'room': name, 'error': 'timeout',
+                    'message': 'No response within {0} seconds.'.format(self.device_timeout)}
+            elif job.error is not None:
+                snapshot['rooms'][name] = {'room': name, 'error': 'unknown',
+                    'message': 'Unknown error: {0}'.format(repr(job.error))}
+            else:
+                # (also a job that timed out in an earlier cycle and has finished since)
+                snapshot['rooms'][name] = job.result
+            with self._lock:
+                self._results[name] = snapshot['rooms'][name]
+                if job is not None and job.done():
+                    self._result_jobs[name] = job
+        snapshot['elapsed'] = round(time.time() - start, 3)
+        return snapshot
+
+    def poll_soon(self, name):
+        # Poll room 'name' (fast, with 'adaptive') now, e.g. after a command was sent to it. Wakes up run(),
+        # which only polls that room (the others are polled when they are due).
+        with self._lock:
+            if name in self._schedulers:
+                self._schedulers[name].command_sent()
+            if self.adaptive:
+                self._next_poll[name] = 0
+            else:
+                self._soon.add(name)
+        self._wake.set()
+
+    def wait(self, seconds):
+        # Sleep between the cycles of run(), until poll_soon() is called
+        self._wake.wait(seconds)
+        self._wake.clear()
+
+    def run(self, interval=5, count=None, commands=None):
+        # Generator yielding one snapshot every 'interval' seconds ('count' times, or forever).
+        # With 'adaptive', a snapshot is taken whenever a room is due to be polled.
+        n = 0
+        while count is None or n < count:
+            start = time.time()
+            yield self.poll(commands)
+            n += 1
+            if count is None or n < count:
+                with self._lock:
+                    next_poll = min(self._next_poll.values()) if len(self._next_poll) > 0 else None
+                    # (rooms that are still busy are overdue, so wait at least the fastest poll interval)
+                    fast = min(scheduler.fast for scheduler in self._schedulers.values()) if self._schedulers else 0
+                if self.adaptive and next_poll is not None:
+                    self.wait(max(fast, next_poll - time.time()))
+                else:
+                    # (until the next cycle, a snapshot of the rooms poll_soon() asks for)
+                    while time.time() - start < interval:
+                        self.wait(interval - (time.time() - start))
+                        with self._lock:
+                            (soon, self._soon) = (self._soon, set())
+                        if len(soon) > 0 and time.time() - start < interval:
+                            yield self.poll(commands, soon)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device fleet poller',
+        )
+    parser.add_argument('--config', help='config file', default='echo360.config')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*")', default='*')
+    parser.add_argument('--command', help='device method to poll (repeatable, default {0})'.format(
+        ' and '.join(DEFAULT_COMMANDS)), action='append',
+        choices=['status_system', 'status_monitoring', 'status_captures', 'status_current_capture',
+            'status_next_capture', 'snapshot'])
+    parser.add_argument('--workers', help='concurrent device requests', default=16, type=int)
+    parser.add_argument('-t', '--timeout', help='HTTP timeout', default=4, type=int)
+    parser.add_argument('--device-timeout', help='per device time limit for each cycle (seconds)', default=5,
+        type=float)
+    parser.add_argument('--interval', help='seconds between cycles', default=5, type=float)
+    parser.add_argument('--count', help='number of cycles', default=1, type=int)
+    parser.add_argument('--adaptive', help='poll each room at a schedule aware, adaptive interval', action='store_true')
+    parser.add_argument('--retries', help='retries of a failed request (timeouts, network and 5xx errors)',
+        default=0, type=int)
+    parser.add_argument('--breaker', help='stop polling a room after this many failures in a row, until a probe '
+        'succeeds', default=None, type=int)
+    parser.add_argument('--record', help='record status_monitoring polls in this database (see recorder.py)',
+        default=None)
+    parser.add_argument('--thumbnails', help='save the monitoring images of active rooms in this directory',
+        default=None)
+    parser.add_argument('--thumbnail-interval', help='seconds between monitoring image downloads', default=10,
+        type=float)
+    parser.add_argument('--metrics-port', help='serve Prometheus metrics at http://host:port/metrics', default=None,
+        type=int)
+    parser.add_argument('--metrics-host', help="metrics listen address ('' for every interface)", default='127.0.0.1')
+    parser.add_argument('--cache', help='device information cache file (skips connection tests)', default=None)
+    parser.add_argument('--cache-ttl', help='device information cache lifetime (seconds)', default=24*3600, type=int)
+    args = parser.parse_args()
+
+    info_cache = None
+    if args.cache is not None:
+        info_cache = Echo360DeviceInfoCache(args.cache, args.cache_ttl)
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = Echo360Metrics()
+        metrics.serve(args.metrics_port, args.metrics_host)
+    fleet = Echo360Fleet(load_rooms(args.config, args.rooms), commands=args.command or DEFAULT_COMMANDS,
+        workers=args.workers, timeout=args.timeout, device_timeout=args.device_timeout, info_cache=info_cache,
+        adaptive=args.adaptive, metrics=metrics, thumbnails=args.thumbnails,
+        thumbnail_interval=args.thumbnail_interval, retry=Echo360RetryPolicy(args.retries),
+        breaker_threshold=args.breaker)
+    recorder = None
+    if args.record is not None:
+        recorder = Echo360Recorder(args.record)
+    try:    # catch ctrl-c
+        for snapshot in fleet.run(args.interval, args.count):
+            if recorder is not None:
+                recorder.record_snapshot(snapshot)
+            print(json.dumps(snapshot, sort_keys=True))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')
+    finally:
+        if recorder is not None:
+            recorder.close()
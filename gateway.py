@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+#
+# A caching HTTP gateway in front of the capture devices in echo360.config.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# One Echo360Fleet polls every device (once, however many clients there are) and the gateway serves the
+# latest results as JSON from memory. Each document is serialised once per poll, with an ETag: a client
+# sending If-None-Match with the current ETag gets '304 Not Modified'. Capture commands are passed through
+# to the device, and the room is polled again straight away.
+#
+#   GET  /rooms                                 every room: {'rooms': {room_name: {...}}}
+#   GET  /rooms/room_name                       one room (see Echo360Fleet.poll_room())
+#   GET  /rooms/room_name/status_monitoring     one response of a room (any --command)
+#   POST /rooms/room_name/capture/stop          a capture command: new_capture, confidence_monitor, pause,
+#                                               record, extend or stop. Arguments (duration, profile,
+#                                               description) in the query string or a JSON body.
+#
+# The X-Echo360-Time header has the time of the poll. Commands return the response of the device (see
+# Echo360CaptureDeviceResponse.as_dict()), with the status 200, or 502 if the device returned an error.
+#
+# Each change of the status_monitoring state of a room (inactive, waiting, active, paused, complete, a new
+# capture, or an error when the room can't be polled) is a transition event, so clients can wait for changes
+# instead of polling. Events have increasing ids and the last 'events' (default 1000) are kept to resume from:
+#
+#   GET  /events                                Server-Sent Events (text/event-stream) of every room, or
+#   GET  /rooms/room_name/events                of one room. A client that reconnects with Last-Event-ID
+#                                               (or ?since=id) gets the events it missed first.
+#   GET  /events?since=id&timeout=30            long-poll (a client not accepting text/event-stream): waits
+#                                               until there are events after 'id' (default: the latest) and
+#                                               returns {'events': [...], 'last_id': id}
+#
+# When events a client asked for are no longer kept (or the gateway was restarted) it gets 'missed' (a
+# 'missed' SSE event, or 'missed': true) with the current state of the rooms instead.
+#
+# Usage: python gateway.py --config echo360.config --port 8360 --adaptive
+#        curl -i http://localhost:8360/rooms/lt1/status_monitoring
+#        curl -X POST "http://localhost:8360/rooms/lt1/capture/extend?duration=600"
+#        curl -N -H "Accept: text/event-stream" http://localhost:8360/events
+
+from capture_device import Echo360DeviceInfoCache
+from fleet import DEFAULT_COMMANDS, Echo360Fleet, load_rooms
+from retry import Echo360RetryPolicy
+import argparse
+import BaseHTTPServer
+import collections
+import hashlib
+import json
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+def _without_latency(result):
+    # A copy of a fleet poll result (or command response) without its poll time
+    return dict((key, value) for (key, value) in result.items() if key != 'latency')
+
+class Echo360ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Echo360EventLog(object):
+    # The last 'size' events (dicts), with increasing ids. Thread safe: readers wait() for new events.
+    # Ids start at the time in milliseconds, so they keep increasing when the gateway is restarted.
+    def __init__(self, size=1000):
+        self.size = size
+        self.last_id = int(time.time() * 1000)
+        self._events = collections.deque(maxlen=size)
+        self._condition = threading.Condition()
+
+    def append(self, event):
+        # Add an event (its 'id' is set) and wake up the readers
+        with self._condition:
+            self.last_id += 1
+            event['id'] = self.last_id
+            self._events.append(event)
+            self._condition.notify_all()
+        return event
+
+    def since(self, id, rooms=None):
+        # (events after 'id' of 'rooms' (default: all), missed): 'missed' is True if some events after 'id'
+        # are no longer kept, or 'id' is not one of ours
+        with self._condition:
+            first = self._events[0]['id'] if len(self._events) > 0 else self.last_id + 1
+            missed = id < first - 1 or id > self.last_id
+            events = [event for event in self._events if event['id'] > id and (rooms is None or event['room'] in rooms)]
+            return (events, missed)
+
+    def wait(self, id, timeout, rooms=None):
+        # since(), waiting up to 'timeout' seconds for an event after 'id' of 'rooms'
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                (events, missed) = self.since(id, rooms)
+                remaining = deadline - time.time()
+                if len(events) > 0 or missed or remaining <= 0:
+                    return (events, missed)
+                self._condition.wait(remaining)
+
+
+class Echo360Gateway(object):
+    # Serves the results of 'fleet' (an Echo360Fleet). With 'control' False, commands are refused (403).
+    # Capture commands: name -> (Echo360CaptureDevice method, argument names)
+    COMMANDS = {
+        'new_capture':          ('capture_new_capture', ['duration', 'profile', 'description']),
+        'confidence_monitor':   ('capture_confidence_monitor', ['duration', 'profile', 'description']),
+        'pause':                ('capture_pause', []),
+        'record':               ('capture_record', []),
+        'extend':               ('capture_extend', ['duration']),
+        'stop':                 ('capture_stop', []),
+        }
+
+    def __init__(self, fleet, interval=5, control=True, events=1000):
+        self.fleet = fleet
+        self.interval = interval
+        self.control = control
+        self.rooms = dict((room['room'], room) for room in fleet.rooms)
+        self.snapshot = None
+        self.events = Echo360EventLog(events)
+        self._documents = {}    # path -> (ETag, JSON), replaced (not changed) by update()
+        self._states = {}       # room name -> (transition key, its last transition event)
+        self._lock = threading.Lock()   # _states (updated by the poller, read by the HTTP threads)
+
+    def document(self, path):
+        # (ETag, JSON) of a GET path, or None
+        return self._documents.get(path)
+
+    def update(self, snapshot):
+        # Serialise the documents of a fleet snapshot. The poll times are left out of the documents (they are
+        # in X-Echo360-Time), so the ETag of a room only changes when its status does.
+        documents = {}
+        rooms = {}
+        for (name, result) in snapshot['rooms'].items():
+            result = _without_latency(result or {})
+            for (key, value) in result.items():
+                if isinstance(value, dict):
+                    result[key] = _without_latency(value)
+            rooms[name] = result
+            documents['/rooms/' + name] = self._document(result)
+            for (key, value) in result.items():
+                if isinstance(value, dict):
+                    documents['/rooms/{0}/{1}'.format(name, key)] = self._document(value)
+        documents['/rooms'] = self._document({'rooms': rooms})
+        self.snapshot = snapshot
+        self._documents = documents
+        for name in sorted(rooms):
+            self.transition(name, rooms[name], snapshot['time'])
+
+    def transition(self, name, result, at):
+        # Add a transition event if the state of room 'name' changed. Like Echo360StatusStream, a new capture
+        # (start time) is a change but its duration is not.
+        monitoring = result.get('status_monitoring')
+        event = {'room': name, 'time': at}
+        if monitoring is not None and monitoring.get('result_code') == 'success':
+            event['state'] = monitoring.get('state')
+            for key in ['start_time', 'start_time_local', 'duration', 'confidence_monitoring']:
+                if monitoring.get(key) is not None:
+                    event[key] = monitoring[key]
+            key = (event['state'], event.get('start_time'))
+        elif monitoring is not None or 'error' in result:
+            event['state'] = 'error'
+            event['error'] = monitoring['result_code'] if monitoring is not None else result['error']
+            event['message'] = monitoring['result_message'] if monitoring is not None else result.get('message')
+            key = ('error', event['error'])
+        else:
+            return None     # (not polling status_monitoring)
+        with self._lock:
+            (last_key, last_event) = self._states.get(name, (None, None))
+            if key == last_key:
+                return None
+            event['previous'] = last_event['state'] if last_event is not None else None
+            # (the state first: a reader that takes events.last_id and then states() doesn't miss the event)
+            self._states[name] = (key, event)
+        return self.events.append(event)
+
+    def states(self, rooms=None):
+        # The last transition event of each room in 'rooms' (default: all)
+        with self._lock:
+            states = self._states.items()
+        return dict((name, event) for (name, (key, event)) in states if rooms is None or name in rooms)
+
+    def _document(self, value):
+        data = json.dumps(value, sort_keys=True, default=str)
+        return ('"{0}"'.format(hashlib.sha1(data).hexdigest()[:20]), data)
+
+    def command(self, name, command, args):
+        # Send a capture command to room 'name'. Returns (HTTP status, JSON-able result).
+        if not self.control:
+            return (403, {'error': 'Commands are disabled.'})
+        if name not in self.rooms:
+            return (404, {'error': 'No room {0}.'.format(name)})
+        if command not in self.COMMANDS:
+            return (404, {'error': 'No command {0}.'.format(command)})
+        if not isinstance(args, dict):
+            return (400, {'error': 'The arguments must be a JSON object.'})
+        (method, names) = self.COMMANDS[command]
+        room = self.rooms[name]
+        values = {'duration': 3600, 'profile': room.get('profile'), 'description': 'gateway.py'}
+        if command == 'extend':
+            values['duration'] = 600
+        values.update(args)
+        try:
+            arguments = [int(values[arg]) if arg == 'duration' else values[arg] for arg in names]
+        except (TypeError, ValueError):
+            return (400, {'error': 'The duration must be a number of seconds.'})
+        device = self.fleet.device(room)
+        if not device.connection_test.success():
+            response = device.connection_test
+        else:
+            response = getattr(device, method)(*arguments)
+            self.fleet.poll_soon(name)
+        return (200 if response.success() else 502, response.as_dict())
+
+    def poll(self):
+        # Thread - poll the fleet forever
+        for snapshot in self.fleet.run(self.interval):
+            self.update(snapshot)
+
+    def start(self):
+        t = threading.Thread(target=self.poll)
+        t.daemon = True
+        t.start()
+
+    def serve(self, port, host='127.0.0.1'):
+        # Serve from a thread per connection. Returns the HTTP server (call serve_forever() or shutdown()).
+        return Echo360ThreadingHTTPServer((host, port), self.handler())
+
+    def handler(self):
+        gateway = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # one write per response (flushed by handle_one_request()), sent at once: BaseHTTPServer writes
+            # each header line separately, which with keep-alive waits for the client's delayed ACK
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                path = url.path.rstrip('/')
+                parts = path.strip('/').split('/')
+                if path == '/events' or (len(parts) == 3 and parts[0] == 'rooms' and parts[2] == 'events'):
+                    self.send_events(None if path == '/events' else [parts[1]], urlparse.parse_qs(url.query))
+                    return
+                document = gateway.document(path)
+                if document is None:
+                    self.send_json(404, {'error': 'Not found.'} if gateway.snapshot is not None else
+                        {'error': 'Not polled yet.'})
+                    return
+                (etag, data) = document
+                if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_data(200, data, etag)
+
+            def do_POST(self):
+                url = urlparse.urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if len(parts) != 4 or parts[0] != 'rooms' or parts[2] != 'capture':
+                    self.send_json(404, {'error': 'Not found.'})
+                    return
+                args = dict((name, values[-1]) for (name, values) in urlparse.parse_qs(url.query).items())
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > 0:
+                    try:
+                        body = json.loads(self.rfile.read(length))
+                    except ValueError:
+                        body = None
+                    if not isinstance(body, dict):
+                        self.send_json(400, {'error': 'The body must be a JSON object.'})
+                        return
+                    args.update(body)
+                (status, result) = gateway.command(parts[1], parts[3], args)
+                self.send_json(status, result)
+
+            def send_events(self, rooms, query):
+                if rooms is not None and rooms[0] not in gateway.rooms:
+                    self.send_json(404, {'error': 'No room {0}.'.format(rooms[0])})
+                    return
+                try:
+                    since = query.get('since', [self.headers.get('Last-Event-ID')])[-1]
+                    since = gateway.events.last_id if since in [None, ''] else int(since)
+                    timeout = min(float(query.get('timeout', [30])[-1]), 300)
+                except ValueError:
+                    self.send_json(400, {'error': 'The event id and timeout must be numbers.'})
+                    return
+                if 'text/event-stream' in self.headers.get('Accept', ''):
+                    self.send_stream(rooms, since)
+                    return
+                # long-poll
+                (events, missed) = gateway.events.wait(since, timeout, rooms)
+                result = {'events': events, 'last_id': events[-1]['id'] if len(events) > 0 else since}
+                if missed:
+                    result['last_id'] = gateway.events.last_id
+                    result['missed'] = True
+                    result['states'] = gateway.states(rooms)
+                self.send_json(200, result)
+
+            def send_stream(self, rooms, since):
+                # Server-Sent Events until the client disconnects, with a comment every 15 seconds to keep
+                # the connection (and proxies) open
+                self.close_connection = True
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                try:
+                    self.wfile.write('retry: {0}\n\n'.format(int(gateway.interval * 1000)))
+                    self.wfile.flush()
+                    while True:
+                        (events, missed) = gateway.events.wait(since, 15, rooms)
+                        if missed:
+                            since = gateway.events.last_id
+                            self.write_event(since, 'missed', {'states': gateway.states(rooms)})
+                        for event in events:
+                            since = event['id']
+                            self.write_event(since, 'transition', event)
+                        if not missed and len(events) == 0:
+                            self.wfile.write(': keep-alive\n\n')
+                        self.wfile.flush()
+                except socket.error:
+                    pass    # disconnected
+
+            def write_event(self, id, name, value):
+                self.wfile.write('id: {0}\nevent: {1}\ndata: {2}\n\n'.format(id, name,
+                    json.dumps(value, sort_keys=True, default=str)))
+
+            def send_json(self, status, value):
+                self.send_data(status, json.dumps(value, sort_keys=True, default=str))
+
+            def send_data(self, status, data, etag=None):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Cache-Control', 'no-cache')
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                if gateway.snapshot is not None:
+                    self.send_header('X-Echo360-Time', gateway.snapshot['time'])
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device caching gateway',
+        )
+    parser.add_argument('--config', help='config file', default='echo360.config')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*")', default='*')
+    parser.add_argument('--host', help='listen address', default='127.0.0.1')
+    parser.add_argument('--port', help='listen port', default=8360, type=int)
+    parser.add_argument('--command', help='device method to poll (repeatable, default {0})'.format(
+        ' and '.join(DEFAULT_COMMANDS)), action='append', choices=['status_system', 'status_monitoring', 'status_captures',
+        'status_current_capture', 'status_next_capture'])
+    parser.add_argument('--read-only', help='refuse capture commands', action='store_true')
+    parser.add_argument('--events', help='transition events kept for clients to resume from', default=1000,
+        type=int)
+    parser.add_argument('--workers', help='concurrent device requests', default=16, type=int)
+    parser.add_argument('-t', '--timeout', help='HTTP timeout', default=4, type=int)
+    parser.add_argument('--device-timeout', help='per device time limit for each cycle (seconds)', default=5,
+        type=float)
+    parser.add_argument('--interval', help='seconds between polls', default=5, type=float)
+    parser.add_argument('--adaptive', help='poll each room at a schedule aware, adaptive interval', action='store_true')
+    parser.add_argument('--retries', help='retries of a failed request (timeouts, network and 5xx errors)',
+        default=2, type=int)
+    parser.add_argument('--breaker', help='stop polling a room after this many failures in a row, until a probe '
+        'succeeds', default=5, type=int)
+    parser.add_argument('--cache', help='device information cache file (skips connection tests)', default=None)
+    parser.add_argument('--cache-ttl', help='device information cache lifetime (seconds)', default=24*3600, type=int)
+    args = parser.parse_args()
+
+    info_cache = None
+    if args.cache is not None:
+        info_cache = Echo360DeviceInfoCache(args.cache, args.cache_ttl)
+    fleet = Echo360Fleet(load_rooms(args.config, args.rooms),
+        commands=args.command or DEFAULT_COMMANDS, workers=args.workers, timeout=args.timeout,
+        device_timeout=args.device_timeout, info_cache=info_cache, adaptive=args.adaptive,
+        retry=Echo360RetryPolicy(retries=args.retries), breaker_threshold=args.breaker)
+    gateway = Echo360Gateway(fleet, interval=args.interval, control=not args.read_only, events=args.events)
+    gateway.start()
+    server = gateway.serve(args.port, args.host)
+    print('Serving {0} rooms at http://{1}:{2}/rooms'.format(len(fleet.rooms), args.host, args.port))
+    sys.stdout.flush()
+    try:    # catch ctrl-c
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Request latency histograms and response counts for capture devices, in the Prometheus text format.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Pass an Echo360Metrics to Echo360CaptureDevice (metrics=...) to record, for each device and endpoint,
+# the time taken by each phase of a request:
+#   connect: TCP connect (new connections only)
+#   tls:     TLS handshake (new https connections only)
+#   ttfb:    request sent to response headers received
+#   body:    response body read
+#   parse:   XML parse
+#   total:   the whole call_api() call
+# and the number of responses by HTTP status, and of failed requests by error ('timeout', 'socket-61', ...).
+#
+#     metrics = Echo360Metrics()
+#     metrics.serve(9360)     # http://localhost:9360/metrics (host='' for other machines)
+#     device = Echo360CaptureDevice(server, username, password, metrics=metrics)
+
+import BaseHTTPServer
+import bisect
+import threading
+
+# Histogram bucket upper bounds (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASES = ('connect', 'tls', 'ttfb', 'body', 'parse', 'total')
+
+def endpoint(command):
+    # The endpoint of an API command, without the variable parts
+    # (e.g. 'log-list-last-count/10' -> 'log-list-last-count', 'diagnostics/ping/host' -> 'diagnostics/ping').
+    parts = command.strip('/').split('/')
+    if parts[0] == 'log-list-last-count':
+        return parts[0]
+    if parts[0] == 'monitoring':
+        return 'monitoring'
+    if parts[:2] in [['diagnostics', 'ping'], ['diagnostics', 'traceroute']]:
+        return '/'.join(parts[:2])
+    if parts[:2] == ['diagnostics', 'recovery'] and parts[-1] == 'upload':
+        return 'diagnostics/recovery/upload'
+    return '/'.join(parts)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Echo360Metrics(object):
+    # Thread safe. Devices are labelled with their server URL, or the name in 'names' (server URL -> name,
+    # e.g. the room name).
+    def __init__(self, names=None):
+        self.names = names or {}
+        self._lock = threading.Lock()
+        self._histograms = {}   # (device, endpoint, phase) -> [bucket counts..., +Inf count, sum]
+        self._responses = {}    # (device, endpoint, status) -> count
+        self._errors = {}       # (device, endpoint, error) -> count
+
+    def observe(self, server, command, phase, seconds):
+        key = (self.names.get(server, server), endpoint(command), phase)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def count(self, server, command, status):
+        # Count a response: an HTTP status (int), or an error (e.g. 'timeout', see request_error()).
+        counts = self._responses if isinstance(status, int) else self._errors
+        key = (self.names.get(server, server), endpoint(command), str(status))
+        with self._lock:
+            counts[key] = counts.get(key, 0) + 1
+
+    def exposition(self):
+        # The metrics in the Prometheus text format (version 0.0.4).
+        with self._lock:
+            histograms = sorted((key, list(value)) for (key, value) in self._histograms.items())
+            responses = sorted(self._responses.items())
+            errors = sorted(self._errors.items())
+        lines = [
+            '# HELP echo360_request_phase_seconds Capture device API request time by phase.',
+            '# TYPE echo360_request_phase_seconds histogram',
+            ]
+        for ((device, command, phase), histogram) in histograms:
+            labels = 'device="{0}",endpoint="{1}",phase="{2}"'.format(_label(device), _label(command), phase)
+            total = 0
+            for (i, bound) in enumerate(BUCKETS):
+                total += histogram[i]
+                lines.append('echo360_request_phase_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, total))
+            total += histogram[len(BUCKETS)]
+            lines.append('echo360_request_phase_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, total))
+            lines.append('echo360_request_phase_seconds_sum{{{0}}} {1:.6f}'.format(labels, histogram[-1]))
+            lines.append('echo360_request_phase_seconds_count{{{0}}} {1}'.format(labels, total))
+        lines.append('# HELP echo360_responses_total Capture device API responses by HTTP status.')
+        lines.append('# TYPE echo360_responses_total counter')
+        for ((device, command, status), count) in responses:
+            lines.append('echo360_responses_total{{device="{0}",endpoint="{1}",status="{2}"}} {3}'.format(
+                _label(device), _label(command), status, count))
+        lines.append('# HELP echo360_request_errors_total Capture device API requests that failed, by error.')
+        lines.append('# TYPE echo360_request_errors_total counter')
+        for ((device, command, error), count) in errors:
+            lines.append('echo360_request_errors_total{{device="{0}",endpoint="{1}",error="{2}"}} {3}'.format(
+                _label(device), _label(command), _label(error), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        # Serve the metrics at http://host:port/metrics from a daemon thread. Returns the HTTP server. Only
+        # local clients can connect by default; host '' (or an interface address) exposes the metrics (the
+        # device names and URLs) to the network.
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
@@ -2,44 +2,36 @@
 
 # A proof of concept script.
 # Works from an OS/X terminal window or a Raspberry Pi (optionally with an Adafruit 2x16 LCD).
+# Monitors and controls one or more rooms from one process: each room has its own state machine, command
+# queue and output, all run by one Echo360EventLoop (see capture_device_async.py).
 # Usage: sudo nohup python echo360/monitor.py room_name &
+#        python monitor.py --rooms "lt*"
+# Commands are read from stdin: a character (for the first room), or 'room_name character'.
+# SIGHUP re-reads the config file and restarts the rooms; SIGTERM and ctrl-c stop cleanly.
 
-from capture_device import Echo360CaptureDevice
+from buttons import Echo360Buttons
+from capture_device_async import AsyncEcho360CaptureDevice, Echo360EventLoop, Echo360Future, Echo360Queue
+from polling import Echo360PollScheduler
+from metrics import Echo360Metrics
+from recorder import Echo360Recorder
+from retry import Echo360CircuitBreaker, Echo360RetryPolicy
+import argparse
 import ConfigParser
 import datetime
-import os
-import socket
+import fnmatch
+import logging
+import signal
 import sys
-import thread
+import threading
 import time
-import urlparse
 
-class DieselCaptureDevice(Echo360CaptureDevice):
-    # use the Diesel HTTP methods so we can run in a simple loop.
-    def __init__(self, server, username, password, debuglevel=None, timeout=10):
-        Echo360CaptureDevice.__init__(self, server, username, password, debuglevel, timeout)
+COMMANDS = ['a', 'b', 'c', 't', 's']
 
-    def request(self, method, path, headers=None, body=None, timeout=None):
-        url = urlparse.urlparse(urlparse.urljoin(self.server, path))
-        try:
-            if url.scheme == 'https':
-                client = diesel.protocols.http.HttpsClient(url.hostname, url.port or 443, timeout=timeout)
-            elif url.scheme == 'http':
-                client = diesel.protocols.http.HttpClient(url.hostname, url.port or 80, timeout=timeout)
-            resp = client.request(method, url.path, headers, body, timeout)
-        except Exception as e:
-            # the following error popped up on a Sunday after the device was inactive for 3 days:
-            # SysCallError: (-1, 'Unexpected EOF')
-            return('unknown', 'Unknown error: {0}'.format(repr(e)), {}, None)
-        (status, reason) = resp.status.split(' ', 1)
-        return (int(status), reason, resp.headers, resp.response[0])
-
-def local_time_now(format='%Y-%m-%d %H:%M'):
-    # return the local time
+def local_time_now(utc_offset, format='%Y-%m-%d %H:%M'):
+    # return the local time of a device
     ts_struct_time = time.gmtime()
     ts_datetime = datetime.datetime.fromtimestamp(time.mktime(ts_struct_time)) + \
-        datetime.timedelta(minutes = int(device.connection_test.utc_offset))
-        #datetime.timedelta(minutes = 600)
+        datetime.timedelta(minutes = int(utc_offset))
     return ts_datetime.strftime(format)
 
 def state_machine(current, char):
@@ -58,162 +50,309 @@ def state_machine(current, char):
     else:
         return None
 
-# Diesel loop - process command_queue
-def device_command():
-    global current_state
-    while True:
-        c = command_queue.get()
-        if device is None:
-            log.info('No Device for command: ' + c)
-        else:
-            log.info('Device command: ' + c)
-            # No extend command?
-            if c == 'start':
-                #record for 90 minutes.
-                name = 'Lecture Capture {0} {1}'.format(local_time_now(), capture_location)
-                log.info('Name={0}'.format(name))
-                # record for 90 minutes
-                resp = device.capture_new_capture(60*90, capture_profile, name)
-                #print str(resp)
-            elif c == 'pause':
-                resp = device.capture_pause()
-            elif c == 'extend':
-                # extend by 10 minutes
-                resp = device.capture_extend(60*10)
-                # extend doesn't change the state so we clear the current state to 
-                # force it to be updated in the next status check
-                current_state = 'Extended'
-            elif c == 'resume':
-                resp = device.capture_record()
-            elif c == 'stop':
-                resp = device.capture_stop()
-            if not resp.success():
-                log.warning(str(resp))
-
-# Diesel loop - process output_queue
-def text_output():
-    while True:
-        message = output_queue.get()
-        log.info(message)
-        if lcd is not None:
-            lcd.clear()
-            lcd.message('Echo360: {0}\n{1}'.format(capture_location, message))
-
-# Diesel loop - process each command character
-def execute_command():
-    while True:
-        char = command_char_queue.get()
-        log.info('Execute user command: {0}'.format(char))
+
+class Echo360RoomMonitor(object):
+    # One room: polls the device status at an adaptive interval (see Echo360PollScheduler), turns command
+    # characters into device commands through state_machine(), and sends messages to output(message).
+    # current_state is a device state, or Unknown, Extended, Error, No connection or Exception.
+    # start() and stop() run and cancel the room's coroutines on the loop.
+    def __init__(self, loop, room, device, profile, output, recorder=None):
+        self.loop = loop
+        self.room = room
+        self.device = device
+        self.profile = profile
+        self.output = output
+        self.recorder = recorder
+        self.log = logging.getLogger('monitor.' + room)
+        self.current_state = 'Unknown'
+        self.scheduler = Echo360PollScheduler()
+        self.commands = Echo360Queue(loop)
+        self.sending = False
+        self._tasks = []
+        self._wake = None
+        self._timer = None
+
+    def start(self):
+        self.current_state = 'Unknown'
+        self._tasks = [self.loop.spawn(self.monitor()), self.loop.spawn(self.run_commands())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def busy(self):
+        # True while a command is queued or being sent to the device
+        return self.sending or len(self.commands) > 0
+
+    def execute(self, char):
+        # process a command character
+        self.log.info('Execute user command: {0}'.format(char))
         if char == 't':
-            output_queue.put('Test command')
+            self.output('Test command')
         elif char == 's':
-            output_queue.put('State: ' + current_state)
+            self.output('State: ' + self.current_state)
         else:
-            next = state_machine(current_state, char)
+            next = state_machine(self.current_state, char)
             if next is None:
-                log.info('State remains {0}'.format(current_state))
+                self.log.info('State remains {0}'.format(self.current_state))
             else:
-                log.info('Change state to {0}'.format(next))
-                diesel.fork_from_thread(output_queue.put, 'Command: ' + next)
-                diesel.fork_from_thread(command_queue.put, next)                
+                self.log.info('Change state to {0}'.format(next))
+                self.output('Command: ' + next)
+                self.commands.put(next)
 
-# Diesel thread - read characters from the command line
-def read_line_thread():
-    try:
-        log.info('Commands: a=start/extend; b=pause/resume; c=stop')
+    def run_commands(self):
+        # Coroutine - send the commands in the command queue to the device, one at a time
         while True:
-            char = raw_input()
-            if char in ['a', 'b', 'c','t', 's']:
-                diesel.fork_from_thread(command_char_queue.put, char) 
-            else:
-                log.info('Ignored invalid command.')
-    except:
-        log.info('No command line input. Probably running as a daemon.')
-
-# Diesel loop - loops on LCD button pressed + 0.15 seconds
-def read_button():
-    if lcd is None:
-        return
-    log.info('Ready for LCD button')
-    # Poll buttons and translate to a command
-    btn = ((lcd.LEFT  , 'b'),
-           (lcd.UP    , 't'),
-           (lcd.DOWN  , 's'),
-           (lcd.RIGHT , 'c'),
-           (lcd.SELECT, 'a'))
-    while True:
-        prev = -1
-        for b in btn:
-            if lcd.buttonPressed(b[0]):
-                if b is not prev:
-                    diesel.fork_from_thread(command_char_queue.put, (b[1]))
-                    prev = b
-        diesel.sleep(0.15)
-
-# Diesel loop - poll device status every 0.25 seconds (or 60 seconds after 10 errors)
-# current_state is a bit of a hack. It can be a device state, Extended, Error,  No connection, Exception.
-def state_change_monitor():
-    global device
-    global current_state
-    log.info('starting state change monitor for {0} user {1}'.format(device_uri, device_username))
-    # Try to recover from errors
-    while True:
-        try:
-            device = DieselCaptureDevice(device_uri, device_username, device_password, timeout=timeout)
-            if device.connection_test.success():
-                # current_state = None
-                error_count = 0
-                while True:
-                    mon = device.status_monitoring()
+            c = yield self.commands.get()
+            if self.device.connection_test is None or not self.device.connection_test.success():
+                self.log.info('No Device for command: ' + c)
+                continue
+            self.log.info('Device command: ' + c)
+            self.sending = True
+            try:
+                if c == 'start':
+                    name = 'Lecture Capture {0} {1}'.format(local_time_now(self.device.utc_offset), self.room)
+                    self.log.info('Name={0}'.format(name))
+                    # record for 90 minutes
+                    resp = yield self.device.capture_new_capture(60*90, self.profile, name)
+                elif c == 'pause':
+                    resp = yield self.device.capture_pause()
+                elif c == 'extend':
+                    # extend by 10 minutes
+                    resp = yield self.device.capture_extend(60*10)
+                    # extend doesn't change the state so we clear the current state to
+                    # force it to be updated in the next status check
+                    self.current_state = 'Extended'
+                elif c == 'resume':
+                    resp = yield self.device.capture_record()
+                elif c == 'stop':
+                    resp = yield self.device.capture_stop()
+                if not resp.success():
+                    self.log.warning(str(resp))
+            except Exception as e:
+                # (keep sending later commands, and don't leave the buttons busy)
+                self.log.warning('Device command {0} failed: {1}'.format(c, repr(e)))
+            finally:
+                self.sending = False
+            # poll fast (starting now) to pick up the state change
+            self.scheduler.command_sent()
+            self.poll_now()
+
+    def monitor(self):
+        # Coroutine - poll the device status: every 0.25 seconds around scheduled starts, after a command and
+        # while waiting or active, backing off when idle. Errors are retried by the device (see retry.py);
+        # while its circuit breaker is open the polls wait for the breaker's next probe.
+        self.log.info('starting state change monitor for {0} user {1}'.format(self.device.server,
+            self.device.username))
+        while True:
+            state = None
+            try:
+                if self.device.connection_test is None or not self.device.connection_test.success():
+                    # (the connection test gives the device utc_offset)
+                    yield self.device.test_connection()
+                if not self.device.connection_test.success():
+                    self.log.warning('Connection not established: {0}'.format(str(self.device.connection_test)))
+                    self.set_state('No connection')
+                else:
+                    if self.scheduler.schedule_stale():
+                        self.scheduler.update_schedule((yield self.device.status_next_capture()))
+                    start = time.time()
+                    mon = yield self.device.status_monitoring()
+                    if self.recorder is not None:
+                        self.recorder.record_response(self.room, mon, time.time() - start, start)
                     if mon.success():
                         state = mon.state
-                        if state != current_state:
-                            current_state = state
-                            output_queue.put('State: ' + current_state)
+                        self.set_state(state, 'State: ')
                     else:
-                        log.warning('Monitoring error: ' + str(mon))
-                        current_state = 'Error'
-                        error_count += 1
-                        if error_count > 9:
-                            log.warning('Too many errors. Retry in 60 seconds.')
-                            break
-                    diesel.sleep(0.25)
-            else:
-                log.warning('Connection not established: {0}. Retry in 60 seconds.'.format(str(device.connection_test._result_code)))
-                current_state = 'No connection'
-                diesel.fork_from_thread(output_queue.put, current_state)
-        except socket.timeout as e:
-            device = None
-            log.info('network timeout connecting to {0} as {1}. Retry in 60 seconds.'.format(device_uri, device_username))
-            current_state = 'Exception'
-            diesel.fork_from_thread(output_queue.put, current_state)
+                        self.log.warning('Monitoring error: ' + str(mon))
+                        self.set_state('Error')
+            except Exception as e:
+                self.log.info('Unknown error: {0}'.format(repr(e)))
+                self.set_state('Exception')
+            delay = self.scheduler.next_delay(state)
+            if self.device.breaker is not None and self.device.breaker.state == 'open':
+                delay = max(delay, self.device.breaker.retry_in())
+            # sleep, unless a command wakes us up
+            yield self.sleep(delay)
+
+    def set_state(self, state, prefix=''):
+        if state != self.current_state:
+            self.current_state = state
+            self.output(prefix + state)
+
+    def sleep(self, delay):
+        # A future that is done after 'delay' seconds, or sooner if poll_now() is called.
+        self._wake = Echo360Future(self.loop)
+        self._timer = self.loop.call_later(delay, self._wake.set_result, None)
+        return self._wake
+
+    def poll_now(self):
+        if self._wake is not None:
+            self._timer.cancel()
+            self._wake.set_result(None)
+
+
+class Echo360MonitorService(object):
+    # The rooms (names or globs of '[capture room_name]' sections of the config file) monitored by one
+    # process, on one event loop. Optional options of a room section:
+    #   record = echo360-%%Y-%%m.sqlite     record every poll (see recorder.py; rooms may share a file)
+    #   metrics_port = 9360                 serve Prometheus metrics for all rooms (see metrics.py)
+    #   metrics_host = 0.0.0.0              ... to other machines too (default 127.0.0.1, local only)
+    # Messages of the first room are also shown on the LCD, and its buttons send commands to it.
+    def __init__(self, config_filename, rooms, lcd=None, timeout=5):
+        self.config_filename = config_filename
+        self.patterns = rooms
+        self.lcd = lcd
+        self.timeout = timeout
+        self.loop = Echo360EventLoop()
+        self.log = logging.getLogger('monitor')
+        self.rooms = []
+        self.recorders = {}
+        self.metrics = None
+        self._metrics_server = None
+        self.buttons = None
+
+    def load(self):
+        # (Re)read the config file and create the rooms.
+        config = ConfigParser.ConfigParser()
+        config.readfp(open(self.config_filename))
+        names = [section.split(' ', 1)[1] for section in config.sections() if section.startswith('capture ')]
+        self.rooms = []
+        for name in names:
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                continue
+            section = 'capture ' + name
+            uri = config.get(section, 'uri')
+            recorder = None
+            if config.has_option(section, 'record'):
+                # optional recording of every poll (see recorder.py)
+                filename = config.get(section, 'record')
+                if filename not in self.recorders:
+                    self.recorders[filename] = Echo360Recorder(filename)
+                recorder = self.recorders[filename]
+            if config.has_option(section, 'metrics_port') and self.metrics is None:
+                # optional Prometheus metrics (see metrics.py)
+                self.metrics = Echo360Metrics()
+                host = '127.0.0.1'
+                if config.has_option(section, 'metrics_host'):
+                    host = config.get(section, 'metrics_host')
+                self._metrics_server = self.metrics.serve(config.getint(section, 'metrics_port'), host)
+            if self.metrics is not None:
+                self.metrics.names[uri] = name
+            device = AsyncEcho360CaptureDevice(uri, config.get(section, 'username'), config.get(section, 'password'),
+                timeout=self.timeout, loop=self.loop, metrics=self.metrics, retry=Echo360RetryPolicy(retries=2),
+                breaker=Echo360CircuitBreaker(threshold=5))
+            output = self.make_output(name, lcd=len(self.rooms) == 0 and self.lcd is not None)
+            self.rooms.append(Echo360RoomMonitor(self.loop, name, device, config.get(section, 'profile'), output,
+                recorder))
+        if len(self.rooms) == 0:
+            self.log.warning('No rooms match {0} in {1}'.format(' '.join(self.patterns), self.config_filename))
+
+    def make_output(self, name, lcd=False):
+        # The output sink of a room: the log, and the LCD for the first room
+        log = logging.getLogger('monitor.' + name)
+        def output(message):
+            log.info('Message: ' + message)
+            if lcd:
+                self.lcd.clear()
+                self.lcd.message('Echo360: {0}\n{1}'.format(name, message))
+        return output
+
+    def start(self):
+        for room in self.rooms:
+            room.start()
+        if self.lcd is not None and len(self.rooms) > 0:
+            # the LCD buttons send commands to the first room, except while it is sending one (see buttons.py)
+            room = self.rooms[0]
+            self.log.info('Ready for LCD button')
+            self.buttons = Echo360Buttons(self.loop, self.lcd,
+                [(self.lcd.LEFT, 'b'), (self.lcd.UP, 't'), (self.lcd.DOWN, 's'), (self.lcd.RIGHT, 'c'),
+                (self.lcd.SELECT, 'a')], room.execute, busy=room.busy)
+            self.buttons.start()
+
+    def stop(self):
+        # Cancel the rooms' coroutines and their requests, close their connections and flush the recordings.
+        for room in self.rooms:
+            room.stop()
+            room.device.close()
+        if self.buttons is not None:
+            self.buttons.stop()
+            self.buttons = None
+        for recorder in self.recorders.values():
+            recorder.close()
+
+    def restart(self):
+        self.log.info('Restarting')
+        self.stop()
+        self.recorders = {}
+        self.load()
+        self.start()
+
+    def shutdown(self):
+        self.log.info('Stopping')
+        self.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+        self.loop.stop()
+
+    def command(self, line):
+        # A command line from stdin: 'character' for the first room, or 'room_name character'.
+        parts = line.split()
+        if len(parts) == 1 and len(self.rooms) > 0:
+            (room, char) = (self.rooms[0], parts[0])
+        elif len(parts) == 2:
+            room = ([room for room in self.rooms if room.room == parts[0]] + [None])[0]
+            char = parts[1]
+        else:
+            room = None
+        if room is None or char not in COMMANDS:
+            self.log.info('Ignored invalid command.')
+            return
+        room.execute(char)
+
+    def read_lines(self):
+        # Thread - read commands from the command line and hand them to the event loop
+        try:
+            self.log.info('Commands: a=start/extend; b=pause/resume; c=stop')
+            while True:
+                line = raw_input()
+                self.loop.call_soon_threadsafe(self.command, line)
         except:
-            device = None
-            log.info('Unknown error. Retry in 60 seconds.')
-            current_state = 'Exception'
-            diesel.fork_from_thread(output_queue.put, current_state)
+            self.log.info('No command line input. Probably running as a daemon.')
+
+    def run(self):
+        # Run until SIGTERM or ctrl-c. SIGHUP restarts.
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.loop.call_soon_threadsafe(self.shutdown))
+        signal.signal(signal.SIGINT, lambda signum, frame: self.loop.call_soon_threadsafe(self.shutdown))
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.loop.call_soon_threadsafe(self.restart))
+        self.load()
+        self.start()
+        t = threading.Thread(target=self.read_lines)
+        t.daemon = True
+        t.start()
+        self.loop.run_forever()
 
-        # only try to reconnect every minute
-        diesel.sleep(60)
 
 if __name__ == '__main__':
-    # process configuration
-    if len(sys.argv) == 2:
-        capture_location = sys.argv[1]
-    else:
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device monitor and controller',
+        )
+    parser.add_argument('room', help='room name (a [capture room_name] section of the config file)', nargs='*')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*", repeatable)', action='append', default=[])
+    parser.add_argument('--config', help='config file', default='echo360.config')
+    parser.add_argument('-t', '--timeout', help='HTTP timeout', default=5, type=int)
+    args = parser.parse_args()
+    if len(args.room) + len(args.rooms) == 0:
         print('The room_name must be specified.')
         sys.exit(1)
-    timeout = 5
-    config_filename = 'echo360.config'
 
-    config = ConfigParser.ConfigParser()
-    config.readfp(open(config_filename))
-
-    section = 'capture ' + capture_location
-    device_uri      = config.get(section, 'uri')
-    device_username = config.get(section, 'username')
-    device_password = config.get(section, 'password')
-    capture_profile = config.get(section, 'profile')
+    # log timestamps are UTC
+    logging.Formatter.converter = time.gmtime
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] {%(name)s} %(levelname)s:%(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
 
     # start LCD if present
     lcd_path = 'Adafruit-Raspberry-Pi-Python-Code/Adafruit_CharLCDPlate'
@@ -226,24 +365,8 @@ if __name__ == '__main__':
     except:
         lcd = None
 
-    # Diesel import takes a while on the Raspberry Pi (which is why it is after the first lcd message)
-    import diesel
-    from diesel.protocols.http import HttpClient, HttpsClient
-
-    log = diesel.log.name('monitor')
-
-    # create Diesel queues
-    output_queue = diesel.util.queue.Queue()
-    command_queue = diesel.util.queue.Queue()
-    command_char_queue = diesel.util.queue.Queue()
-
-    # Global written by state_change_monitor and read by 
-    current_state = 'Unknown'
-
-    # Start Diesel
-    thread.start_new_thread(read_line_thread, ())
-    diesel.quickstart(text_output, device_command, state_change_monitor, read_button, execute_command)
+    service = Echo360MonitorService(args.config, args.room + args.rooms, lcd=lcd, timeout=args.timeout)
+    service.run()
     if lcd is not None:
         lcd.clear()
         lcd.message('Echo360\nMonitor stopped')
-
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Schedule aware, adaptive polling interval for capture device status monitoring.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Polling status/monitoring every 0.25 seconds is only needed when a state change is likely: around a
+# scheduled start, just after a local command, and while a capture is waiting or active. A room that is
+# inactive with nothing scheduled can be polled far less often (but never so late that a scheduled
+# start is missed).
+#
+#     scheduler = Echo360PollScheduler()
+#     while True:
+#         if scheduler.schedule_stale():
+#             scheduler.update_schedule(device.status_next_capture())
+#         state = device.status_monitoring().state
+#         time.sleep(scheduler.next_delay(state))
+
+from capture_device import timestamp_seconds
+import time
+
+class Echo360PollScheduler(object):
+    # Chooses the delay before the next status poll of one device.
+    #   fast:             delay while a state change is likely (seconds)
+    #   normal:           delay for paused and complete captures, and after errors
+    #   idle:             longest delay, for an inactive room with nothing scheduled soon
+    #   lead_time:        poll fast from this many seconds before a scheduled start...
+    #   grace_time:       ...until this many seconds after it
+    #   command_window:   poll fast for this many seconds after a local command
+    #   schedule_refresh: seconds between status_next_capture() calls (see schedule_stale())
+    def __init__(self, fast=0.25, normal=2, idle=30, lead_time=120, grace_time=60, command_window=30,
+            schedule_refresh=300):
+        self.fast = fast
+        self.normal = normal
+        self.idle = idle
+        self.lead_time = lead_time
+        self.grace_time = grace_time
+        self.command_window = command_window
+        self.schedule_refresh = schedule_refresh
+        self.next_start = None      # next scheduled start (seconds since the epoch), or None
+        self._schedule_time = None  # when next_start was last updated
+        self._command_time = None
+        self._state = None
+
+    def command_sent(self, now=None):
+        # Call after sending a local command (start, pause, stop, ...) to the device.
+        self._command_time = time.time() if now is None else now
+
+    def update_schedule(self, response, now=None):
+        # Record the next scheduled start from a status_next_capture() (or status_captures()) response.
+        now = time.time() if now is None else now
+        if not response.success():
+            return
+        self._schedule_time = now
+        start = response.__dict__.get('next_start_time') or response.__dict__.get('next_schedule_start_time')
+        self.next_start = None if start is None else timestamp_seconds(start)
+
+    def schedule_stale(self, now=None):
+        # True if the next scheduled start should be refreshed: never fetched, older than schedule_refresh,
+        # or the capture it described has started.
+        now = time.time() if now is None else now
+        if self._schedule_time is None or now - self._schedule_time > self.schedule_refresh:
+            return True
+        return self.next_start is not None and now > self.next_start + self.grace_time
+
+    def next_delay(self, state, now=None):
+        # The delay (seconds) before the next poll, given the state just returned by status_monitoring()
+        # (a device state, or None after an error).
+        now = time.time() if now is None else now
+        if state != self._state:
+            # A transition (including the first poll): the schedule may have changed too
+            if state in ['inactive', 'complete']:
+                self._schedule_time = None
+            self._state = state
+        if self._command_time is not None and now - self._command_time < self.command_window:
+            return self.fast
+        if state in ['waiting', 'active']:
+            return self.fast
+        if self.next_start is not None and self.next_start - self.lead_time <= now <= self.next_start + self.grace_time:
+            return self.fast
+        if state != 'inactive':
+            return self.normal
+        delay = self.idle
+        if self.next_start is not None and now < self.next_start - self.lead_time:
+            # wake up in time for the scheduled start
+            delay = min(delay, self.next_start - self.lead_time - now)
+        if self._schedule_time is not None:
+            # and in time to refresh the schedule
+            delay = min(delay, self._schedule_time + self.schedule_refresh - now)
+        return max(self.fast, delay)
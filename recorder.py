@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#
+# Record every status_monitoring() poll of one or more capture devices, and report on the recordings.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Polls are stored in SQLite databases (WAL mode) as one small row each: time (ms), room, state, duration,
+# confidence monitoring flag and request latency (ms). Rooms and states are stored once, as integer ids.
+# A poll that failed is recorded with its error (e.g. 'timeout', 'socket-61', '401') as the state.
+#
+# The database filename may contain strftime codes (UTC) to rotate the recording, e.g. one file per month
+# with 'echo360-%Y-%m.sqlite'. Queries read every file matching the pattern.
+#
+# Usage: python fleet.py --config echo360.config --adaptive --count 999999 --record 'echo360-%Y-%m.sqlite'
+#        python recorder.py --database 'echo360-%Y-%m.sqlite' summary --since 2014-07-01
+#        python recorder.py --database 'echo360-%Y-%m.sqlite' states --rooms "lt*"
+#        python recorder.py --database 'echo360-%Y-%m.sqlite' transitions --rooms lt1 --since 2014-07-09
+
+import argparse
+import calendar
+import datetime
+import fnmatch
+import glob
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS rooms (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+    CREATE TABLE IF NOT EXISTS states (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+    CREATE TABLE IF NOT EXISTS polls (
+        ts INTEGER NOT NULL,        -- milliseconds since the epoch (UTC)
+        room INTEGER NOT NULL,      -- rooms.id
+        state INTEGER NOT NULL,     -- states.id (a device state or an error code)
+        duration INTEGER,           -- seconds
+        confidence INTEGER,         -- 1 if a confidence monitor capture, 0 if not
+        latency INTEGER             -- milliseconds
+        );
+    CREATE INDEX IF NOT EXISTS polls_room_ts ON polls (room, ts);
+'''
+
+# States that are device states rather than errors
+DEVICE_STATES = ['inactive', 'waiting', 'active', 'paused', 'complete']
+
+def _milliseconds(ts):
+    return int(round(ts * 1000))
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _confidence(value):
+    if value is None:
+        return None
+    return 1 if str(value).lower() == 'true' else 0
+
+
+class Echo360Recorder(object):
+    # Appends poll records to the database. Records are written in batches (one transaction for up to
+    # batch_size records, or every flush_interval seconds) so the cost per poll is a list append.
+    # Call flush() or close() before exiting. Thread safe.
+    def __init__(self, filename, batch_size=500, flush_interval=5):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []      # (ts, room, state, duration, confidence, latency)
+        self._last_flush = time.time()
+        self._db = None
+        self._db_filename = None
+        self._rooms = {}
+        self._states = {}
+        self._recorded = {}     # room -> last snapshot result recorded
+
+    def record(self, room, ts, state, duration=None, confidence=None, latency=None):
+        # Record one poll. 'ts' and 'latency' are in seconds.
+        with self._lock:
+            self._pending.append((_milliseconds(ts), room, state, _int_or_none(duration), _confidence(confidence),
+                None if latency is None else _milliseconds(latency)))
+            if len(self._pending) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def record_response(self, room, response, latency=None, ts=None):
+        # Record a status_monitoring() response (an Echo360CaptureDeviceResponse).
+        ts = time.time() if ts is None else ts
+        if response.success():
+            self.record(room, ts, response.state, response.duration, response.confidence_monitoring, latency)
+        else:
+            self.record(room, ts, str(response._result_code), latency=latency)
+
+    def record_snapshot(self, snapshot):
+        # Record the status_monitoring result of each room in an Echo360Fleet snapshot, with the time of the
+        # status_monitoring call (or of the failed connection test). Rooms that were not polled (adaptive
+        # polling) repeat their last result and are skipped.
+        ts = time.time()
+        for (name, result) in snapshot['rooms'].items():
+            if result is None or self._recorded.get(name) is result:
+                continue
+            self._recorded[name] = result
+            mon = result.get('status_monitoring')
+            if mon is None:
+                self.record(name, ts, result.get('error', 'unknown'), latency=result.get('latency'))
+            elif mon['result_code'] == 'success':
+                self.record(name, ts, mon['state'], mon['duration'], mon['confidence_monitoring'],
+                    mon.get('latency'))
+            else:
+                self.record(name, ts, str(mon['result_code']), latency=mon.get('latency'))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._db_filename = None
+
+    def _flush(self):
+        self._last_flush = time.time()
+        pending = self._pending
+        self._pending = []
+        rows = []
+        for record in pending:
+            db = self._database(record[0])
+            if db is not self._db:
+                # rotated: write what we have to the previous file first
+                self._write(rows)
+                rows = []
+                self._open(db)
+            rows.append((record[0], self._id('rooms', self._rooms, record[1]),
+                self._id('states', self._states, record[2])) + record[3:])
+        self._write(rows)
+
+    def _database(self, ms):
+        # The (rotated) filename for a record at time 'ms', or the current database if it is the same file.
+        filename = time.strftime(self.filename, time.gmtime(ms / 1000))
+        if filename == self._db_filename:
+            return self._db
+        return filename
+
+    def _open(self, filename):
+        if self._db is not None:
+            self._db.close()
+        self._db = connect(filename)
+        self._db_filename = filename
+        self._rooms = dict(self._db.execute('SELECT name, id FROM rooms'))
+        self._states = dict(self._db.execute('SELECT name, id FROM states'))
+
+    def _id(self, table, ids, name):
+        if name not in ids:
+            cursor = self._db.execute('INSERT INTO {0} (name) VALUES (?)'.format(table), (name,))
+            ids[name] = cursor.lastrowid
+        return ids[name]
+
+    def _write(self, rows):
+        if self._db is None:
+            return
+        self._db.executemany('INSERT INTO polls VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self._db.commit()
+
+
+def connect(filename):
+    # Open (creating if needed) a recorder database.
+    db = sqlite3.connect(filename, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')   # durable at each checkpoint, safe with WAL
+    db.executescript(SCHEMA)
+    return db
+
+
+class Echo360Recording(object):
+    # Read only queries over every database file matching a recorder filename pattern. The queries read
+    # the polls table alone (no joins) and map room and state ids to names afterwards.
+    def __init__(self, filename):
+        self.filenames = sorted(glob.glob(re.sub('%.', '*', filename)))
+
+    def _query(self, columns, rooms='*', since=None, until=None, tail=''):
+        # Yield (room names, state names, row) for each row of 'SELECT columns FROM polls WHERE ... tail'
+        # in each file in turn. room and state names are dicts of the file's ids.
+        where = []
+        params = []
+        if since is not None:
+            where.append('ts >= ?')
+            params.append(_milliseconds(since))
+        if until is not None:
+            where.append('ts < ?')
+            params.append(_milliseconds(until))
+        for filename in self.filenames:
+            db = sqlite3.connect(filename)
+            room_names = dict((room_id, name) for (room_id, name) in db.execute('SELECT id, name FROM rooms')
+                if fnmatch.fnmatch(name, rooms))
+            state_names = dict(db.execute('SELECT id, name FROM states'))
+            clauses = where + ['room IN ({0})'.format(','.join(str(room_id) for room_id in room_names))]
+            sql = 'SELECT {0} FROM polls WHERE {1} {2}'.format(columns, ' AND '.join(clauses), tail)
+            for row in db.execute(sql.format(errors=','.join(str(state_id) for (state_id, name)
+                    in state_names.items() if name not in DEVICE_STATES)), params):
+                yield (room_names, state_names, row)
+            db.close()
+
+    def summary(self, rooms='*', since=None, until=None):
+        # Per room: [polls, errors, first ts, last ts, latency total, latency max] (ts and latency in ms).
+        result = {}
+        for (room_names, state_names, (room, polls, errors, first, last, latency, latency_max)) in self._query(
+                'room, COUNT(*), SUM(state IN ({errors})), MIN(ts), MAX(ts), TOTAL(latency), MAX(latency)',
+                rooms, since, until, 'GROUP BY room'):
+            total = result.setdefault(room_names[room], [0, 0, first, last, 0, 0])
+            total[0] += polls
+            total[1] += errors
+            total[2] = min(total[2], first)
+            total[3] = max(total[3], last)
+            total[4] += latency
+            total[5] = max(total[5], latency_max)
+        return result
+
+    def states(self, rooms='*', since=None, until=None, max_gap=300):
+        # Per room, the seconds spent in each state (or error): each poll counts until the next poll of
+        # the room, but for no more than 'max_gap' seconds (so time not being recorded is not counted).
+        result = {}
+        previous = {}   # room -> (ts, state)
+        for (room_names, state_names, (room, ts, state)) in self._query(
+                'room, ts, state', rooms, since, until, 'ORDER BY room, ts'):
+            room = room_names[room]
+            if room in previous:
+                (last_ts, last_state) = previous[room]
+                totals = result.setdefault(room, {})
+                totals[last_state] = totals.get(last_state, 0) + min(max_gap, (ts - last_ts) / 1000.0)
+            previous[room] = (ts, state_names[state])
+        return result
+
+    def transitions(self, rooms='*', since=None, until=None):
+        # Yield (room, ts, from_state, to_state) for each change of state, in time order for each room.
+        previous = {}
+        for (room_names, state_names, (room, ts, state)) in self._query(
+                'room, ts, state', rooms, since, until, 'ORDER BY room, ts'):
+            room = room_names[room]
+            state = state_names[state]
+            if room in previous and previous[room] != state:
+                yield (room, ts, previous[room], state)
+            previous[room] = state
+
+
+def parse_time(value):
+    # '2014-07-09' or '2014-07-09T10:30:00' (UTC) to seconds since the epoch
+    if value is None:
+        return None
+    if 'T' not in value:
+        value += 'T00:00:00'
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+def format_time(ms):
+    return datetime.datetime.utcfromtimestamp(ms / 1000.0).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device poll recording reports',
+        )
+    parser.add_argument('report', help='report', choices=['summary', 'states', 'transitions'])
+    parser.add_argument('--database', help='recorder database (strftime codes match any value)',
+        default='echo360-%Y-%m.sqlite')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*")', default='*')
+    parser.add_argument('--since', help='start time, UTC (e.g. 2014-07-01 or 2014-07-01T09:00:00)', default=None)
+    parser.add_argument('--until', help='end time, UTC', default=None)
+    args = parser.parse_args()
+
+    recording = Echo360Recording(args.database)
+    if len(recording.filenames) == 0:
+        print('No recordings match {0}'.format(args.database))
+        sys.exit(1)
+    since = parse_time(args.since)
+    until = parse_time(args.until)
+
+    try:    # catch ctrl-c and broken pipes (e.g. | head)
+        if args.report == 'summary':
+            print('{0:<16} {1:>10} {2:>8} {3:>8} {4:>9} {5:>9}  {6:<24} {7:<24}'.format(
+                'room', 'polls', 'errors', 'ok %', 'avg ms', 'max ms', 'first', 'last'))
+            for (room, (polls, errors, first, last, latency, latency_max)) in sorted(
+                    recording.summary(args.rooms, since, until).items()):
+                print('{0:<16} {1:>10} {2:>8} {3:>8.2f} {4:>9.1f} {5:>9}  {6:<24} {7:<24}'.format(
+                    room, polls, errors, 100.0 * (polls - errors) / polls, latency / polls, latency_max,
+                    format_time(first), format_time(last)))
+        elif args.report == 'states':
+            for (room, totals) in sorted(recording.states(args.rooms, since, until).items()):
+                print('{0:<16} {1}'.format(room, '  '.join('{0}={1:.2f}h'.format(state, seconds / 3600.0)
+                    for (state, seconds) in sorted(totals.items()))))
+        elif args.report == 'transitions':
+            for (room, ts, from_state, to_state) in recording.transitions(args.rooms, since, until):
+                print('{0} {1:<16} {2} -> {3}'.format(format_time(ts), room, from_state, to_state))
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')
+    except IOError:
+        pass
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Re-upload the saved content of many capture devices to the ESS, e.g. after a network outage.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# The saved content (diagnostics/recovery/saved-content) of every '[capture room_name]' section of
+# echo360.config is listed concurrently, then each capture is re-uploaded (diagnostics/recovery/ID/upload).
+# At most --workers uploads run at once across the fleet, and at most --per-device on any one device, so the
+# ESS and the devices are not swamped. The device only queues an upload, so --hold keeps each upload's slot
+# for that many seconds after it is queued to pace the uploads to what the ESS can absorb.
+#
+# Progress is kept in a JSON file (--progress). Captures already uploaded are skipped, so an interrupted
+# recovery can be run again; failed uploads are retried on the next run.
+#
+# Usage: python recovery.py --config echo360.config --list
+#        python recovery.py --config echo360.config --rooms "lt*" --workers 8 --per-device 1 --hold 300
+#        python recovery.py --config echo360.config --since 2014-07-01
+
+from capture_device import Echo360CaptureDevice, Echo360CaptureDeviceResponse, Echo360DeviceInfoCache
+from fleet import Echo360WorkerPool, load_rooms
+import argparse
+import datetime
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+def utc_now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Echo360RecoveryProgress(object):
+    # The uploads done so far, kept in a JSON file: {room_name: {capture_id: {'title': ..., 'start_time': ...,
+    # 'result': 'success' or the error, 'message': ..., 'time': ...}}}. Thread safe. The file is rewritten
+    # (atomically) after every upload, so it is up to date if the recovery is interrupted.
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._progress = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self._progress = json.load(f)
+
+    def uploaded(self, room, capture_id):
+        with self._lock:
+            return self._progress.get(room, {}).get(capture_id, {}).get('result') == 'success'
+
+    def record(self, room, capture, response):
+        # Record the response of the upload of 'capture' (a dict from diagnostics_recovery_saved_content()).
+        with self._lock:
+            self._progress.setdefault(room, {})[capture['id']] = {
+                'title':        capture.get('title'),
+                'start_time':   capture.get('start_time'),
+                'result':       'success' if response.success() else str(response._result_code),
+                'message':      response._result_message,
+                'time':         utc_now(),
+                }
+            self._save()
+
+    def _save(self):
+        if self.filename is None:
+            return
+        temp = self.filename + '.part'
+        with open(temp, 'w') as f:
+            json.dump(self._progress, f, indent=2, sort_keys=True)
+        os.rename(temp, self.filename)
+
+
+class Echo360Recovery(object):
+    # Re-uploads the saved content of 'rooms' (dicts from load_rooms()).
+    # 'workers' is the number of uploads in progress across all rooms, 'per_device' the number on one device.
+    # 'hold' is the number of seconds an upload keeps its slot after the device has queued it.
+    # Captures that started before 'since' (a capture device timestamp, e.g. '2014-07-01') are left alone.
+    def __init__(self, rooms, progress, workers=8, per_device=1, hold=0, since=None, timeout=30,
+            info_cache=None):
+        self.rooms = rooms
+        self.progress = progress
+        self.workers = Echo360WorkerPool(workers)
+        self.max_uploads = workers
+        self.per_device = per_device
+        self.hold = hold
+        self.since = since
+        self.timeout = timeout
+        self.info_cache = info_cache
+        self._devices = {}
+
+    def device(self, room):
+        name = room['room']
+        if name not in self._devices:
+            self._devices[name] = Echo360CaptureDevice(room['uri'], room['username'], room['password'],
+                timeout=self.timeout, lazy=True, info_cache=self.info_cache)
+        return self._devices[name]
+
+    def list_room(self, room):
+        # The saved content of one room: a dict with the room name and the captures still to upload
+        # ('pending'), the number already uploaded ('done'), or the error.
+        result = {'room': room['room'], 'pending': [], 'done': 0}
+        device = self.device(room)
+        if not device.connection_test.success():
+            result['error'] = str(device.connection_test._result_code)
+            result['message'] = device.connection_test._result_message
+            return result
+        response = device.diagnostics_recovery_saved_content()
+        if not response.success():
+            result['error'] = str(response._result_code)
+            result['message'] = response._result_message
+            return result
+        for capture in response.captures:
+            if self.since is not None and (capture.get('start_time') or '') < self.since:
+                continue
+            if self.progress.uploaded(room['room'], capture['id']):
+                result['done'] += 1
+            else:
+                result['pending'].append(capture)
+        return result
+
+    def list(self):
+        # List the saved content of all rooms concurrently. Returns a list of list_room() results.
+        jobs = [self.workers.submit(self.list_room, room) for room in self.rooms]
+        results = []
+        for job in self.workers.as_completed(jobs):
+            if job.error is not None:
+                results.append({'room': job.args[0]['room'], 'pending': [], 'done': 0, 'error': 'unknown',
+                    'message': 'Unknown error: {0}'.format(repr(job.error))})
+            else:
+                results.append(job.result)
+        return sorted(results, key=lambda result: result['room'])
+
+    def upload(self, room, capture):
+        device = self.device(room)
+        response = device.diagnostics_capture_id_upload(capture['id'])
+        self.progress.record(room['room'], capture, response)
+        if response.success() and self.hold > 0:
+            time.sleep(self.hold)
+        return response
+
+    def run(self, listing=None):
+        # Generator: re-upload the pending captures of all rooms (the list() results in 'listing', or a new
+        # list()), yielding (room name, capture, response) as each upload finishes. Rooms take turns, oldest
+        # capture first, within the global and per device limits.
+        if listing is None:
+            listing = self.list()
+        rooms = dict((room['room'], room) for room in self.rooms)
+        pending = dict((result['room'], sorted(result['pending'], key=lambda capture: capture.get('start_time')))
+            for result in listing if len(result['pending']) > 0)
+        active = dict((name, 0) for name in pending)
+        order = sorted(pending)
+        done = Queue.Queue()
+        running = 0
+        while running > 0 or len(pending) > 0:
+            # start uploads while there are free slots, one room at a time
+            started = True
+            while started and running < self.max_uploads:
+                started = False
+                for name in list(order):
+                    if running >= self.max_uploads:
+                        break
+                    if name not in pending or active[name] >= self.per_device:
+                        continue
+                    capture = pending[name].pop(0)
+                    if len(pending[name]) == 0:
+                        del pending[name]
+                    job = self.workers.submit(self.upload, rooms[name], capture)
+                    job.add_listener(done)
+                    active[name] += 1
+                    running += 1
+                    started = True
+                    # (the next room goes first next time)
+                    order.remove(name)
+                    order.append(name)
+            if running == 0:
+                break
+            job = done.get(True, 365 * 24 * 3600)   # a finite timeout keeps ctrl-c working in Python 2
+            (room, capture) = job.args
+            active[room['room']] -= 1
+            running -= 1
+            response = job.result
+            if job.error is not None:
+                response = Echo360CaptureDeviceResponse('diagnostics/recovery/{0}/upload'.format(capture['id']),
+                    'unknown', 'Unknown error: {0}'.format(repr(job.error)),
+                    title='Re-Upload Content from the Device to the ESS')
+            yield (room['room'], capture, response)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device saved content recovery',
+        )
+    parser.add_argument('--config', help='config file', default='echo360.config')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*")', default='*')
+    parser.add_argument('--progress', help='progress file (uploaded captures are skipped)',
+        default='echo360-recovery.json')
+    parser.add_argument('--workers', help='uploads in progress at once, across all devices', default=8, type=int)
+    parser.add_argument('--per-device', help='uploads in progress at once on one device', default=1, type=int)
+    parser.add_argument('--hold', help='seconds each upload keeps its slot after the device queues it', default=0,
+        type=float)
+    parser.add_argument('--since', help='only captures that started after this time, UTC (e.g. 2014-07-01)',
+        default=None)
+    parser.add_argument('--list', help='list the captures to upload, without uploading them', action='store_true')
+    parser.add_argument('-t', '--timeout', help='HTTP timeout', default=30, type=int)
+    parser.add_argument('--cache', help='device information cache file (skips connection tests)', default=None)
+    parser.add_argument('--cache-ttl', help='device information cache lifetime (seconds)', default=24*3600, type=int)
+    args = parser.parse_args()
+
+    info_cache = None
+    if args.cache is not None:
+        info_cache = Echo360DeviceInfoCache(args.cache, args.cache_ttl)
+    recovery = Echo360Recovery(load_rooms(args.config, args.rooms), Echo360RecoveryProgress(args.progress),
+        workers=args.workers, per_device=args.per_device, hold=args.hold, since=args.since, timeout=args.timeout,
+        info_cache=info_cache)
+
+    try:    # catch ctrl-c
+        start = time.time()
+        listing = recovery.list()
+        errors = [result for result in listing if 'error' in result]
+        total = sum(len(result['pending']) for result in listing)
+        for result in listing:
+            if 'error' in result:
+                print('{0:<24} error {1}: {2}'.format(result['room'], result['error'], result['message']))
+            elif len(result['pending']) > 0 or args.list:
+                print('{0:<24} {1} to upload, {2} already uploaded'.format(result['room'], len(result['pending']),
+                    result['done']))
+            if args.list:
+                for capture in result['pending']:
+                    print('    {0} {1:<24} {2}'.format(capture['id'], capture.get('start_time_local'),
+                        capture.get('title')))
+        print('{0} captures to upload from {1} devices ({2} devices could not be listed)'.format(total,
+            len([result for result in listing if len(result['pending']) > 0]), len(errors)))
+        if args.list:
+            sys.exit(0)
+
+        n = 0
+        failed = 0
+        for (room, capture, response) in recovery.run(listing):
+            n += 1
+            if not response.success():
+                failed += 1
+            print('[{0}/{1}] {2:<24} {3} {4:<24} {5}'.format(n, total, room, capture['id'],
+                capture.get('title'), 'ok' if response.success() else str(response)))
+            sys.stdout.flush()
+        print('Uploaded {0} of {1} captures in {2:.1f} seconds, {3} failed'.format(n - failed, total,
+            time.time() - start, failed))
+        if failed > 0 or len(errors) > 0:
+            sys.exit(4)
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')
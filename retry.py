@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Retry policy and circuit breaker for capture device API calls.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Pass an Echo360RetryPolicy (retry=...) and an Echo360CircuitBreaker (breaker=...) to Echo360CaptureDevice.
+# The policy says, for each kind of error, whether a request is retried and whether it counts as a failure
+# of the device: a timeout is retried and counts, a 401 does neither (the device answered). Retries wait
+# for a random time up to an exponentially growing limit, so many clients that failed at the same moment
+# don't retry in step. Commands (POST) are only retried if the request can't have reached the device.
+#
+# The breaker (one per device) opens after 'threshold' failures in a row: calls then fail at once with the
+# result code 'circuit-open', without a request. After a jittered delay (growing each time it opens again)
+# one call first sends a cheap probe request ('probe', status/system); if the device answers the breaker
+# closes and the call goes ahead, otherwise it opens again.
+#
+#     policy = Echo360RetryPolicy(retries=2)
+#     device = Echo360CaptureDevice(server, username, password, retry=policy, breaker=Echo360CircuitBreaker())
+#     print(device.breaker.as_dict())     # {'state': 'closed', 'failures': 0, ...}
+
+import random
+import threading
+import time
+
+class Echo360RetryPolicy(object):
+    # Error class (request() status) -> (retry, device failure)
+    ERRORS = {
+        'timeout':      (True, True),
+        'socket':       (True, True),
+        'socket-61':    (True, True),   # connection refused (e.g. rebooting)
+        'socket-8':     (False, True),  # unknown host
+        'unknown':      (True, True),
+        'Invalid URL':  (False, False),
+        'circuit-open': (False, False),
+        401:            (False, False),
+        404:            (False, False),
+        409:            (False, False), # error response of some capture commands
+        501:            (False, False), # error response of capture/new_capture
+        }
+    # Errors where the request was not sent, so a command (POST) can be retried too
+    UNSENT = ['socket-61', 'socket-8', 'Invalid URL']
+
+    def __init__(self, retries=2, base=0.25, cap=8, errors=None):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.errors = dict(self.ERRORS)
+        if errors is not None:
+            self.errors.update(errors)
+
+    def classify(self, status):
+        # (retry, device failure) for a request() status. Other HTTP errors: 5xx are retried failures,
+        # 4xx are neither. Other exception codes are failures.
+        if status == 200:
+            return (False, False)
+        if status in self.errors:
+            return self.errors[status]
+        if isinstance(status, int):
+            return (status >= 500, status >= 500)
+        return (False, True)
+
+    def should_retry(self, status, method, attempt):
+        # Retry attempt 'attempt' (0 for the first retry) after a request that returned 'status'?
+        return attempt < self.retries and self.classify(status)[0] and (method == 'GET' or status in self.UNSENT)
+
+    def delay(self, attempt):
+        # Seconds to wait before retry 'attempt': random, up to base * 2^attempt (at most cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class Echo360CircuitBreaker(object):
+    # Per device. Thread safe. state is 'closed' (calls go ahead), 'open' (calls fail at once) or 'half-open'
+    # (a probe is in progress). An open breaker allows a probe after a random 50-100% of
+    # reset * 2^(times opened in a row - 1) seconds (at most cap).
+    def __init__(self, threshold=5, reset=2, cap=60, probe='status/system'):
+        self.threshold = threshold
+        self.reset = reset
+        self.cap = cap
+        self.probe = probe
+        self.state = 'closed'
+        self.failures = 0       # failures in a row
+        self.trips = 0          # times opened since it was last closed
+        self.opened = 0         # total times opened
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        # True if a call can go ahead, 'probe' if the caller must send the probe first (then call success()
+        # or failure()), or False if the breaker is open.
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() >= self.retry_at:
+                self.state = 'half-open'
+                return 'probe'
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.trips = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                self.trips += 1
+                self.opened += 1
+                self.state = 'open'
+                self.retry_at = time.time() + random.uniform(0.5, 1) * min(self.cap,
+                    self.reset * 2 ** (self.trips - 1))
+
+    def retry_in(self):
+        # Seconds until an open breaker allows a probe (0 if it is not open)
+        with self._lock:
+            if self.state != 'open':
+                return 0
+            return max(0, self.retry_at - time.time())
+
+    def as_dict(self):
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened,
+            'retry_in': round(self.retry_in(), 1)}
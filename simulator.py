@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+#
+# A local stand-in for one or more Echo360 capture devices, for testing and benchmarking the tools without
+# classroom hardware.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# Implements the API 3.0 calls used by Echo360CaptureDevice (status/*, monitoring/*.jpg, capture/*,
+# diagnostics/* and log-list-last-count) over HTTP/1.1 (keep-alive), or HTTPS with --certificate.
+# Each simulated device runs a capture state machine: scheduled captures every --schedule-interval seconds
+# go waiting (pre-roll) -> active -> complete -> inactive, and the capture commands start, pause, resume,
+# extend and stop captures as a device would. --speed runs the device clocks faster than real time.
+#
+# With --rooms N there are N devices, room1 ... roomN, at http://host:port/room1/ etc. (and the first is
+# also at http://host:port/). --config writes an echo360.config for them (for fleet.py and monitor.py).
+#
+# Faults: --latency and --jitter delay each response, --error-rate answers with 503 Service Unavailable
+# and --drop-rate closes the connection without a response. The reboot command takes a device offline
+# (connections are dropped) for --reboot-time seconds.
+#
+# Usage: python simulator.py --port 8080 --rooms 100 --config simulator.config --latency 0.02
+#        python capture_device.py -s http://127.0.0.1:8080/room1/ -p password -c test-status
+
+import argparse
+import base64
+import BaseHTTPServer
+import datetime
+import os
+import random
+import SocketServer
+import ssl
+import threading
+import time
+import urlparse
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+THUMBNAILS = ['vga_display_graphics-channel1-stream0.jpg', 'video_ntsc_graphics-channel2-stream0.jpg']
+
+def timestamp(seconds):
+    # Capture device (UTC) timestamp format, e.g. '2014-06-05T00:27:37.000Z'
+    return datetime.datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%S.') + \
+        '{0:03d}Z'.format(int(seconds * 1000) % 1000)
+
+def element(tag, value):
+    if value is None:
+        return '<{0}/>'.format(tag)
+    return '<{0}>{1}</{0}>'.format(tag, escape(str(value)))
+
+def ok(text):
+    return (200, 'text/xml', '<ok text={0} />'.format(quoteattr(text)))
+
+def error(status, text):
+    return (status, 'text/xml', '<error text={0} />'.format(quoteattr(text)))
+
+def html(lines):
+    return (200, 'text/html', '<pre>' + escape('\n'.join(lines)) + '</pre>')
+
+
+class Echo360SimulatedDevice(object):
+    # The state of one simulated capture device. handle() answers one API call as (status, content type, body).
+    # Thread safe.
+    def __init__(self, name='room1', utc_offset=600, schedule_interval=3600, schedule_duration=3000,
+            pre_roll=60, complete_time=10, log_entries=500, thumbnail_size=40000, reboot_time=60, speed=1.0,
+            saved_content=0):
+        self.name = name
+        self.utc_offset = utc_offset
+        self.schedule_interval = schedule_interval
+        self.schedule_duration = schedule_duration
+        self.pre_roll = pre_roll
+        self.complete_time = complete_time
+        self.reboot_time = reboot_time
+        self.speed = speed
+        self.serial_number = 'ff-ff-{0:02x}-{1:02x}-ff-ff'.format(random.randint(0, 255), random.randint(0, 255))
+        self.system_version = '5.4.39512'
+        self.profile = 'Display/Video (Podcast/Vodcast/EchoPlayer). Optimized for quality/full motion video'
+        self.down_until = 0
+        self._start = time.time()
+        self._up_since = self.now()
+        self._lock = threading.RLock()
+        self._current = None    # dict of the current capture, or None
+        self._schedule = []     # upcoming scheduled captures (dicts), in start time order
+        self._saved = []        # saved content (dicts)
+        self._log = []          # (time, level, message)
+        self._log_limit = max(log_entries, 1000)
+        self._thumbnail = '\xff\xd8\xff\xe0' + os.urandom(max(thumbnail_size - 6, 0)) + '\xff\xd9'
+        for i in range(log_entries):
+            self.log('Startup message {0}'.format(i), 'DEBUG', self._up_since - log_entries + i)
+        for i in range(saved_content):
+            # captures from before the start, e.g. not uploaded during a network outage
+            start = self._up_since - (saved_content - i) * self.schedule_duration
+            capture = self._capture('scheduled', start, self.schedule_duration, 'Saved lecture {0}'.format(i + 1),
+                'ECHO101 Semester 2', self.profile)
+            capture['state'] = 'complete'
+            capture['end'] = start + self.schedule_duration
+            self._saved.append(capture)
+        self.log('Device {0} started'.format(name))
+
+    def now(self):
+        # Simulated time (seconds since the epoch, UTC).
+        return self._start + (time.time() - self._start) * self.speed
+
+    def log(self, message, level='INFO', at=None):
+        self._log.append((self.now() if at is None else at, level, message))
+        if len(self._log) > self._log_limit:
+            del self._log[:len(self._log) - self._log_limit]
+
+    def update(self):
+        # Advance the state machine to now().
+        now = self.now()
+        self._extend_schedule(now)
+        current = self._current
+        if current is not None and current['state'] in ['active', 'paused'] and \
+                now >= current['start'] + current['duration']:
+            self._complete(current['start'] + current['duration'])
+        if current is not None and current['state'] == 'complete' and now >= current['end'] + self.complete_time:
+            self._current = current = None
+        if current is None and len(self._schedule) > 0 and now >= self._schedule[0]['start'] - self.pre_roll:
+            self._current = current = self._schedule.pop(0)
+            current['state'] = 'waiting'
+            self.log('Capture {0} waiting'.format(current['title']))
+        if current is not None and current['state'] == 'waiting' and now >= current['start']:
+            current['state'] = 'active'
+            self.log('Capture {0} started'.format(current['title']))
+
+    def _extend_schedule(self, now):
+        # Keep a day of scheduled captures, one every schedule_interval seconds
+        if self.schedule_interval <= 0:
+            return
+        last = self._schedule[-1]['start'] if len(self._schedule) > 0 else \
+            (now // self.schedule_interval) * self.schedule_interval
+        while last < now + 24 * 3600:
+            last += self.schedule_interval
+            self._schedule.append(self._capture('scheduled', last, self.schedule_duration,
+                'Lecture {0}'.format(datetime.datetime.utcfromtimestamp(last).strftime('%Y-%m-%d %H:%M')),
+                'ECHO101 Semester 2', self.profile))
+
+    def _capture(self, type, start, duration, title, section, profile, confidence=False):
+        return {'id': str(uuid.uuid4()), 'type': type, 'start': start, 'duration': duration, 'title': title,
+            'section': section, 'profile': profile, 'confidence': confidence, 'state': 'inactive', 'end': None}
+
+    def _complete(self, end):
+        current = self._current
+        current['state'] = 'complete'
+        current['end'] = end
+        current['duration'] = int(end - current['start'])
+        self.log('Capture {0} complete'.format(current['title']))
+        if not current['confidence']:
+            self._saved.append(current)
+
+    def state(self):
+        return 'inactive' if self._current is None else self._current['state']
+
+    def handle(self, method, path, params):
+        # Answer one API call: returns (status, content type, body).
+        with self._lock:
+            self.update()
+            if path.startswith('monitoring/') and method == 'GET':
+                return self.monitoring_snapshot(path.split('/', 1)[1])
+            handler = self.HANDLERS.get((method, path))
+            if handler is None:
+                parts = path.split('/')
+                if path.startswith('log-list-last-count/') and method == 'GET':
+                    return self.log_list_last_count(parts[1])
+                if len(parts) == 3 and parts[1] in ['ping', 'traceroute'] and method == 'POST':
+                    return self.diagnostics_network(parts[1], parts[2])
+                if len(parts) == 4 and parts[:2] == ['diagnostics', 'recovery'] and parts[3] == 'upload' and \
+                        method == 'POST':
+                    return self.diagnostics_upload(parts[2])
+                return (404, 'text/html', '<html><body>Not Found</body></html>')
+            return handler(self, params)
+
+    # status/*
+
+    def _wall_clock(self):
+        return element('wall-clock-time', timestamp(self.now()))
+
+    def _capture_xml(self, capture, state=None):
+        if capture is None:
+            return ''
+        return ''.join([
+            '<schedule>',
+            element('type', capture['type']),
+            element('start-time', timestamp(capture['start'])),
+            element('duration', capture['duration']),
+            '<parameters>',
+            element('title', capture['title']),
+            element('section', capture['section']),
+            '<capture-profile>', element('name', capture['profile']), '</capture-profile>',
+            '</parameters>',
+            '</schedule>',
+            element('state', state or capture['state']),
+            element('start-time', timestamp(capture['start'])),
+            element('duration', capture['duration']),
+            ])
+
+    def _next(self):
+        return self._schedule[0] if len(self._schedule) > 0 else None
+
+    def status_system(self, params):
+        return (200, 'text/xml', ''.join(['<status>', self._wall_clock(),
+            '<content>', element('state', 'idle' if self._current is None else 'capturing'), '</content>',
+            element('utc-offset', self.utc_offset), element('serial-number', self.serial_number),
+            element('system-version', self.system_version), element('up-since', timestamp(self._up_since)),
+            element('last-sync', timestamp(self.now() - self.now() % 300)), '</status>']))
+
+    def status_captures(self, params):
+        return (200, 'text/xml', ''.join(['<status>', self._wall_clock(),
+            '<current>', self._capture_xml(self._current), '</current>',
+            '<next>', self._capture_xml(self._next(), 'inactive'), '</next>', '</status>']))
+
+    def status_current_capture(self, params):
+        return (200, 'text/xml', ''.join(['<status>', self._wall_clock(),
+            '<current>', self._capture_xml(self._current), '</current>', '</status>']))
+
+    def status_next_capture(self, params):
+        return (200, 'text/xml', ''.join(['<status>', self._wall_clock(),
+            '<next>', self._capture_xml(self._next(), 'inactive'), '</next>', '</status>']))
+
+    def status_monitoring(self, params):
+        current = self._current
+        if current is None:
+            return (200, 'text/xml', ''.join(['<status>', self._wall_clock(), element('state', 'inactive'),
+                '</status>']))
+        images = ''
+        if current['state'] in ['active', 'paused']:
+            images = '<monitoring><images>' + ''.join(element('image', name) for name in THUMBNAILS) + \
+                '</images></monitoring>'
+        return (200, 'text/xml', ''.join(['<status>', self._wall_clock(), element('state', current['state']),
+            element('start-time', timestamp(current['start'])), element('duration', current['duration']),
+            element('confidence-monitoring', 'true' if current['confidence'] else 'false'), images,
+            '</status>']))
+
+    def monitoring_snapshot(self, name):
+        if name not in THUMBNAILS or self._current is None or self._current['state'] not in ['active', 'paused']:
+            return (404, 'text/html', '<html><body>Not Found</body></html>')
+        return (200, 'image/jpeg', self._thumbnail)
+
+    def status_get_user_sections(self, params):
+        return (200, 'text/xml', ''.join(['<sections><section>', element('name', 'ECHO101 Semester 2'),
+            element('guid', uuid.uuid5(uuid.NAMESPACE_DNS, self.name)),
+            '<capture-profile>', element('name', self.profile), '</capture-profile>', '</section></sections>']))
+
+    def status_get_user_ref(self, params):
+        return (200, 'text/xml', element('authenticated-user-ref', uuid.uuid5(uuid.NAMESPACE_URL, self.name)))
+
+    # capture/*
+
+    def capture_new_capture(self, params, confidence=False):
+        command = 'confidence_monitor' if confidence else 'new_capture'
+        if self._current is not None and self._current['state'] != 'complete':
+            return error(501, 'Failed on command ({0}).  A capture is already running.'.format(command))
+        try:
+            duration = int(params['duration'])
+        except (KeyError, ValueError):
+            return error(501, 'Failed on command ({0}).  Invalid duration.'.format(command))
+        self._current = self._capture('ad hoc', self.now(), duration, params.get('description', ''),
+            None, params.get('capture_profile_name', self.profile), confidence)
+        self._current['state'] = 'active'
+        self.log('Capture {0} started ({1})'.format(self._current['title'], command))
+        return ok('Capture scheduled for start')
+
+    def capture_confidence_monitor(self, params):
+        return self.capture_new_capture(params, confidence=True)
+
+    def capture_extend(self, params):
+        if self.state() not in ['active', 'paused']:
+            return error(409, 'Failed on command (extend).  No capture is running.')
+        try:
+            duration = int(params['duration'])
+        except (KeyError, ValueError):
+            return error(409, 'Failed on command (extend).  Invalid duration.')
+        end = self._current['start'] + self._current['duration'] + duration
+        if self._next() is not None:
+            # can't extend past the start of the next scheduled capture
+            end = min(end, self._next()['start'] - self.pre_roll)
+        self._current['duration'] = max(self._current['duration'], int(end - self._current['start']))
+        self.log('Capture {0} extended by {1} seconds'.format(self._current['title'], duration))
+        return ok('Extend by {0} seconds recieved'.format(duration))
+
+    def capture_pause(self, params):
+        if self.state() != 'active':
+            return error(409, 'Failed on command (pause).  No capture is running.')
+        self._current['state'] = 'paused'
+        self.log('Capture {0} paused'.format(self._current['title']))
+        return ok('Command (pause) submitted')
+
+    def capture_record(self, params):
+        if self.state() not in ['paused', 'waiting']:
+            return error(409, 'Failed on command (record).  No capture is paused or waiting.')
+        if self._current['state'] == 'waiting':
+            # start early, keeping the scheduled end time
+            now = self.now()
+            self._current['duration'] += int(self._current['start'] - now)
+            self._current['start'] = now
+        self._current['state'] = 'active'
+        self.log('Capture {0} recording'.format(self._current['title']))
+        return ok('Command (record) submitted')
+
+    def capture_stop(self, params):
+        if self.state() not in ['active', 'paused']:
+            return error(409, 'Failed on command (stop).  No capture is running.')
+        self._complete(self.now())
+        return ok('Command (stop) submitted')
+
+    # diagnostics/*
+
+    def diagnostics_clear_cache(self, params):
+        self.log('User cache cleared')
+        return ok('User cache cleared')
+
+    def diagnostics_restart_all(self, params):
+        self.log('Restarting all executables')
+        return ok('Restarting all executables')
+
+    def diagnostics_reboot(self, params):
+        self.log('Rebooting')
+        self.down_until = time.time() + self.reboot_time
+        if self._current is not None and self._current['state'] in ['active', 'paused']:
+            self._complete(self.now())
+        self._up_since = self.now() + self.reboot_time * self.speed
+        return ok('Rebooting')
+
+    def diagnostics_network(self, command, host):
+        lines = []
+        for i in range(4 if command == 'ping' else 6):
+            ms = random.uniform(0.2, 20)
+            if command == 'ping':
+                lines.append('64 bytes from {0}: icmp_seq={1} ttl=56 time={2:.3f} ms'.format(host, i + 1, ms))
+            else:
+                lines.append('{0}  10.0.{1}.1 ({2:.3f} ms)'.format(i + 1, i, ms))
+        return (200, 'text/html', '<br/>'.join(escape(line) for line in lines))
+
+    def diagnostics_system_info_ifconfig(self, params):
+        return html(['eth0      Link encap:Ethernet  HWaddr {0}'.format(self.serial_number.replace('-', ':')),
+            '          inet addr:10.0.0.10  Bcast:10.0.0.255  Mask:255.255.255.0',
+            '          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1'])
+
+    def diagnostics_system_info_top(self, params):
+        status, content_type, body = html(['  PID USER      PR  NI  VIRT  RES  SHR S %CPU %MEM    TIME+  COMMAND',
+            ' 1042 root      20   0  412m  96m  12m S 23.0  9.6 812:01.44 capture',
+            ' 1011 root      20   0  102m  21m 8.2m S  1.3  2.1  31:07.10 api'])
+        return (status, content_type, '<head><meta http-equiv="refresh" content="5"></head>' + body)
+
+    def diagnostics_system_info_dmesg(self, params):
+        return html(['[    0.000000] Linux version 2.6.32 (build@echo360)',
+            '[    1.204000] eth0: link up, 1000Mbps, full-duplex'])
+
+    def diagnostics_system_info_device(self, params):
+        return (200, 'text/xml', ''.join(['<device>', element('name', self.name),
+            element('serial-number', self.serial_number), element('system-version', self.system_version),
+            element('utc-offset', self.utc_offset), '</device>']))
+
+    def diagnostics_system_info_tasks(self, params):
+        tasks = [task for task in ([self._current] if self._current is not None else []) + self._schedule
+            if task['state'] != 'complete']
+        return (200, 'text/xml', '<tasks>' + ''.join(''.join(['<task id={0}>'.format(quoteattr(task['id'])),
+            element('type', task['type']), element('start-time', timestamp(task['start'])),
+            element('duration', task['duration']), element('title', task['title']),
+            element('section', task['section']), element('capture-profile', task['profile']),
+            '</task>']) for task in tasks) + '</tasks>')
+
+    def diagnostics_recovery_saved_content(self, params):
+        return (200, 'text/xml', '<captures>' + ''.join(''.join(['<capture id={0}>'.format(quoteattr(capture['id'])),
+            element('title', capture['title']), element('start-time', timestamp(capture['start'])),
+            element('duration', capture['duration']), element('section', capture['section']),
+            '</capture>']) for capture in self._saved) + '</captures>')
+
+    def diagnostics_upload(self, id):
+        for capture in self._saved:
+            if capture['id'] == id:
+                self.log('Upload of capture {0} queued'.format(id))
+                return ok('Upload of capture {0} queued'.format(id))
+        return error(404, 'Capture {0} not found.'.format(id))
+
+    def log_list_last_count(self, count):
+        try:
+            count = int(count)
+        except ValueError:
+            return (404, 'text/html', '<html><body>Not Found</body></html>')
+        entries = self._log[-count:] if count > 0 else []
+        return (200, 'text/xml', '<log-list>' + ''.join(
+            '<log-entry>\ntime: "{0}"\nmessage: "{1}"\nlevel: "{2}"\n</log-entry>'.format(
+                timestamp(at), escape(message), level) for (at, level, message) in entries) + '</log-list>')
+
+    HANDLERS = {
+        ('GET', 'status/system'): status_system,
+        ('GET', 'status/captures'): status_captures,
+        ('GET', 'status/current_capture'): status_current_capture,
+        ('GET', 'status/next_capture'): status_next_capture,
+        ('GET', 'status/monitoring'): status_monitoring,
+        ('GET', 'status/get_user_sections'): status_get_user_sections,
+        ('GET', 'status/get_user_ref'): status_get_user_ref,
+        ('POST', 'capture/new_capture'): capture_new_capture,
+        ('POST', 'capture/confidence_monitor'): capture_confidence_monitor,
+        ('POST', 'capture/extend'): capture_extend,
+        ('POST', 'capture/pause'): capture_pause,
+        ('POST', 'capture/record'): capture_record,
+        ('POST', 'capture/stop'): capture_stop,
+        ('POST', 'diagnostics/clear_cache'): diagnostics_clear_cache,
+        ('POST', 'diagnostics/restart_all'): diagnostics_restart_all,
+        ('POST', 'diagnostics/reboot'): diagnostics_reboot,
+        ('GET', 'diagnostics/system-info/ifconfig'): diagnostics_system_info_ifconfig,
+        ('GET', 'diagnostics/system-info/top'): diagnostics_system_info_top,
+        ('GET', 'diagnostics/system-info/dmesg'): diagnostics_system_info_dmesg,
+        ('GET', 'diagnostics/system-info/device'): diagnostics_system_info_device,
+        ('GET', 'diagnostics/system-info/tasks'): diagnostics_system_info_tasks,
+        ('GET', 'diagnostics/recovery/saved-content'): diagnostics_recovery_saved_content,
+        }
+
+
+class Echo360SimulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 request handler for an Echo360Simulator.
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Echo360Simulator/1.0'
+    wbufsize = -1   # send each response in one write (separate header and body writes meet delayed ACKs)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        server = self.server
+        body = ''
+        if 'Content-Length' in self.headers:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        path = urlparse.urlparse(self.path).path.strip('/')
+        (device, path) = server.find_device(path)
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if device is None:
+            return self.reply(404, 'text/html', '<html><body>Not Found</body></html>')
+        if time.time() < device.down_until or random.random() < server.drop_rate:
+            # rebooting, or a dropped connection: no response
+            self.close_connection = 1
+            return
+        if random.random() < server.error_rate:
+            return self.reply(503, 'text/html', '<html><body>Service Unavailable</body></html>')
+        if server.username is not None and self.headers.get('Authorization') != 'Basic ' + \
+                base64.b64encode('{0}:{1}'.format(server.username, server.password)):
+            return self.reply(401, 'text/html', '<html><body>Unauthorized</body></html>')
+        params = dict(urlparse.parse_qsl(body)) if method == 'POST' else {}
+        self.reply(*device.handle(method, path, params))
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Echo360Simulator(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # An HTTP(S) server for one or more Echo360SimulatedDevice, one thread per connection.
+    # Device 'name' is at /name/..., and the first device is also at /...
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, devices, username='admin', password='password', certificate=None,
+            latency=0, jitter=0, error_rate=0, drop_rate=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Echo360SimulatorHandler)
+        if certificate is not None:
+            self.socket = ssl.wrap_socket(self.socket, certfile=certificate, server_side=True)
+        self.devices = devices
+        self._by_name = dict((device.name, device) for device in devices)
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.verbose = verbose
+        self.scheme = 'http' if certificate is None else 'https'
+
+    def find_device(self, path):
+        # Return (device, API path) for a request path (with the leading '/' removed).
+        parts = path.split('/', 1)
+        if parts[0] in self._by_name:
+            return (self._by_name[parts[0]], parts[1] if len(parts) > 1 else '')
+        return (self.devices[0] if len(self.devices) > 0 else None, path)
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive connections (e.g. TLS EOF errors) are not worth a traceback
+        if self.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def url(self, device):
+        (host, port) = self.server_address[:2]
+        return '{0}://{1}:{2}/{3}/'.format(self.scheme, host, port, device.name)
+
+    def write_config(self, filename):
+        # Write an echo360.config with a '[capture name]' section per device.
+        with open(filename, 'w') as f:
+            for device in self.devices:
+                f.write('[capture {0}]\nuri = {1}\nusername = {2}\npassword = {3}\nprofile = {4}\n\n'.format(
+                    device.name, self.url(device), self.username, self.password, device.profile))
+
+    def start(self):
+        # Serve from a daemon thread (e.g. for tests and benchmarks). Returns the thread.
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+
+def simulator(host='127.0.0.1', port=0, rooms=1, **kwargs):
+    # Create an Echo360Simulator with 'rooms' devices, room1 ... roomN. kwargs are Echo360Simulator arguments
+    # and Echo360SimulatedDevice arguments (applied to every device). port 0 picks a free port.
+    device_args = {}
+    for name in ['utc_offset', 'schedule_interval', 'schedule_duration', 'pre_roll', 'complete_time',
+            'log_entries', 'thumbnail_size', 'reboot_time', 'speed', 'saved_content']:
+        if name in kwargs:
+            device_args[name] = kwargs.pop(name)
+    devices = [Echo360SimulatedDevice('room{0}'.format(i + 1), **device_args) for i in range(rooms)]
+    return Echo360Simulator((host, port), devices, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device simulator',
+        )
+    parser.add_argument('--host', help='listen address', default='127.0.0.1')
+    parser.add_argument('--port', help='listen port', default=8080, type=int)
+    parser.add_argument('--rooms', help='number of simulated devices', default=1, type=int)
+    parser.add_argument('--config', help='write an echo360.config for the devices to this file', default=None)
+    parser.add_argument('-u', '--user', help='username (none to disable authentication)', default='admin')
+    parser.add_argument('-p', '--password', help='password', default='password')
+    parser.add_argument('--certificate', help='PEM certificate and key file (serve HTTPS)', default=None)
+    parser.add_argument('--latency', help='mean response delay (seconds)', default=0, type=float)
+    parser.add_argument('--jitter', help='response delay standard deviation (seconds)', default=0, type=float)
+    parser.add_argument('--error-rate', help='fraction of requests answered with 503', default=0, type=float)
+    parser.add_argument('--drop-rate', help='fraction of connections dropped without a response', default=0,
+        type=float)
+    parser.add_argument('--utc-offset', help='device UTC offset (minutes)', default=600, type=int)
+    parser.add_argument('--schedule-interval', help='seconds between scheduled captures (0 for none)',
+        default=3600, type=int)
+    parser.add_argument('--schedule-duration', help='scheduled capture duration (seconds)', default=3000, type=int)
+    parser.add_argument('--pre-roll', help='waiting time before a scheduled capture (seconds)', default=60, type=int)
+    parser.add_argument('--reboot-time', help='seconds a device is offline after a reboot', default=60, type=int)
+    parser.add_argument('--log-entries', help='initial log entries per device', default=500, type=int)
+    parser.add_argument('--saved-content', help='initial saved captures per device (for recovery.py)', default=0,
+        type=int)
+    parser.add_argument('--speed', help='simulated time runs this many times faster than real time', default=1,
+        type=float)
+    parser.add_argument('-v', '--verbose', help='log each request', action='store_true')
+    args = parser.parse_args()
+
+    server = simulator(args.host, args.port, args.rooms,
+        username=None if args.user == 'none' else args.user, password=args.password, certificate=args.certificate,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, drop_rate=args.drop_rate,
+        verbose=args.verbose, utc_offset=args.utc_offset, schedule_interval=args.schedule_interval,
+        schedule_duration=args.schedule_duration, pre_roll=args.pre_roll, reboot_time=args.reboot_time,
+        log_entries=args.log_entries, speed=args.speed, saved_content=args.saved_content)
+    if args.config is not None:
+        server.write_config(args.config)
+    print('Echo360 simulator: {0} device(s), {1} ... {2}'.format(len(server.devices), server.url(server.devices[0]),
+        server.url(server.devices[-1])))
+    try:    # catch ctrl-c
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# A calendar of the scheduled captures of every capture device in echo360.config.
+#
+# ----------------------------------------------------------------------------
+# This file is part of Echo360 Tools.  The tools are free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# ----------------------------------------------------------------------------
+#
+# The task file (diagnostics/system-info/tasks) of every '[capture room_name]' section of the config file is
+# fetched concurrently and its captures are kept in an in-memory index, so questions about the whole fleet
+# are answered without asking the devices:
+#
+#     calendar = Echo360Calendar(load_rooms('echo360.config'))
+#     calendar.refresh()                  # fetch every task file; returns the rooms whose tasks changed
+#     calendar.recording(at)              # the captures in progress at 'at' (seconds since the epoch, UTC)
+#     calendar.starting(300)              # the captures starting in the next 5 minutes
+#     calendar.conflicts()                # overlapping captures in one room
+#
+# A refresh only re-indexes the rooms whose tasks changed, and a room that can't be reached keeps its last
+# tasks (and is listed in 'errors'). Captures are indexed by the 15 minute slots they cover and by start time.
+#
+# Usage: python timetable.py --config echo360.config
+#        python timetable.py --config echo360.config --rooms "lt*" --starting 5 --watch 60
+#        python timetable.py --config echo360.config --at 2014-07-01T10:00:00 --conflicts --json
+
+from capture_device import Echo360CaptureDevice, Echo360DeviceInfoCache
+from fleet import Echo360WorkerPool, load_rooms
+from recorder import parse_time
+import argparse
+import bisect
+import json
+import sys
+import threading
+import time
+
+class Echo360Calendar(object):
+    # The scheduled captures of 'rooms' (dicts from load_rooms()). Thread safe. Captures are the task dicts
+    # of diagnostics_system_info_tasks() with the 'room' name added; queries return them sorted by start.
+    def __init__(self, rooms, workers=16, timeout=10, info_cache=None, slot=900):
+        self.rooms = rooms
+        self.workers = Echo360WorkerPool(workers)
+        self.timeout = timeout
+        self.info_cache = info_cache
+        self.slot = slot
+        self.errors = {}        # room name -> (result code, message) of its last failed refresh
+        self.updated = {}       # room name -> time its tasks were last fetched
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._tasks = {}        # room name -> captures
+        self._fingerprints = {} # room name -> what update() compares to find changed rooms
+        self._slots = {}        # slot number -> sorted (start, room name, task id, capture) in progress in the slot
+        self._starts = []       # sorted (start, room name, task id, capture)
+        self._conflicts = None  # conflicts(), until the next change
+
+    def device(self, room):
+        name = room['room']
+        if name not in self._devices:
+            device = Echo360CaptureDevice(room['uri'], room['username'], room['password'], timeout=self.timeout,
+                lazy=True, info_cache=self.info_cache)
+            if not device.connection_test.success():
+                return device
+            self._devices[name] = device
+        return self._devices[name]
+
+    def fetch_room(self, room):
+        # The diagnostics_system_info_tasks() response of one room (or its failed connection test)
+        device = self.device(room)
+        if not device.connection_test.success():
+            return device.connection_test
+        return device.diagnostics_system_info_tasks()
+
+    def refresh(self, rooms=None):
+        # Fetch the task files of 'rooms' (default: all) concurrently and index the changes.
+        # Returns the names of the rooms whose captures changed.
+        jobs = [self.workers.submit(self.fetch_room, room) for room in (rooms or self.rooms)]
+        fetched = {}
+        for job in self.workers.as_completed(jobs):
+            name = job.args[0]['room']
+            if job.error is not None:
+                self.errors[name] = ('unknown', 'Unknown error: {0}'.format(repr(job.error)))
+            elif not job.result.success():
+                self.errors[name] = (job.result._result_code, job.result._result_message)
+            else:
+                self.errors.pop(name, None)
+                self.updated[name] = time.time()
+                fetched[name] = job.result.tasks
+        return self.update(fetched)
+
+    def update(self, rooms):
+        # Replace the captures of each room in 'rooms' (room name -> task dicts). Returns the names of the rooms
+        # whose captures changed. A few changed rooms are updated in place, many rebuild the whole index.
+        changed = {}
+        for (name, tasks) in rooms.items():
+            tasks = sorted((dict(task, room=name) for task in tasks if task.get('start') is not None),
+                key=lambda task: task['start'])
+            fingerprint = [(task.get('id'), task['start'], task['end'], task.get('title'), task.get('section'))
+                for task in tasks]
+            if self._fingerprints.get(name) != fingerprint:
+                changed[name] = (tasks, fingerprint)
+        with self._lock:
+            rebuild = len(changed) > max(8, len(self._tasks) // 4)
+            for (name, (tasks, fingerprint)) in changed.items():
+                if not rebuild:
+                    for task in self._tasks.get(name, []):
+                        self._remove(task)
+                    for task in tasks:
+                        self._add(task)
+                self._tasks[name] = tasks
+                self._fingerprints[name] = fingerprint
+            if rebuild:
+                self._rebuild()
+            if len(changed) > 0:
+                self._conflicts = None
+        return sorted(changed)
+
+    def _key(self, task):
+        return (task['start'], task['room'], task.get('id'), task)
+
+    def _rebuild(self):
+        self._starts = sorted(self._key(task) for tasks in self._tasks.values() for task in tasks)
+        self._slots = {}
+        for key in self._starts:
+            for slot in self._task_slots(key[3]):
+                self._slots.setdefault(slot, []).append(key)
+
+    def _add(self, task):
+        key = self._key(task)
+        for slot in self._task_slots(task):
+            bisect.insort(self._slots.setdefault(slot, []), key)
+        bisect.insort(self._starts, key)
+
+    def _remove(self, task):
+        for slot in self._task_slots(task):
+            self._delete(self._slots[slot], task)
+            if len(self._slots[slot]) == 0:
+                del self._slots[slot]
+        self._delete(self._starts, task)
+
+    def _delete(self, keys, task):
+        i = bisect.bisect_left(keys, (task['start'], task['room'], task.get('id')))
+        while keys[i][3] is not task:
+            i += 1
+        del keys[i]
+
+    def _task_slots(self, task):
+        return xrange(int(task['start'] // self.slot), int(max(task['start'], task['end'] - 1) // self.slot) + 1)
+
+    def tasks(self, name):
+        with self._lock:
+            return list(self._tasks.get(name, []))
+
+    def recording(self, at=None):
+        # The captures in progress at 'at' (default: now)
+        at = time.time() if at is None else at
+        with self._lock:
+            return [key[3] for key in self._slots.get(int(at // self.slot), []) if key[0] <= at < key[3]['end']]
+
+    def starting(self, within=300, at=None):
+        # The captures starting in the 'within' seconds after 'at' (default: now)
+        at = time.time() if at is None else at
+        with self._lock:
+            i = bisect.bisect_left(self._starts, (at,))
+            j = bisect.bisect_left(self._starts, (at + within,))
+            return [key[3] for key in self._starts[i:j]]
+
+    def conflicts(self):
+        # A list of (kind, capture, capture) of the captures of one room that overlap, sorted by start:
+        # 'duplicate' if they start and end at the same time (e.g. scheduled twice), otherwise 'overlap'.
+        with self._lock:
+            if self._conflicts is None:
+                self._conflicts = []
+                for tasks in self._tasks.values():
+                    self._conflicts.extend(self._find_conflicts(tasks))
+                self._conflicts.sort(key=lambda (kind, a, b): (b['start'], b['room']))
+            return list(self._conflicts)
+
+    def _find_conflicts(self, tasks):
+        # Sweep the captures of a room in start order, keeping those that haven't ended yet
+        conflicts = []
+        active = []
+        for task in tasks:
+            active = [other for other in active if other['end'] > task['start']]
+            for other in active:
+                same = other['start'] == task['start'] and other['end'] == task['end']
+                conflicts.append(('duplicate' if same else 'overlap', other, task))
+            active.append(task)
+        return conflicts
+
+def task_str(task):
+    return '{0:<24} {1:<20} {2:>4} min  {3:<32} {4}'.format(task['room'],
+        (task.get('start_time_local') or task.get('start_time') or '')[:19], int(task['end'] - task['start']) // 60,
+        task.get('title'), task.get('section') or '')
+
+def task_dict(task):
+    return dict((name, value) for (name, value) in task.items() if name not in ['start', 'end'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Echo360 Capture Device fleet capture calendar',
+        )
+    parser.add_argument('--config', help='config file', default='echo360.config')
+    parser.add_argument('--rooms', help='room name glob (e.g. "lt*")', default='*')
+    parser.add_argument('--at', help='time for the recording and starting lists, UTC (default: now)', default=None)
+    parser.add_argument('--starting', help='list the captures starting in the next N minutes', default=5,
+        type=float)
+    parser.add_argument('--conflicts', help='list overlapping captures', action='store_true')
+    parser.add_argument('--watch', help='refresh every N seconds, printing changes', default=None, type=float)
+    parser.add_argument('--json', help='print JSON', action='store_true')
+    parser.add_argument('--workers', help='task files fetched at once', default=16, type=int)
+    parser.add_argument('-t', '--timeout', help='HTTP timeout', default=10, type=int)
+    parser.add_argument('--cache', help='device information cache file (skips connection tests)', default=None)
+    parser.add_argument('--cache-ttl', help='device information cache lifetime (seconds)', default=24*3600, type=int)
+    args = parser.parse_args()
+
+    info_cache = None
+    if args.cache is not None:
+        info_cache = Echo360DeviceInfoCache(args.cache, args.cache_ttl)
+    calendar = Echo360Calendar(load_rooms(args.config, args.rooms), workers=args.workers, timeout=args.timeout,
+        info_cache=info_cache)
+
+    try:    # catch ctrl-c
+        while True:
+            start = time.time()
+            changed = calendar.refresh()
+            at = parse_time(args.at) if args.at is not None else time.time()
+            recording = calendar.recording(at)
+            starting = calendar.starting(args.starting * 60, at)
+            conflicts = calendar.conflicts() if args.conflicts else []
+            if args.json:
+                print(json.dumps({'time': at, 'changed': changed, 'errors': calendar.errors,
+                    'recording': [task_dict(task) for task in recording],
+                    'starting': [task_dict(task) for task in starting],
+                    'conflicts': [[kind, task_dict(a), task_dict(b)] for (kind, a, b) in conflicts]}, sort_keys=True))
+            else:
+                print('{0} captures in {1} rooms, {2} rooms changed, {3} errors ({4:.1f} seconds)'.format(
+                    sum(len(calendar.tasks(room['room'])) for room in calendar.rooms), len(calendar.rooms),
+                    len(changed), len(calendar.errors), time.time() - start))
+                for (name, (code, message)) in sorted(calendar.errors.items()):
+                    print('{0:<24} error {1}: {2}'.format(name, code, message))
+                print('Recording:')
+                for task in recording:
+                    print('    ' + task_str(task))
+                print('Starting in the next {0:g} minutes:'.format(args.starting))
+                for task in starting:
+                    print('    ' + task_str(task))
+                if args.conflicts:
+                    print('Conflicts:')
+                    for (kind, a, b) in conflicts:
+                        print('    {0:<8} {1}\n             {2}'.format(kind, task_str(a), task_str(b)))
+            sys.stdout.flush()
+            if args.watch is None:
+                break
+            time.sleep(max(0, args.watch - (time.time() - start)))
+    except KeyboardInterrupt:
+        print('\nCtrl-C User requested exit.')